@@ -22,7 +22,10 @@ from scipy.io import savemat
 from datetime import datetime, timedelta
 from glob import glob1
 from os.path import join
+from fnmatch import fnmatch
 import os
+import json
+import hashlib
 
 # ETS imports
 try:
@@ -32,10 +35,17 @@ try:
 except ImportError:
     BC_UI = False
     pass
+
+# HDF5 correlation store
+try:
+    BC_H5PY = True
+    import h5py
+except ImportError:
+    BC_H5PY = False
     
 # Obspy imports
 from obspy.signal.invsim import cosine_taper
-from obspy.core import trace, stream
+from obspy.core import trace, stream, UTCDateTime
 
 
 # Local imports
@@ -2151,5 +2161,337 @@ if BC_UI:
                                  Item('stations'),
                                  Item('locations'),
                                  Item('channels')))
-    
+
+
+class CorrelationStore(object):
+    """HDF5 file holding the correlation traces of many combinations
+
+    Every combination is stored in a group named after the ID of its
+    correlation traces (e.g. ``LT-LT.LT01-LT02.-.HHZ-HHZ``) that holds an
+    extendable dataset ``corr_data`` of shape ``(time, lag)``, the time
+    index ``time`` with the start time of the first trace of each row and
+    the time ``written`` when each row was written, both as POSIX
+    timestamps, and the ``checksum`` of every row calculated when it is
+    written (see :func:`_row_checksums`). The stats dictionaries of the combination are kept as
+    attributes. ``corr_data`` is chunked in blocks of ``chunk_rows`` rows
+    and compressed so that a time range of a combination is read without
+    reading the whole matrix. The datasets grow in steps of ``chunk_rows``
+    rows, the number of rows in use is kept in the attribute ``nrows``.
+
+    HDF5 files must not be written concurrently by several processes. With
+    MPI every process writes its own store (see :func:`corr_store_name`) and
+    :func:`corr_mat_from_stores` combines the rows of all of them.
+
+    :type fname: string
+    :param fname: name of the HDF5 file
+    :type mode: string
+    :param mode: ``'a'`` to create or append, ``'r'`` to read only
+    :type chunk_rows: int
+    :param chunk_rows: number of rows in a chunk of ``corr_data``
+    :type compression: string or None
+    :param compression: HDF5 compression filter of ``corr_data``
+    """
+    def __init__(self, fname, mode='a', chunk_rows=24, compression='gzip'):
+        if not BC_H5PY:
+            raise ImportError('CorrelationStore requires h5py.')
+        self.fname = fname
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.h5 = h5py.File(fname, mode)
+        # row index of the combinations used by append
+        self._indices = {}
+
+    def _create_group(self, tr):
+        grp = self.h5.create_group(tr.id)
+        grp.attrs['stats'] = json.dumps(_stats_dict_from_obj(tr.stats))
+        grp.attrs['stats_tr1'] = json.dumps(_stats_dict_from_obj(tr.stats_tr1))
+        grp.attrs['stats_tr2'] = json.dumps(_stats_dict_from_obj(tr.stats_tr2))
+        grp.attrs['nrows'] = 0
+        npts = len(tr.data)
+        grp.create_dataset('corr_data', shape=(0, npts), maxshape=(None, npts),
+                           chunks=(self.chunk_rows, npts), dtype=tr.data.dtype,
+                           compression=self.compression,
+                           shuffle=(self.compression is not None))
+        grp.create_dataset('time', shape=(0,), maxshape=(None,),
+                           chunks=(1024,), dtype=np.float64)
+        grp.create_dataset('written', shape=(0,), maxshape=(None,),
+                           chunks=(1024,), dtype=np.float64)
+        grp.create_dataset('checksum', shape=(0,), maxshape=(None,),
+                           chunks=(1024,), dtype=np.uint64)
+        return grp
+
+    def _nrows(self, ID):
+        """Number of rows of combination ``ID`` in use
+        """
+        grp = self.h5[ID]
+        if 'nrows' in grp.attrs:
+            return int(grp.attrs['nrows'])
+        return grp['time'].shape[0]
+
+    def _index(self, ID):
+        """Sampling rate, number of samples and rows of combination ``ID``
+        and a dictionary of the rows of the start times
+
+        The index is read once and then kept up to date by :meth:`append`.
+        """
+        if ID not in self._indices:
+            grp = self.h5[ID]
+            nrows = self._nrows(ID)
+            times = grp['time'][:nrows]
+            if 'written' not in grp:
+                grp.create_dataset('written', data=np.zeros(len(times)),
+                                   maxshape=(None,), chunks=(1024,))
+            if 'checksum' not in grp:
+                grp.create_dataset('checksum', data=_row_checksums(
+                                       ID, times, grp['corr_data'][:nrows]),
+                                   maxshape=(None,), chunks=(1024,))
+            self._indices[ID] = {
+                'sampling_rate': json.loads(grp.attrs['stats'])['sampling_rate'],
+                'npts': grp['corr_data'].shape[1],
+                'nrows': nrows,
+                'rows': dict(zip(times.tolist(), range(nrows)))}
+        return self._indices[ID]
+
+    def append(self, st):
+        """Append the correlation traces of the stream ``st``
+
+        Every trace becomes a row of the combination of its ID. A trace with
+        the same start time as an existing row replaces that row so that
+        writing the same correlations again does not duplicate them. The
+        traces are grouped by combination and the new rows of a combination
+        are written in one slice.
+
+        :type st: :class:`~obspy.core.stream.Stream`
+        :param st: correlation traces with ``stats_tr1`` and ``stats_tr2``
+
+        :raises InputError: if a trace does not match the sampling rate or
+            length of its combination. Nothing is written in that case.
+        """
+        groups = {}
+        for tr in st:
+            groups.setdefault(tr.id, []).append(tr)
+        for ID, traces in groups.items():
+            if ID in self.h5:
+                index = self._index(ID)
+                sampling_rate, npts = index['sampling_rate'], index['npts']
+            else:
+                sampling_rate = traces[0].stats['sampling_rate']
+                npts = len(traces[0].data)
+            for tr in traces:
+                if (tr.stats['sampling_rate'] != sampling_rate) or \
+                        (len(tr.data) != npts):
+                    raise InputError('Trace %s at %s does not match the '
+                                     'combination.' %
+                                     (ID, tr.stats_tr1['starttime']))
+        written = float(UTCDateTime())
+        for ID in sorted(groups.keys()):
+            traces = groups[ID]
+            if ID not in self.h5:
+                self._create_group(traces[0])
+            grp = self.h5[ID]
+            index = self._index(ID)
+            # the last trace of a start time is used
+            data = {}
+            for tr in traces:
+                data[float(UTCDateTime(tr.stats_tr1['starttime']))] = tr.data
+            old = sorted([(index['rows'][ttime], ttime) for ttime in data
+                          if ttime in index['rows']])
+            new = sorted([ttime for ttime in data
+                          if ttime not in index['rows']])
+            dtype = grp['corr_data'].dtype
+            if old:
+                rows = [row for row, _ in old]
+                otimes = [ttime for _, ttime in old]
+                odata = np.array([data[ttime] for ttime in otimes],
+                                 dtype=dtype)
+                grp['corr_data'][rows, :] = odata
+                grp['written'][rows] = np.ones(len(rows))*written
+                grp['checksum'][rows] = _row_checksums(ID, otimes, odata)
+            if new:
+                start = index['nrows']
+                stop = start + len(new)
+                if stop > grp['time'].shape[0]:
+                    step = grp['corr_data'].chunks[0]
+                    size = int(np.ceil(float(stop)/step))*step
+                    for name in ['time', 'written', 'checksum']:
+                        grp[name].resize((size,))
+                    grp['corr_data'].resize((size, index['npts']))
+                ndata = np.array([data[ttime] for ttime in new], dtype=dtype)
+                grp['corr_data'][start:stop] = ndata
+                grp['time'][start:stop] = new
+                grp['written'][start:stop] = written
+                grp['checksum'][start:stop] = _row_checksums(ID, new, ndata)
+                for row, ttime in enumerate(new, start):
+                    index['rows'][ttime] = row
+                index['nrows'] = stop
+                grp.attrs['nrows'] = stop
+        self.h5.flush()
+
+    def combinations(self, pattern='*'):
+        """Sorted IDs of the combinations matching the glob ``pattern``
+        """
+        return sorted([ID for ID in self.h5.keys() if fnmatch(ID, pattern)])
+
+    def _rows(self, ID, starttime=None, endtime=None):
+        """Time index of combination ``ID`` and the indices of the rows
+        with ``starttime <= time < endtime``
+        """
+        times = self.h5[ID]['time'][:self._nrows(ID)]
+        sel = np.ones(len(times), dtype=bool)
+        if starttime is not None:
+            sel &= times >= float(UTCDateTime(starttime))
+        if endtime is not None:
+            sel &= times < float(UTCDateTime(endtime))
+        return times, np.where(sel)[0]
+
+    def _read(self, ID, starttime=None, endtime=None):
+        """Time, write time and data of the rows of combination ``ID`` that
+        start in a time range sorted by time
+        """
+        grp = self.h5[ID]
+        times, ind = self._rows(ID, starttime, endtime)
+        if len(ind) == 0:
+            return times[:0], times[:0], \
+                np.zeros((0, grp['corr_data'].shape[1]),
+                         dtype=grp['corr_data'].dtype)
+        data = grp['corr_data'][ind[0]:ind[-1]+1][ind-ind[0]]
+        if 'written' in grp:
+            written = grp['written'][ind[0]:ind[-1]+1][ind-ind[0]]
+        else:
+            written = np.zeros(len(ind))
+        order = np.argsort(times[ind], kind='mergesort')
+        return times[ind][order], written[order], data[order]
+
+    def read(self, ID, starttime=None, endtime=None):
+        """Rows of combination ``ID`` that start in a time range
+
+        Only the chunks of ``corr_data`` spanning the rows with
+        ``starttime <= time < endtime`` are read.
+
+        :rtype: tuple
+        :return: time as POSIX timestamps and data of the rows sorted by time
+        """
+        times, _, data = self._read(ID, starttime, endtime)
+        return times, data
+
+    def digest(self, starttime=None, endtime=None, checksum=True,
+               recompute=False):
+        """Number of rows of all combinations that start in a time range
+
+        With ``checksum`` the sum of the checksums of these rows is returned
+        as well (``None`` otherwise). The sum does not depend on the order in
+        which the rows were written. The checksums recorded by
+        :meth:`append` are used such that only the time index and the
+        checksums are read. With ``recompute`` they are calculated from the
+        data of the rows instead to detect corrupted data.
+
+        :rtype: tuple
+        :return: number of rows and checksum
+        """
+        nrows = 0
+        total = 0
+        for ID in self.combinations():
+            times, ind = self._rows(ID, starttime, endtime)
+            nrows += len(ind)
+            if (not checksum) or (len(ind) == 0):
+                continue
+            grp = self.h5[ID]
+            if recompute or ('checksum' not in grp):
+                data = grp['corr_data'][ind[0]:ind[-1]+1][ind-ind[0]]
+                sums = _row_checksums(ID, times[ind], data)
+            else:
+                sums = grp['checksum'][ind[0]:ind[-1]+1][ind-ind[0]]
+            total = (total + sum([int(c) for c in sums])) % 2**64
+        if not checksum:
+            return nrows, None
+        return nrows, '%016x' % total
+
+    def stats(self, ID):
+        """The stats dictionaries ``stats``, ``stats_tr1`` and ``stats_tr2``
+        of combination ``ID``
+        """
+        grp = self.h5[ID]
+        return dict([(key, dict([(str(k), v) for k, v in
+                                 json.loads(grp.attrs[key]).items()]))
+                     for key in ['stats', 'stats_tr1', 'stats_tr2']])
+
+    def corr_mat(self, ID, starttime=None, endtime=None):
+        """Correlation matrix of combination ``ID`` in a time range
+
+        :rtype: dictionary of type correlation matrix
+        :return: **corr_mat** as created by :func:`corr_mat_from_corr_stream`
+        """
+        return corr_mat_from_stores([self], ID, starttime, endtime)
+
+    def close(self):
+        self.h5.close()
+
+
+def _row_checksums(ID, times, data):
+    """Checksums of the rows of combination ``ID`` with start ``times``
+    and ``data``
+
+    The checksum of a row is made of the first eight bytes of the SHA1 digest of
+    the ID, the start time and the data of the row.
+    """
+    sums = np.zeros(len(times), dtype=np.uint64)
+    for ii, (ttime, row) in enumerate(zip(times, data)):
+        sha1 = hashlib.sha1(ID.encode('utf-8'))
+        sha1.update(np.float64(ttime).tobytes())
+        sha1.update(np.ascontiguousarray(row).tobytes())
+        sums[ii] = int(sha1.hexdigest()[:16], 16)
+    return sums
+
+
+def corr_store_name(base_dir, rank=0):
+    """Name of the correlation store written by process ``rank``
+    """
+    return join(base_dir, 'correlations_%s.h5' % rank)
+
+
+def corr_mat_from_stores(stores, ID, starttime=None, endtime=None):
+    """Correlation matrix of combination ``ID`` from several stores
+
+    The rows of the combination in all stores (e.g. the files of the
+    processes of a parallel run) with a start time in the range
+    ``starttime <= time < endtime`` are combined in one correlation matrix
+    sorted by time. If rows of the same time are present in several stores
+    the one written last is used, such that a store of a later run replaces
+    the rows of an earlier run independent of the number of processes and
+    the names of the stores. Rows written at the same time (or by stores
+    without write times) are taken from the store later in ``stores``.
+
+    :type stores: list
+    :param stores: :class:`CorrelationStore` objects or file names
+    :type ID: string
+    :param ID: ID of the correlation traces of the combination
+
+    :rtype: dictionary of type correlation matrix
+    :return: **corr_mat**
+    """
+    corr_mat = None
+    rows = {}
+    for store in stores:
+        opened = not isinstance(store, CorrelationStore)
+        if opened:
+            store = CorrelationStore(store, mode='r')
+        try:
+            if ID not in store.h5:
+                continue
+            if corr_mat is None:
+                corr_mat = store.stats(ID)
+            times, written, data = store._read(ID, starttime, endtime)
+            for ttime, wtime, row in zip(times, written, data):
+                if (ttime not in rows) or (wtime >= rows[ttime][0]):
+                    rows[ttime] = (wtime, row)
+        finally:
+            if opened:
+                store.close()
+    if corr_mat is None:
+        raise KeyError('Combination %s is not in the stores.' % ID)
+    times = sorted(rows.keys())
+    corr_mat['corr_data'] = np.array([rows[ttime][1] for ttime in times])
+    corr_mat['time'] = np.array(['%s' % UTCDateTime(ttime) for ttime in times])
+    return corr_mat
+
 # EOF
@@ -1,9 +1,41 @@
 #!/usr/bin/python
 
+import os
+import glob
+import hashlib
+import threading
+import time
 import numpy as np
 import scipy.signal as signal
-from mpi4py import MPI
+from collections import OrderedDict
 from copy import deepcopy
+from itertools import imap, izip
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# mpi4py is only required for parallel execution on several processes
+try:
+    BC_MPI = True
+    from mpi4py import MPI
+except ImportError:
+    BC_MPI = False
+
+# optional Fourier transform backends
+try:
+    BC_SCIPY_FFT = True
+    import scipy.fft as sfft
+except ImportError:
+    BC_SCIPY_FFT = False
+try:
+    BC_FFTW = True
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    BC_FFTW = False
+try:
+    from scipy.fft import next_fast_len
+except ImportError:
+    from scipy.fftpack import next_fast_len
 
 from obspy.core import UTCDateTime, stream, trace
 import obspy.signal as osignal
@@ -11,254 +43,1401 @@ import obspy.signal as osignal
 from miic.core.corr_fun import combine_stats
 from miic.core.miic_utils import convert_to_matlab
 
-from numpy import (expand_dims, nanmean,reshape, transpose, take,
-             sort, ones, arange, dot, cast, asarray)
-from scipy import linalg
+from numpy import expand_dims, nanmean, asarray
 
 
 zerotime = UTCDateTime(1971,1,1)
 
 
+class LocalComm(object):
+    """Communicator for execution in a single process without MPI
 
-def pxcorr_write(comm,A,st,**kwargs):
-    """ A is an array with time along going the first dimension.
+    Implements the part of the interface of an `mpi4py` communicator that is
+    used by :func:`stream_pxcorr` for a single process. It can be passed as
+    `comm` to run the correlation without an MPI launcher and is used by
+    default if `mpi4py` is not installed. To use all cores of the machine
+    combine it with the `threads` executor.
     """
-    global zerotime
+    def Get_rank(self):
+        return 0
 
-    t0 = MPI.Wtime()
-    msize = A.shape
-    ntrc = msize[1]
+    def Get_size(self):
+        return 1
 
-    psize = comm.Get_size()
-    rank = comm.Get_rank()
-    # time domain processing
-    # map of traces on precesses
-    # test if joint normalization per station is required
-    jnormflag = False
-    for proc in kwargs['FDpreProcessing']:
-        if proc['function'] == spectralWhitening:
-            if 'joint_norm' in proc['args']:
-                jnormflag = True
-    if jnormflag:
-        # for joint normalization all channels of a station must go to the same
-        # rank.
-        assert ntrc % 3 == 0, "for joint normalization in spectralWhitening "\
-                      "the number of traces needs to the multiple of 3: %d" % ntrc
-        Nst = ntrc/3
-	pmap = (np.arange(ntrc)*np.min((psize,Nst)))/ntrc 
+    def barrier(self):
+        pass
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def gather(self, obj, root=0):
+        return [obj]
+
+
+class SerialExecutor(object):
+    """Executor that maps functions sequentially in the calling thread
+    """
+    size = 1
+
+    def imap(self, func, iterable):
+        return imap(func, iterable)
+
+    def close(self):
+        pass
+
+
+class ThreadExecutor(object):
+    """Executor that maps functions on a pool of threads
+
+    NumPy releases the global interpreter lock in its array operations and
+    Fourier transforms such that blocks of traces and combinations can be
+    processed simultaneously on several cores of one machine. The order of
+    the results is preserved.
+
+    :type threads: int
+    :param threads: number of threads (defaults to the number of cores)
+    """
+    def __init__(self, threads=None):
+        if not threads:
+            threads = cpu_count()
+        self.size = threads
+        self.pool = ThreadPool(threads)
+
+    def imap(self, func, iterable):
+        return self.pool.imap(func, iterable)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def get_executor(options):
+    """Return the executor that maps the work within one process
+
+    `options['executor']` may be `serial` (default) or `threads`. For
+    `threads` the number of threads can be given in `options['threads']`.
+    Any object with the methods `imap`, `close` and the attribute `size`
+    (number of workers) can be passed as well. Such an executor belongs to
+    the caller and is not closed by :func:`pxcorr` (see
+    :func:`_close_executor`).
+    """
+    if 'executor' not in options.keys():
+        return SerialExecutor()
+    executor = options['executor']
+    if executor == 'serial':
+        return SerialExecutor()
+    elif executor == 'threads':
+        if 'threads' in options.keys():
+            return ThreadExecutor(options['threads'])
+        return ThreadExecutor()
+    elif hasattr(executor, 'imap'):
+        return executor
+    raise ValueError("executor '%s' not implemented" % executor)
+
+
+def _close_executor(executor, options):
+    """Close `executor` if it was created by :func:`get_executor` and not
+    passed in `options['executor']`
+    """
+    if ('executor' in options.keys()) and (executor is options['executor']):
+        return
+    executor.close()
+
+
+class NumpyFFT(object):
+    """Fourier transforms along the first dimension with `numpy.fft`
+    """
+    def rfft(self, A):
+        return np.fft.rfft(A,axis=0)
+
+    def irfft(self, B, n):
+        return np.fft.irfft(B,n=n,axis=0)
+
+
+class ScipyFFT(object):
+    """Fourier transforms along the first dimension with `scipy.fft`
+
+    :type workers: int
+    :param workers: number of threads used by `scipy.fft` for a transform
+        of several columns
+    """
+    def __init__(self, workers=None):
+        if not BC_SCIPY_FFT:
+            raise ImportError("fft backend 'scipy' requires scipy.fft")
+        self.workers = workers
+
+    def rfft(self, A):
+        return sfft.rfft(A,axis=0,workers=self.workers)
+
+    def irfft(self, B, n):
+        return sfft.irfft(B,n=n,axis=0,workers=self.workers)
+
+
+class FFTWFFT(object):
+    """Fourier transforms along the first dimension with pyFFTW
+
+    The FFTW plans are created once for every shape and dtype of the input
+    and cached. As a plan must not be executed by several threads at the
+    same time every thread keeps its own cache.
+
+    :type threads: int
+    :param threads: number of threads used by FFTW for one transform
+    :type planner_effort: str
+    :param planner_effort: FFTW planner flag used to create the plans
+    """
+    def __init__(self, threads=1, planner_effort='FFTW_MEASURE'):
+        if not BC_FFTW:
+            raise ImportError("fft backend 'fftw' requires pyfftw")
+        self.threads = threads or 1
+        self.planner_effort = planner_effort
+        self.local = threading.local()
+
+    def _plan(self, builder, A, n=None):
+        if not hasattr(self.local, 'plans'):
+            self.local.plans = {}
+        key = (builder.__name__, A.shape, A.dtype.str, n)
+        if key not in self.local.plans:
+            # planning may overwrite the input so it is done on a dummy
+            dummy = pyfftw.empty_aligned(A.shape,dtype=A.dtype)
+            kwargs = {'axis':0,'threads':self.threads,
+                      'planner_effort':self.planner_effort}
+            if n is not None:
+                kwargs['n'] = n
+            self.local.plans[key] = builder(dummy,**kwargs)
+        return self.local.plans[key]
+
+    def rfft(self, A):
+        # the output array of a plan is reused by the next call
+        return self._plan(pyfftw.builders.rfft,A)(A).copy()
+
+    def irfft(self, B, n):
+        return self._plan(pyfftw.builders.irfft,B,n)(B).copy()
+
+
+def get_fft(options):
+    """Return the backend used for the Fourier transforms
+
+    `options['fft']` may be `numpy` (default), `scipy` or `fftw`. The number
+    of threads used by `scipy` and `fftw` for one transform can be given in
+    `options['fft_threads']`. Any object with the methods `rfft(A)` and
+    `irfft(B, n)` transforming along the first dimension can be passed as
+    well.
+    """
+    if 'fft' not in options.keys():
+        return NumpyFFT()
+    fft = options['fft']
+    if 'fft_threads' in options.keys():
+        threads = options['fft_threads']
     else:
-        pmap = (np.arange(ntrc)*psize)/ntrc
-    # indecies for traces to be worked on by each process
-    ind = pmap == rank
+        threads = None
+    if fft == 'numpy':
+        return NumpyFFT()
+    elif fft == 'scipy':
+        return ScipyFFT(threads)
+    elif fft == 'fftw':
+        return FFTWFFT(threads)
+    elif hasattr(fft, 'rfft') and hasattr(fft, 'irfft'):
+        return fft
+    raise ValueError("fft backend '%s' not implemented" % fft)
+
+
+class NodeSharedMemory(object):
+    """Arrays shared by the processes of one node
+
+    The processes of `comm` are split into groups that share memory (one
+    group per node). Arrays returned by :meth:`zeros` are allocated once per
+    node in an MPI shared memory window and every process of the node works
+    on the same memory. Reductions are only communicated between the
+    leaders (lowest rank) of the nodes.
+
+    :type comm: :class:`mpi4py.MPI.Comm`
+    :param comm: communicator of all processes
+    """
+    def __init__(self, comm):
+        self.nodecomm = comm.Split_type(MPI.COMM_TYPE_SHARED,
+                                        key=comm.Get_rank())
+        self.leader = self.nodecomm.Get_rank() == 0
+        color = 0 if self.leader else MPI.UNDEFINED
+        self.leadercomm = comm.Split(color,comm.Get_rank())
+        self.windows = []
+
+    def zeros(self, shape, dtype=np.float64):
+        """Return a zero filled array in memory shared within the node
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape))*dtype.itemsize if self.leader else 0
+        win = MPI.Win.Allocate_shared(nbytes,dtype.itemsize,
+                                      comm=self.nodecomm)
+        self.windows.append(win)
+        buf, itemsize = win.Shared_query(0)
+        arr = np.ndarray(buffer=buf,dtype=dtype,shape=shape)
+        if self.leader:
+            arr[:] = 0
+        self.nodecomm.Barrier()
+        return arr
+
+    def allreduce(self, arr):
+        """Sum a shared array over all nodes in place
+
+        Every process must have finished writing its contribution to the
+        array of its node before calling this function.
+        """
+        self.nodecomm.Barrier()
+        if self.leader and self.leadercomm.Get_size() > 1:
+            rarr = arr.reshape(-1).view(_real_dtype(arr.dtype))
+            self.leadercomm.Allreduce(MPI.IN_PLACE,
+                                      [rarr,_mpi_type(rarr.dtype)],
+                                      op=MPI.SUM)
+        self.nodecomm.Barrier()
+        return arr
+
+    def free(self):
+        """Release the shared arrays and the communicators
+        """
+        self.nodecomm.Barrier()
+        for win in self.windows:
+            win.Free()
+        self.windows = []
+        if self.leadercomm != MPI.COMM_NULL:
+            self.leadercomm.Free()
+        self.nodecomm.Free()
+
+
+class WorkCounter(object):
+    """Counter shared by all processes to hand out work dynamically
+
+    The counter is held in an MPI window on rank 0 and incremented with an
+    atomic one-sided fetch and add, such that a process claims the next
+    items as soon as it has finished its previous ones without involving
+    the other processes. Without MPI the counter is a local integer.
+
+    :type comm: :class:`mpi4py.MPI.Comm`
+    :param comm: communicator of the processes sharing the work
+    """
+    def __init__(self, comm):
+        self.win = None
+        self.count = 0
+        if comm.Get_size() == 1:
+            return
+        itemsize = MPI.INT64_T.Get_size()
+        nbytes = itemsize if comm.Get_rank() == 0 else 0
+        self.win = MPI.Win.Allocate(nbytes,itemsize,comm=comm)
+        if comm.Get_rank() == 0:
+            self.win.Lock(0,MPI.LOCK_EXCLUSIVE)
+            self.win.Put([np.zeros(1,dtype=np.int64),MPI.INT64_T],0)
+            self.win.Unlock(0)
+        comm.Barrier()
+
+    def claim(self, n=1):
+        """Claim `n` items and return the index of the first one
+        """
+        if self.win is None:
+            start = self.count
+            self.count += n
+            return start
+        inc = np.array([n],dtype=np.int64)
+        start = np.zeros(1,dtype=np.int64)
+        self.win.Lock(0,MPI.LOCK_SHARED)
+        self.win.Fetch_and_op([inc,MPI.INT64_T],[start,MPI.INT64_T],0,0,
+                              MPI.SUM)
+        self.win.Unlock(0)
+        return int(start[0])
+
+    def free(self):
+        """Release the window of the counter (collective)
+        """
+        if self.win is not None:
+            self.win.Free()
+            self.win = None
+
+
+class SpectrumCache(object):
+    """On-disk cache of pre-processed spectra of single traces
+
+    Every spectrum is stored in a numpy file in `directory` named by a hash
+    of the seed ID and the start time of the trace, the sampling rate, the
+    number of samples and the processing recipe (see :func:`_recipe_hash`).
+    Spectra are returned as memory-mapped arrays. The modification time of
+    a file is updated when it is read such that :meth:`evict` removes the
+    least recently used spectra first.
+
+    The size of the cache is scanned once and then tracked by :meth:`put`.
+    When it exceeds `max_size` the cache is evicted to `low_water` times
+    `max_size` so that the directory is not scanned on every write. Spectra
+    written by other processes are only accounted for at the next eviction.
+
+    :type directory: str
+    :param directory: directory of the cache
+    :type max_size: int
+    :param max_size: size of the cache in bytes (unlimited if None)
+    """
+    low_water = 0.9
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def key(self, trace_id, starttime, sampling_rate, npts, recipe):
+        """Return the key of the spectrum of a trace
+        """
+        desc = '%s|%s|%r|%d|%s' % (trace_id,starttime,float(sampling_rate),
+                                   npts,recipe)
+        return hashlib.sha1(desc.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory,key + '.npy')
+
+    def get(self, key):
+        """Return the spectrum stored under `key` or None
+        """
+        path = self._path(key)
+        try:
+            spec = np.load(path,mmap_mode='r')
+            os.utime(path,None)
+        except (IOError, OSError, ValueError):
+            return None
+        return spec
+
+    def put(self, key, spec):
+        """Store the spectrum `spec` under `key`
+        """
+        path = self._path(key)
+        # write to a temporary file first such that no other process reads
+        # an incomplete file
+        tmp = '%s.%d.tmp' % (path,os.getpid())
+        with open(tmp,'wb') as fh:
+            np.save(fh,np.ascontiguousarray(spec))
+        if self.max_size is None:
+            os.rename(tmp,path)
+            return
+        if self._size is None:
+            self._size = self.size()
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        self._size += os.path.getsize(tmp)
+        os.rename(tmp,path)
+        if self._size > self.max_size:
+            self.evict(int(self.low_water*self.max_size))
+
+    def files(self):
+        """Return the modification time, size and path of all spectra
+        ordered from the least to the most recently used one
+        """
+        flist = []
+        for path in glob.glob(os.path.join(self.directory,'*.npy')):
+            try:
+                fstat = os.stat(path)
+            except OSError:
+                continue
+            flist.append((fstat.st_mtime,fstat.st_size,path))
+        return sorted(flist)
+
+    def size(self):
+        """Return the size of the cache in bytes
+        """
+        return sum([fsize for mtime, fsize, path in self.files()])
+
+    def evict(self, max_size=None):
+        """Remove the least recently used spectra until the size of the
+        cache does not exceed `max_size` (defaults to `self.max_size`)
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return
+        flist = self.files()
+        total = sum([fsize for mtime, fsize, path in flist])
+        for mtime, fsize, path in flist:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            total -= fsize
+        self._size = total
+
+    def purge(self):
+        """Remove all spectra from the cache
+        """
+        self.evict(0)
+
+
+def _spectrum_cache(kwargs):
+    """Return the spectrum cache if one is to be used
+
+    `kwargs['spectrum_cache']` may be a :class:`SpectrumCache` or the
+    directory of the cache whose size is then limited to
+    `kwargs['spectrum_cache_size']` bytes. The cache requires the seed IDs of
+    the traces in `kwargs['trace_ids']`.
+    """
+    if not ('spectrum_cache' in kwargs.keys() and
+            'trace_ids' in kwargs.keys()):
+        return None
+    cache = kwargs['spectrum_cache']
+    if cache is None or isinstance(cache,SpectrumCache):
+        return cache
+    max_size = None
+    if 'spectrum_cache_size' in kwargs.keys():
+        max_size = kwargs['spectrum_cache_size']
+    # keep the cache object between calls such that its size is tracked
+    if (cache,max_size) not in _spectrum_caches:
+        _spectrum_caches[(cache,max_size)] = SpectrumCache(cache,max_size)
+    return _spectrum_caches[(cache,max_size)]
 
-    ######################################
-    ## time domain pre-processing
-    params = {}
-    for key in kwargs.keys():
-        if not 'Processing' in key:
-            params.update({key:kwargs[key]})
-    for proc in kwargs['TDpreProcessing']:
-        A[:,ind] = proc['function'](A[:,ind],proc['args'],params)
-    # zero-padding
-    A = zeroPadding(A,{'type':'avoidWrapPowerTwo'},params)
 
-    ######################################
-    ## FFT
-    # Allocate space for rfft of data
-    zmsize = A.shape
-    fftsize = zmsize[0]//2+1
-    B = np.zeros((fftsize,ntrc),dtype=complex)
+_spectrum_caches = {}
 
-    B[:,ind] = np.fft.rfft(A[:,ind],axis=0)
-    freqs = rfftfreq(zmsize[0],1./kwargs['sampling_rate'])
 
-    ######################################
-    ## frequency domain pre-processing
-    params.update({'freqs':freqs})
-    for proc in kwargs['FDpreProcessing']:
-        B[:,ind] = proc['function'](B[:,ind],proc['args'],params)
+def _shared_memory(comm,kwargs):
+    """Return the shared memory of the node if it is to be used
+
+    Shared memory is used for the spectra of the `replicate` distribution if
+    `kwargs['shared_memory']` is True and more than one process is running.
+    """
+    if not ('shared_memory' in kwargs.keys() and kwargs['shared_memory']):
+        return None
+    if comm.Get_size() == 1 or _distribution(kwargs) != 'replicate':
+        return None
+    return NodeSharedMemory(comm)
+
 
-    ######################################
-    ## collect results
-    comm.barrier()
-    comm.Allreduce(MPI.IN_PLACE,[B,MPI.DOUBLE],op=MPI.SUM)
 
-    t1 = MPI.Wtime()
+def pxcorr_write(comm,A,st,**kwargs):
+    """ A is an array with time along going the first dimension.
+
+    If `kwargs['trace_map']` is given `A` only contains the traces mapped to
+    this rank.
+    """
+    global zerotime
+
+    executor = get_executor(kwargs)
+    fft = get_fft(kwargs)
+    shm = _shared_memory(comm,kwargs)
+    counter = _work_counter(comm,kwargs)
+    timings = {'start':time.time()}
+
+    ######################################
+    ## pre-processing, FFT and distribution of spectra
+    B, freqs, ind, lcombis, lreltime = _pxcorr_spectra(comm,A,kwargs,
+                                                       executor,shm,fft)
+    timings['spectra'] = time.time()
 
     ######################################
     ## correlation
-    csize = len(kwargs['combinations'])
-    irfftsize = (fftsize-1)*2
+    combis = np.array(kwargs['combinations'],dtype=int).reshape(-1,2)
     sampleToSave = int(np.ceil(kwargs['lengthToSave'] *
                                kwargs['sampling_rate']))
-    C = np.zeros((sampleToSave*2+1,csize),dtype=np.float64)
-
-    center = irfftsize // 2
-
-    pmap = (np.arange(csize)*psize)/csize
-    ind = pmap == rank
-    ind = np.arange(csize)[ind]
-    for ii in ind:
-        #print rank, ii, kwargs['combinations'][ii]
-        # offset of starttimes in samples(just remove fractions of samples)
-        offset = (kwargs['starttime'][kwargs['combinations'][ii][0]] -
-                  kwargs['starttime'][kwargs['combinations'][ii][1]])
-        if kwargs['center_correlation']:
-            roffset = 0.
-        else:
-            # offset exceeding a fraction of integer
-            roffset = np.fix(offset * kwargs['sampling_rate']) / kwargs['sampling_rate']
-        # faction of samples to be compenasated by shifting
-        offset -= roffset
-        # normalization factor of fft correlation
-        if kwargs['normalize_correlation']:
-            norm = (np.sqrt(2.*np.sum(B[:,kwargs['combinations'][ii][0]] *
-                                      B[:,kwargs['combinations'][ii][0]].conj()) -
-                                      B[0,kwargs['combinations'][ii][0]]**2) *
-                    np.sqrt(2.*np.sum(B[:,kwargs['combinations'][ii][1]] *
-                                      B[:,kwargs['combinations'][ii][1]].conj()) -
-                                      B[0,kwargs['combinations'][ii][1]]**2) /
-                    irfftsize).real
-        else:
-            norm = 1.
-        M = (B[:,kwargs['combinations'][ii][0]].conj() *
-                               B[:,kwargs['combinations'][ii][1]] *
-                               np.exp(1j * freqs * offset * 2 * np.pi))
-                               #np.exp(-1j * freqs/kwargs['sampling_rate'] * offset/kwargs['sampling_rate'] * 2 * np.pi))
-
-        tmp = np.fft.irfft(M,axis=0).real
-        # cut the center and do fftshift
-        out = np.concatenate((tmp[-sampleToSave:],tmp[:sampleToSave+1]))/norm
-        starttime = zerotime -sampleToSave/kwargs['sampling_rate'] - roffset
-
-
-        # put trace into a stream
-        cst = stream.Stream()
-        cstats = combine_stats(st[kwargs['combinations'][ii][0]],
-                               st[kwargs['combinations'][ii][1]])
-        cstats['starttime'] = starttime
-        cstats['npts'] = len(out)
-        cst.append(trace.Trace(data=out, header=cstats))
-        cst[0].stats_tr1 = st[kwargs['combinations'][ii][0]].stats
-        cst[0].stats_tr2 = st[kwargs['combinations'][ii][1]].stats
-        if kwargs['direct_output']['function'] == 'convert_to_matlab':
-            convert_to_matlab(cst,kwargs['direct_output']['base_name'],
-                              kwargs['direct_output']['base_dir'])
+
+    # per trace energy
+    energy = _trace_energy(B,np.unique(lcombis))
+    band = _fd_band(kwargs['FDpreProcessing'],freqs)
+    blocks = _scheduled_blocks(lcombis,B.shape[0],kwargs)
+    results = _map_blocks(executor,lambda bpos: _pxcorr_block(B,energy,
+                                lcombis[bpos],lreltime,sampleToSave,kwargs,
+                                fft,band),
+                          blocks,counter)
+    ndone = 0
+    for bpos, (C, starttimes) in results:
+        ndone += len(bpos)
+        for jj, ii in enumerate(ind[bpos]):
+            # put trace into a stream
+            cst = stream.Stream()
+            cstats = combine_stats(st[combis[ii,0]],st[combis[ii,1]])
+            cstats['starttime'] = starttimes[jj]
+            cstats['npts'] = C.shape[0]
+            cst.append(trace.Trace(data=C[:,jj], header=cstats))
+            cst[0].stats_tr1 = st[combis[ii,0]].stats
+            cst[0].stats_tr2 = st[combis[ii,1]].stats
+            if kwargs['direct_output']['function'] == 'convert_to_matlab':
+                convert_to_matlab(cst,kwargs['direct_output']['base_name'],
+                                  kwargs['direct_output']['base_dir'])
+    _close_executor(executor,kwargs)
+    timings['correlation'] = time.time()
+    _timing_report(comm,timings,ndone,kwargs)
+    if counter is not None:
+        counter.free()
+    if shm is not None:
+        shm.free()
     return 0
 
 
 def pxcorr(comm,A,**kwargs):
     """ A is an array with time along going the first dimension.
+
+    If `kwargs['trace_map']` is given `A` only contains the traces mapped to
+    this rank. With `kwargs['distribution'] == 'grid'` the correlations are only
+    gathered on rank 0. All other ranks return (None, None). With
+    `kwargs['schedule'] == 'dynamic'` the blocks of combinations are claimed
+    by the processes while they work (see :class:`WorkCounter`).
     """
     global zerotime    
     
-    t0 = MPI.Wtime()
-    msize = A.shape
-    ntrc = msize[1]
-    
     psize = comm.Get_size()
-    rank = comm.Get_rank()
-    # time domain processing
-    # map of traces on precesses
-    pmap = (np.arange(ntrc)*psize)/ntrc
-    
-    # indecies for traces to be worked on by each process
-    ind = pmap == rank
-    
-    ######################################
-    ## time domain pre-processing
-    params = {}
-    for key in kwargs.keys():
-        if not 'Processing' in key:
-            params.update({key:kwargs[key]})
-    for proc in kwargs['TDpreProcessing']:
-        A[:,ind] = proc['function'](A[:,ind],proc['args'],params)
-    # zero-padding
-    A = zeroPadding(A,{'type':'avoidWrapPowerTwo'},params)
+    executor = get_executor(kwargs)
+    fft = get_fft(kwargs)
+    shm = _shared_memory(comm,kwargs)
+    counter = _work_counter(comm,kwargs)
+    timings = {'start':time.time()}
 
     ######################################
-    ## FFT        
-    # Allocate space for rfft of data
-    zmsize = A.shape
-    fftsize = zmsize[0]//2+1
-    B = np.zeros((fftsize,ntrc),dtype=complex)
-    
-    B[:,ind] = np.fft.rfft(A[:,ind],axis=0)
-    freqs = rfftfreq(zmsize[0],1./kwargs['sampling_rate'])
-    
-    ######################################
-    ## frequency domain pre-processing
-    params.update({'freqs':freqs})
-    for proc in kwargs['FDpreProcessing']:
-        B[:,ind] = proc['function'](B[:,ind],proc['args'],params)
-        
-    ######################################
-    ## collect results
-    comm.barrier()
-    comm.Allreduce(MPI.IN_PLACE,[B,MPI.DOUBLE],op=MPI.SUM)
-    
-    t1 = MPI.Wtime()
+    ## pre-processing, FFT and distribution of spectra
+    B, freqs, ind, lcombis, lreltime = _pxcorr_spectra(comm,A,kwargs,
+                                                       executor,shm,fft)
+    timings['spectra'] = time.time()
 
     ######################################
     ## correlation        
     csize = len(kwargs['combinations'])
-    irfftsize = (fftsize-1)*2
     sampleToSave = int(np.ceil(kwargs['lengthToSave'] *
                                kwargs['sampling_rate']))
-    C = np.zeros((sampleToSave*2+1,csize),dtype=np.float64)
-
-    center = irfftsize // 2
-
-    pmap = (np.arange(csize)*psize)/csize
-    ind = pmap == rank
-    ind = np.arange(csize)[ind]
-    starttimes = np.zeros(csize,dtype=np.float64)
-    for ii in ind:
-        #print rank, ii, kwargs['combinations'][ii]
-        # offset of starttimes in samples(just remove fractions of samples)
-        offset = (kwargs['starttime'][kwargs['combinations'][ii][0]] -
-                  kwargs['starttime'][kwargs['combinations'][ii][1]])
-        if kwargs['center_correlation']:
-            roffset = 0.
-        else:
-            # offset exceeding a fraction of integer
-            roffset = np.fix(offset * kwargs['sampling_rate']) / kwargs['sampling_rate']
-        # faction of samples to be compenasated by shifting 
-        offset -= roffset
-        # normalization factor of fft correlation
-        if kwargs['normalize_correlation']:
-            norm = (np.sqrt(2.*np.sum(B[:,kwargs['combinations'][ii][0]] * 
-                                      B[:,kwargs['combinations'][ii][0]].conj()) -
-                                      B[0,kwargs['combinations'][ii][0]]**2) *
-                    np.sqrt(2.*np.sum(B[:,kwargs['combinations'][ii][1]] * 
-                                      B[:,kwargs['combinations'][ii][1]].conj()) -
-                                      B[0,kwargs['combinations'][ii][1]]**2) /
-                    irfftsize).real
-        else:
-            norm = 1.
-        M = (B[:,kwargs['combinations'][ii][0]].conj() * 
-                               B[:,kwargs['combinations'][ii][1]] * 
-                               np.exp(1j * freqs * offset * 2 * np.pi))
-                               #np.exp(-1j * freqs/kwargs['sampling_rate'] * offset/kwargs['sampling_rate'] * 2 * np.pi))
-        ######################################
-        ## frequency domain postProcessing
-        #
-        
-        tmp = np.fft.irfft(M,axis=0).real
-        # cut the center and do fftshift
-        C[:,ii] = np.concatenate((tmp[-sampleToSave:],tmp[:sampleToSave+1]))/norm
-        starttimes[ii] = zerotime -sampleToSave/kwargs['sampling_rate'] - roffset
+    dtype = _dtype(kwargs)
+    C = np.zeros((sampleToSave*2+1,len(ind)),dtype=dtype)
+    starttimes = np.zeros(len(ind),dtype=np.float64)
+
+    # per trace energy
+    energy = _trace_energy(B,np.unique(lcombis))
+    band = _fd_band(kwargs['FDpreProcessing'],freqs)
+    blocks = _scheduled_blocks(lcombis,B.shape[0],kwargs)
+    results = _map_blocks(executor,lambda bpos: _pxcorr_block(B,energy,
+                                lcombis[bpos],lreltime,sampleToSave,kwargs,
+                                fft,band),
+                          blocks,counter)
+    ndone = 0
+    for bpos, (tC, tstarttimes) in results:
+        C[:,bpos] = tC
+        starttimes[bpos] = tstarttimes
+        ndone += len(bpos)
+    _close_executor(executor,kwargs)
+    timings['correlation'] = time.time()
+    _timing_report(comm,timings,ndone,kwargs)
+    if counter is not None:
+        counter.free()
+    if shm is not None:
+        shm.free()
 
     ######################################
     ## time domain postProcessing
 
     ######################################
     ## collect results 
+    if psize == 1:
+        return (C,starttimes)
+    comm.barrier()
+    if _distribution(kwargs) == 'grid':
+        return _gather_correlations(comm,C,starttimes,ind,csize)
+    tC = np.zeros((sampleToSave*2+1,csize),dtype=dtype)
+    tC[:,ind] = C
+    tstarttimes = np.zeros(csize,dtype=np.float64)
+    tstarttimes[ind] = starttimes
+    comm.Allreduce(MPI.IN_PLACE,[tC,_mpi_type(dtype)],op=MPI.SUM)
+    comm.Allreduce(MPI.IN_PLACE,[tstarttimes,MPI.DOUBLE],op=MPI.SUM)
+    return (tC,tstarttimes)
+
+
+def _distribution(kwargs):
+    """Return the way spectra and combinations are distributed on processes
+    """
+    if 'distribution' in kwargs.keys():
+        if kwargs['distribution'] not in ['replicate', 'grid']:
+            raise ValueError("distribution '%s' not implemented" %
+                             kwargs['distribution'])
+        return kwargs['distribution']
+    return 'replicate'
+
+
+def _schedule(kwargs):
+    """Return the way combinations are scheduled on the processes
+
+    The `dynamic` schedule requires all spectra on every process and is
+    therefore only used with the `replicate` distribution.
+    """
+    if 'schedule' in kwargs.keys():
+        if kwargs['schedule'] not in ['static', 'dynamic']:
+            raise ValueError("schedule '%s' not implemented" %
+                             kwargs['schedule'])
+        if _distribution(kwargs) == 'replicate':
+            return kwargs['schedule']
+    return 'static'
+
+
+def _work_counter(comm,kwargs):
+    """Return the counter of the dynamic schedule or None
+    """
+    if _schedule(kwargs) != 'dynamic':
+        return None
+    return WorkCounter(comm)
+
+
+def _joint_norm(kwargs):
+    """Test whether joint normalization per station is required
+    """
+    for proc in kwargs['FDpreProcessing']:
+        if proc['function'] == spectralWhitening:
+            if 'joint_norm' in proc['args']:
+                if proc['args']['joint_norm']:
+                    return True
+    return False
+
+
+def _dtype(kwargs):
+    """Return the real data type of the data, spectra and correlations
+
+    `kwargs['dtype']` may be `float64` (default) or `float32`.
+    """
+    if 'dtype' in kwargs.keys():
+        dtype = np.dtype(kwargs['dtype'])
+        if dtype not in [np.float32, np.float64]:
+            raise ValueError("dtype '%s' not implemented" % kwargs['dtype'])
+        return dtype
+    return np.dtype(np.float64)
+
+
+def _complex_dtype(dtype):
+    """Return the complex data type matching the real type `dtype`
+    """
+    return np.result_type(dtype,np.complex64)
+
+
+def _real_dtype(dtype):
+    """Return the real data type matching the (complex) type `dtype`
+    """
+    return np.zeros(0,dtype=dtype).real.dtype
+
+
+def _mpi_type(dtype):
+    """Return the MPI data type of the numpy type `dtype`
+    """
+    return {'float32':MPI.FLOAT,
+            'float64':MPI.DOUBLE,
+            'complex64':MPI.COMPLEX,
+            'complex128':MPI.DOUBLE_COMPLEX}[np.dtype(dtype).name]
+
+
+def _padding(kwargs):
+    """Return the type of zero padding applied before the FFT
+    """
+    if 'padding' in kwargs.keys():
+        return kwargs['padding']
+    return 'avoidWrapPowerTwo'
+
+
+def _lag_transform(kwargs):
+    """Return the method to transform the cross-spectra to the saved lags
+    """
+    if 'lag_transform' in kwargs.keys():
+        assert kwargs['lag_transform'] in ['fft','zoom','auto'], \
+            "lag_transform must be 'fft', 'zoom' or 'auto': %s" % \
+            kwargs['lag_transform']
+        return kwargs['lag_transform']
+    return 'fft'
+
+
+def _process_grid(psize):
+    """Arrange `psize` processes in a grid that is as square as possible
+
+    :rtype: tuple
+    :return: number of rows and columns of the grid
+    """
+    nrow = int(np.floor(np.sqrt(psize)))
+    while psize % nrow:
+        nrow -= 1
+    return nrow, psize//nrow
+
+
+def _trace_map(ntrc,psize,kwargs):
+    """Map of traces on processes
+
+    Return the rank of the process that does the pre-processing of each
+    trace. For joint normalization all channels of a station must go to the
+    same rank. In the `replicate` distribution contiguous sets of traces are
+    assigned to the processes. For the `grid` distribution they are
+    distributed cyclically (station wise for joint normalization) to balance
+    the number of traces in the rows and columns of the process grid.
+    """
+    if _joint_norm(kwargs):
+        assert ntrc % 3 == 0, "for joint normalization in spectralWhitening "\
+                      "the number of traces needs to the multiple of 3: %d" % ntrc
+        group = 3
+    else:
+        group = 1
+    Nst = ntrc//group
+    if _distribution(kwargs) == 'grid':
+        return (np.arange(ntrc)//group) % psize
+    return ((np.arange(ntrc)//group)*np.min((psize,Nst)))//Nst
+
+
+def _pxcorr_spectra(comm,A,kwargs,executor,shm=None,fft=None):
+    """Pre-process and Fourier transform the traces and distribute the spectra
+
+    Every process works on the traces assigned to it by :func:`_trace_map`.
+    The spectra are then distributed according to `kwargs['distribution']`:
+
+        -`replicate`: every process receives the spectra of all traces and
+            works on a contiguous set of combinations. With the
+            :class:`NodeSharedMemory` `shm` the spectra are only held once
+            per node and only summed between the nodes.
+        -`grid`: the processes are arranged in a 2D grid. A combination is
+            assigned to the process in the row of the process of its first
+            trace and the column of the process of its second trace. A
+            process only receives the spectra of the traces pre-processed in
+            its grid row and grid column such that the memory per process
+            scales with the number of traces divided by the square root of
+            the number of processes.
+
+    Within a process the pre-processing is done in chunks of traces that are
+    mapped by the `executor`. Spectra found in the :class:`SpectrumCache`
+    `kwargs['spectrum_cache']` are not processed again. The traces are padded according to
+    `kwargs['padding']` (see :func:`zeroPadding`, defaults to
+    `avoidWrapPowerTwo`) and transformed with the backend `fft` (see
+    :func:`get_fft`).
+
+    :rtype: tuple
+    :return: spectra `B` (frequency along the first dimension), their
+        frequencies, indices of the combinations this process works on,
+        their indices of the columns in `B` and the start times of the
+        traces in `B` relative to the first trace
+    """
+    ntrc = len(kwargs['starttime'])
+    psize = comm.Get_size()
+    rank = comm.Get_rank()
+    # time domain processing
+    # map of traces on precesses
+    if 'trace_map' in kwargs.keys():
+        # A only contains the traces of this process
+        pmap = np.asarray(kwargs['trace_map'])
+        ind = pmap == rank
+    else:
+        pmap = _trace_map(ntrc,psize,kwargs)
+        # indecies for traces to be worked on by each process
+        ind = pmap == rank
+        A = A[:,ind]
+
+    if fft is None:
+        fft = NumpyFFT()
+    dtype = _dtype(kwargs)
+    cdtype = _complex_dtype(dtype)
+    params = {}
+    for key in kwargs.keys():
+        if not 'Processing' in key:
+            params.update({key:kwargs[key]})
+    # frequencies of the spectra depend on the length of the padded traces
+    padding = {'type':_padding(kwargs)}
+    npad = zeroPadding(np.zeros((A.shape[0],0)),padding,params).shape[0]
+    fftsize = npad//2+1
+    freqs = rfftfreq(npad,1./kwargs['sampling_rate'])
+    params.update({'freqs':freqs})
+
+    def _process(cols):
+        tA = np.asarray(A[:,cols],dtype=dtype)
+        ######################################
+        ## time domain pre-processing
+        for proc in kwargs['TDpreProcessing']:
+            tA = proc['function'](tA,proc['args'],params)
+        # zero-padding
+        tA = zeroPadding(tA.astype(dtype,copy=False),padding,params)
+
+        ######################################
+        ## FFT
+        tB = fft.rfft(tA).astype(cdtype,copy=False)
+
+        ######################################
+        ## frequency domain pre-processing
+        tB = _fd_process(tB,kwargs['FDpreProcessing'],params)
+        return tB.astype(cdtype,copy=False)
+
+    cache = _spectrum_cache(kwargs)
+    if cache is None:
+        chunks = _trace_chunks(A.shape[1],executor.size,kwargs)
+        tB = np.concatenate(list(executor.imap(_process,chunks)),axis=1)
+    else:
+        tB = _cached_spectra(cache,_process,np.where(ind)[0],A.shape[0],npad,
+                             cdtype,kwargs,executor)
+    # start time phase ramp of the traces on this process
+    combis = np.array(kwargs['combinations'],dtype=int).reshape(-1,2)
+    csize = len(combis)
+    reltime = _relative_starttimes(kwargs['starttime'])
+    _phase_ramp(tB,freqs,reltime[ind])
+
+    ######################################
+    ## distribute spectra
+    if psize == 1:
+        return tB, freqs, np.arange(csize), combis, reltime
+    comm.barrier()
+    if _distribution(kwargs) == 'grid':
+        nrow, ncol = _process_grid(psize)
+        prow = pmap//ncol
+        pcol = pmap%ncol
+        myrow = rank//ncol
+        mycol = rank%ncol
+        # spectra of the traces in this row followed by those in this column
+        rtrc = np.concatenate([np.where(pmap == myrow*ncol+cc)[0]
+                               for cc in range(ncol)])
+        ctrc = np.concatenate([np.where(pmap == rr*ncol+mycol)[0]
+                               for rr in range(nrow)])
+        T = np.zeros((len(rtrc)+len(ctrc),fftsize),dtype=cdtype)
+        sendbuf = np.ascontiguousarray(tB.T)
+        rowcomm = comm.Split(myrow,mycol)
+        counts = np.array([np.sum(pmap == myrow*ncol+cc)
+                           for cc in range(ncol)])*fftsize
+        rowcomm.Allgatherv([sendbuf,_mpi_type(cdtype)],
+                           [T[:len(rtrc)],(counts,None),_mpi_type(cdtype)])
+        rowcomm.Free()
+        colcomm = comm.Split(mycol,myrow)
+        counts = np.array([np.sum(pmap == rr*ncol+mycol)
+                           for rr in range(nrow)])*fftsize
+        colcomm.Allgatherv([sendbuf,_mpi_type(cdtype)],
+                           [T[len(rtrc):],(counts,None),_mpi_type(cdtype)])
+        colcomm.Free()
+        B = T.T
+        # combinations of first traces in this row and second traces in
+        # this column
+        cind = np.where((prow[combis[:,0]] == myrow) &
+                        (pcol[combis[:,1]] == mycol))[0]
+        rpos = np.zeros(ntrc,dtype=int)
+        rpos[rtrc] = np.arange(len(rtrc))
+        cpos = np.zeros(ntrc,dtype=int)
+        cpos[ctrc] = np.arange(len(ctrc)) + len(rtrc)
+        lcombis = np.zeros((len(cind),2),dtype=int)
+        lcombis[:,0] = rpos[combis[cind,0]]
+        lcombis[:,1] = cpos[combis[cind,1]]
+        lreltime = reltime[np.concatenate((rtrc,ctrc))]
+    elif shm is not None:
+        # every process writes its own columns of the array of the node
+        B = shm.zeros((fftsize,ntrc),dtype=cdtype)
+        B[:,ind] = tB
+        shm.allreduce(B)
+        cind = _combination_indices(combis,psize,rank,kwargs)
+        lcombis = combis[cind]
+        lreltime = reltime
+    else:
+        B = np.zeros((fftsize,ntrc),dtype=cdtype)
+        B[:,ind] = tB
+        comm.Allreduce(MPI.IN_PLACE,[B,_mpi_type(dtype)],op=MPI.SUM)
+        cind = _combination_indices(combis,psize,rank,kwargs)
+        lcombis = combis[cind]
+        lreltime = reltime
+    return B, freqs, cind, lcombis, lreltime
+
+
+def _cached_spectra(cache,process,gind,npts,npad,cdtype,kwargs,executor):
+    """Take the spectra of the local traces from the cache where possible
+
+    The spectra of the traces that are not found in `cache` are calculated
+    with `process` (mapping indices of local columns to their spectra) and
+    stored in the cache. For joint normalization all channels of a station
+    are processed if one of them is missing.
+
+    :type gind: numpy.ndarray
+    :param gind: indices of the local traces in the stream
+    :type npts: int
+    :param npts: number of samples of the local traces before padding
+
+    :rtype: numpy.ndarray
+    :return: spectra of the local traces
+    """
+    recipe = _recipe_hash(kwargs,npad,cdtype)
+    keys = [cache.key(kwargs['trace_ids'][tt],kwargs['starttime'][tt],
+                      kwargs['sampling_rate'],npts,recipe) for tt in gind]
+    tB = np.zeros((npad//2+1,len(gind)),dtype=cdtype)
+    missing = []
+    for jj, key in enumerate(keys):
+        spec = cache.get(key)
+        if (spec is None) or (spec.shape != tB.shape[:1]):
+            missing.append(jj)
+        else:
+            tB[:,jj] = spec
+    missing = np.array(missing,dtype=int)
+    if _joint_norm(kwargs) and (len(missing) > 0):
+        missing = np.unique(((missing//3)*3)[:,None] + np.arange(3))
+    if len(missing) > 0:
+        chunks = [missing[chunk] for chunk in
+                  _trace_chunks(len(missing),executor.size,kwargs)]
+        for chunk, cB in izip(chunks,executor.imap(process,chunks)):
+            tB[:,chunk] = cB
+            for jj, col in enumerate(chunk):
+                cache.put(keys[col],cB[:,jj])
+    return tB
+
+
+def _recipe_hash(kwargs,npad,dtype):
+    """Hash of the processing that determines the spectrum of a trace
+    """
+    recipe = [_canonical(kwargs['TDpreProcessing']),
+              _canonical(kwargs['FDpreProcessing']),
+              int(npad),np.dtype(dtype).name]
+    return hashlib.sha1(repr(recipe).encode('utf-8')).hexdigest()
+
+
+def _canonical(obj):
+    """Representation of a processing recipe that does not depend on the
+    order of dictionary keys or the identity of functions
+    """
+    if isinstance(obj,dict):
+        return sorted([(key,_canonical(val)) for key, val in obj.items()])
+    elif isinstance(obj,(list,tuple)):
+        return [_canonical(val) for val in obj]
+    elif isinstance(obj,np.ndarray):
+        return obj.tolist()
+    elif callable(obj):
+        return '%s.%s' % (obj.__module__,obj.__name__)
+    return obj
+
+
+def _trace_chunks(ntrc,nchunks,kwargs):
+    """Split the columns of the local data matrix into `nchunks` chunks
+
+    For joint normalization the chunks contain complete stations. At least
+    one (possibly empty) chunk is returned.
+    """
+    if _joint_norm(kwargs):
+        group = 3
+    else:
+        group = 1
+    bounds = ((np.arange(nchunks+1)*(ntrc//group))//nchunks)*group
+    bounds[-1] = ntrc
+    chunks = [np.arange(bounds[ii],bounds[ii+1]) for ii in range(nchunks)]
+    return [chunk for chunk in chunks if len(chunk) > 0] or [chunks[0]]
+
+
+def _local_trace_matrix(st,comm,kwargs):
+    """Fill a matrix with the data of the traces pre-processed on this rank
+
+    Only the columns of the traces that are mapped to this rank by
+    :func:`_trace_map` are materialized. The traces are not scattered: the
+    whole stream `st` must be present on every rank (e.g. gathered by
+    :func:`allgather_stream`), so the raw data are still held once per rank
+    as obspy traces. Only the duplicated data matrix and its broadcast are
+    avoided.
+
+    :rtype: tuple
+    :return: data matrix with time along the first dimension and the map of
+        all traces on the processes
+    """
+    pmap = _trace_map(len(st),comm.Get_size(),kwargs)
+    ind = np.where(pmap == comm.Get_rank())[0]
+    npts = 0
+    for tr in st:
+        npts = max(npts,tr.stats['npts'])
+    A = np.zeros([npts,len(ind)],dtype=_dtype(kwargs))
+    for ii, tind in enumerate(ind):
+        A[0:st[tind].stats['npts'],ii] = st[tind].data
+    return A, pmap
+
+
+def _gather_correlations(comm,C,starttimes,ind,csize):
+    """Gather correlations computed on different processes on rank 0
+
+    :rtype: tuple
+    :return: correlations and start times of all combinations on rank 0 and
+        (None, None) on all other ranks
+    """
+    rank = comm.Get_rank()
+    nlag = C.shape[0]
+    counts = np.array(comm.gather(len(ind),root=0))
+    allind = comm.gather(ind,root=0)
+    sendbuf = np.ascontiguousarray(C.T)
+    ctype = _mpi_type(C.dtype)
+    if rank == 0:
+        recvbuf = np.zeros((csize,nlag),dtype=C.dtype)
+        rstarttimes = np.zeros(csize,dtype=np.float64)
+        comm.Gatherv([sendbuf,ctype],
+                     [recvbuf,(counts*nlag,None),ctype],root=0)
+        comm.Gatherv([starttimes,MPI.DOUBLE],
+                     [rstarttimes,(counts,None),MPI.DOUBLE],root=0)
+        order = np.concatenate(allind).astype(int)
+        tC = np.zeros((nlag,csize),dtype=C.dtype)
+        tC[:,order] = recvbuf.T
+        tstarttimes = np.zeros(csize,dtype=np.float64)
+        tstarttimes[order] = rstarttimes
+        return (tC,tstarttimes)
+    comm.Gatherv([sendbuf,ctype],None,root=0)
+    comm.Gatherv([starttimes,MPI.DOUBLE],None,root=0)
+    return (None,None)
+
+
+def _relative_starttimes(starttime):
+    """Start times of the traces in seconds relative to the first one
+
+    Differences of `UTCDateTime` objects are exact whereas differences of
+    their float representations lose precision. Offsets between traces are
+    therefore calculated from these relative times.
+    """
+    return np.array([tt - starttime[0] for tt in starttime],dtype=np.float64)
+
+
+def _combination_blocks(ind,fftsize,kwargs):
+    """Split the combination indices `ind` into blocks
+
+    The size of the blocks is taken from `kwargs['block_size']` if present.
+    Otherwise it is chosen such that the cross-spectra of one block occupy
+    about 64 MB.
+    """
+    if 'block_size' in kwargs.keys():
+        bsize = int(kwargs['block_size'])
+    else:
+        bsize = int(2**26/(16*fftsize))
+    bsize = max(bsize,1)
+    return [ind[ii:ii+bsize] for ii in range(0,len(ind),bsize)]
+
+
+def _combination_cost(combis):
+    """Estimated relative cost of correlating the combinations `combis`
+
+    Auto-correlations only need half of the work of a cross-correlation
+    (see :func:`_autocorr_block`). All other combinations cost the same: the
+    traces are packed to a common length and their spectra share one FFT
+    length and band, so the overlap of the traces does not change the work,
+    and the normalization is part of the pre-processing of the traces, not
+    of the combinations.
+    """
+    return np.where(combis[:,0] == combis[:,1],0.5,1.)
+
+
+def _combination_indices(combis,psize,rank,kwargs):
+    """Indices of the combinations correlated by process `rank`
+
+    With the `static` schedule the combinations are split into contiguous
+    parts of equal estimated cost (see :func:`_combination_cost`). With the
+    `dynamic` schedule every process may correlate any combination.
+    """
+    if _schedule(kwargs) == 'dynamic':
+        return np.arange(len(combis))
+    cost = _combination_cost(combis)
+    # process of the center of every combination on the cumulated cost
+    center = np.cumsum(cost) - cost/2.
+    cmap = np.floor(center*psize/max(np.sum(cost),1.)).astype(int)
+    return np.where(cmap == rank)[0]
+
+
+def _scheduled_blocks(combis,fftsize,kwargs):
+    """Split the local combinations `combis` into blocks
+
+    Blocks of cross-correlations come first and those of auto-correlations
+    last, such that a dynamic schedule hands out the most expensive work
+    first. The blocks contain the positions of the combinations in `combis`.
+    """
+    pos = np.arange(len(combis))
+    auto = combis[:,0] == combis[:,1]
+    return (_combination_blocks(pos[~auto],fftsize,kwargs) +
+            _combination_blocks(pos[auto],fftsize,kwargs))
+
+
+def _map_blocks(executor,func,blocks,counter=None):
+    """Map `func` on blocks of combinations
+
+    Without `counter` all `blocks` are mapped with the `executor`. Otherwise
+    the process claims as many blocks from the :class:`WorkCounter` as the
+    executor has workers whenever it finished its previous ones.
+
+    :rtype: generator
+    :return: tuples of the block and the result of `func`
+    """
+    if counter is None:
+        for bpos, result in izip(blocks,executor.imap(func,blocks)):
+            yield bpos, result
+        return
+    while True:
+        start = counter.claim(executor.size)
+        wave = blocks[start:start+executor.size]
+        if len(wave) == 0:
+            break
+        for bpos, result in izip(wave,executor.imap(func,wave)):
+            yield bpos, result
+
+
+def _timing_report(comm,timings,ndone,kwargs):
+    """Print the time spent by every process if `kwargs['timing']` is True
+
+    The time for pre-processing and distribution of the spectra, for the
+    correlation and for waiting on the slowest process is gathered on rank 0
+    together with the number of correlated combinations.
+    """
+    if not ('timing' in kwargs.keys() and kwargs['timing']):
+        return
+    wait = time.time()
     comm.barrier()
-    comm.Allreduce(MPI.IN_PLACE,[C,MPI.DOUBLE],op=MPI.SUM)
-    comm.Allreduce(MPI.IN_PLACE,[starttimes,MPI.DOUBLE],op=MPI.SUM)
-    #print 'werqwer'
-    return (C,starttimes)
+    report = (comm.Get_rank(),timings['spectra']-timings['start'],
+              timings['correlation']-timings['spectra'],time.time()-wait,
+              ndone)
+    reports = comm.gather(report,root=0)
+    if comm.Get_rank() != 0:
+        return
+    for rep in reports:
+        print ('rank %d: spectra %.2f s, correlation %.2f s, wait %.2f s, '
+               '%d combinations' % rep)
+    total = np.array([rep[1]+rep[2] for rep in reports])
+    print ('busy time: mean %.2f s, max %.2f s' % (np.mean(total),
+                                                   np.max(total)))
+
+
+def _phase_ramp(B,freqs,reltime):
+    """Factor the start times of the traces into their spectra
+
+    The start time of every trace is factored into its spectrum by
+    multiplication with the phase ramp `exp(-i w t)`. The product of the
+    conjugate spectrum of one trace with the spectrum of another one then
+    already contains the compensation of their offset and a pair needs no
+    further transcendental work. This is done in place by the process that
+    pre-processes the traces. Zero start times are skipped.
+
+    :type B: numpy.ndarray
+    :param B: spectra of the traces with frequency along the first dimension
+    :type freqs: numpy.ndarray
+    :param freqs: frequencies of the samples in `B`
+    :type reltime: numpy.ndarray
+    :param reltime: start times of the traces in `B` relative to the first
+        trace
+    """
+    shifted = np.where(reltime != 0.)[0]
+    if len(shifted) > 0:
+        B[:,shifted] *= np.exp(-2j * np.pi * np.outer(freqs,reltime[shifted]))
+    return B
+
+
+def _trace_energy(B,cols):
+    """Square root of the energy of the traces
+
+    Calculate the normalization of the correlation once per trace for the
+    columns `cols` of `B`.
+
+    :rtype: numpy.ndarray
+    :return: square root of the energy of the traces as used for the
+        normalization of the correlation (zero for unused columns)
+    """
+    energy = np.zeros(B.shape[1],dtype=np.float64)
+    if len(cols) == 0:
+        return energy
+    energy[cols] = np.sqrt((2.*np.sum(np.absolute(B[:,cols])**2,axis=0) -
+                            B[0,cols]**2).real)
+    return energy
+
+
+def _pxcorr_block(B,energy,combis,reltime,sampleToSave,kwargs,fft=None,
+                  band=None):
+    """Correlate a block of trace combinations
+
+    The cross-spectra of all combinations in `combis` (array of shape
+    (n,2) with indices of the columns in `B`) are calculated in a single
+    vectorized operation and transformed back to time domain by one
+    multi-column inverse FFT. The saved lag window is cut out for all
+    combinations at once. `B` and `energy` must have been prepared with
+    :func:`_phase_ramp` and :func:`_trace_energy` such that the sub-sample
+    offset of the traces
+    is already compensated. The integer part of the offset that is not
+    compensated when `center_correlation` is False is applied as a shift
+    of the lag indices.
+
+    :type B: numpy.ndarray
+    :param B: spectra of the traces with frequency along the first dimension
+    :type energy: numpy.ndarray
+    :param energy: square root of the energy of the traces in `B`
+    :type combis: numpy.ndarray
+    :param combis: indices of the combined traces
+    :type reltime: numpy.ndarray
+    :param reltime: start times of the traces relative to the first one
+    :type sampleToSave: int
+    :param sampleToSave: number of samples to save on either side of zero lag
+    :type kwargs: dictionary
+    :param kwargs: options as passed to `pxcorr`
+    :type fft: object
+    :param fft: backend for the inverse FFT as returned by :func:`get_fft`
+    :type band: slice
+    :param band: samples of `B` outside of which the spectra are zero (see
+        :func:`_fd_band`). The cross-spectra are only calculated within.
+        With `kwargs['lag_transform']` set to `zoom` (or `auto` if it is
+        cheaper than the FFT) the saved lags are evaluated directly from the
+        band (see :func:`_zoom_matrices`) instead of by a full size inverse
+        FFT.
+
+    :rtype: tuple
+    :return: correlations with lag time along the first dimension and their
+        start times as float timestamps
+    """
+    irfftsize = (B.shape[0]-1)*2
+    # auto-correlations are symmetric and calculated separately
+    auto = combis[:,0] == combis[:,1]
+    if np.any(auto) and sampleToSave < irfftsize//2:
+        if np.all(auto):
+            return _autocorr_block(B,energy,combis[:,0],sampleToSave,kwargs,
+                                   fft,band)
+        C = np.zeros((2*sampleToSave+1,len(combis)),
+                     dtype=_real_dtype(B.dtype))
+        starttimes = np.zeros(len(combis),dtype=np.float64)
+        for sel in [auto,~auto]:
+            C[:,sel], starttimes[sel] = _pxcorr_block(B,energy,combis[sel],
+                                            reltime,sampleToSave,kwargs,fft,
+                                            band)
+        return C, starttimes
+    # offset of starttimes in samples(just remove fractions of samples)
+    offset = reltime[combis[:,0]] - reltime[combis[:,1]]
+    if kwargs['center_correlation']:
+        roffset = np.zeros(len(combis))
+    else:
+        # offset exceeding a fraction of integer
+        roffset = np.fix(offset * kwargs['sampling_rate']) / kwargs['sampling_rate']
+    # normalization factor of fft correlation
+    if kwargs['normalize_correlation']:
+        norm = energy[combis[:,0]] * energy[combis[:,1]] / irfftsize
+    else:
+        norm = np.ones(len(combis))
+    shift = np.round(roffset * kwargs['sampling_rate']).astype(int)
+    dtype = _real_dtype(B.dtype)
+    if _use_zoom(kwargs,band,irfftsize,2*sampleToSave+1,
+                 _zoom_nbytes(band,sampleToSave,dtype)):
+        M = B[band][:,combis[:,0]].conj() * B[band][:,combis[:,1]]
+        if np.any(shift):
+            # undo the compensation of the integer offset by a phase ramp
+            k = np.arange(band.start,band.stop)
+            M *= np.exp(-2j*np.pi*((np.outer(k,shift) % irfftsize) /
+                                   float(irfftsize))).astype(B.dtype)
+        cosm, sinm = _zoom_matrices(irfftsize,band,sampleToSave,dtype)
+        C = cosm.dot(M.real) - sinm.dot(M.imag)
+        C /= norm.astype(dtype,copy=False)
+    else:
+        if band is None:
+            M = B[:,combis[:,0]].conj() * B[:,combis[:,1]]
+        else:
+            M = np.zeros((B.shape[0],len(combis)),dtype=B.dtype)
+            M[band] = B[band][:,combis[:,0]].conj() * B[band][:,combis[:,1]]
+        if fft is None:
+            fft = NumpyFFT()
+        tmp = fft.irfft(M,irfftsize)
+        # cut the center and do fftshift for all combinations at once while
+        # undoing the compensation of the integer offset
+        lags = (np.arange(-sampleToSave,sampleToSave+1)[:,None] -
+                shift[None,:]) % irfftsize
+        C = (tmp[lags,np.arange(len(combis))[None,:]]/norm).astype(dtype,
+                                                                copy=False)
+    # the start time only depends on the integer offset
+    starttimes = np.zeros(len(combis),dtype=np.float64)
+    for ro in np.unique(roffset):
+        starttimes[roffset == ro] = (zerotime - sampleToSave /
+                                     kwargs['sampling_rate'] - ro)
+    return C, starttimes
+
+
+def _autocorr_block(B,energy,cols,sampleToSave,kwargs,fft=None,band=None):
+    """Auto-correlate a block of traces
+
+    The auto-correlations of the columns `cols` of `B` are calculated from
+    the real power spectra. As they are symmetric only the positive lags
+    are transformed (by a type 1 discrete cosine transform if `scipy.fft`
+    is available) and mirrored to the negative lags. This halves the work
+    of the transform but not the memory of the result, which holds both
+    lags like the results of all other combinations returned by
+    :func:`pxcorr`. The start time offsets of the traces do not matter for
+    auto-correlations. The arguments are those of :func:`_pxcorr_block`.
+
+    :rtype: tuple
+    :return: correlations with lag time along the first dimension and their
+        start times as float timestamps
+    """
+    irfftsize = (B.shape[0]-1)*2
+    dtype = _real_dtype(B.dtype)
+    if kwargs['normalize_correlation']:
+        norm = (energy[cols]**2 / irfftsize).astype(dtype)
+    else:
+        norm = np.ones(len(cols),dtype=dtype)
+    if band is None:
+        band = slice(0,B.shape[0])
+    P = np.zeros((B.shape[0],len(cols)),dtype=dtype)
+    P[band] = np.absolute(B[band][:,cols])**2
+    if _use_zoom(kwargs,band,irfftsize,sampleToSave+1,
+                 _zoom_nbytes(band,sampleToSave,dtype)):
+        cosm, _ = _zoom_matrices(irfftsize,band,sampleToSave,dtype)
+        pos = cosm[sampleToSave:].dot(P[band])
+    elif BC_SCIPY_FFT:
+        pos = sfft.dct(P,type=1,axis=0)[:sampleToSave+1] / irfftsize
+    else:
+        if fft is None:
+            fft = NumpyFFT()
+        pos = fft.irfft(P.astype(B.dtype),irfftsize)[:sampleToSave+1]
+    pos = (pos / norm).astype(dtype,copy=False)
+    C = np.concatenate((pos[:0:-1],pos),axis=0)
+    starttimes = np.zeros(len(cols),dtype=np.float64)
+    starttimes[:] = zerotime - sampleToSave / kwargs['sampling_rate']
+    return C, starttimes
+
+
+def _use_zoom(kwargs,band,irfftsize,nlags,nbytes=0):
+    """Decide whether `nlags` lags are evaluated with :func:`_zoom_matrices`
+
+    If the matrices of `nbytes` bytes exceed `_ZOOM_MAX_BYTES` the inverse
+    FFT is used even if `zoom` is requested.
+    """
+    if band is None:
+        return False
+    if nbytes > _ZOOM_MAX_BYTES:
+        return False
+    method = _lag_transform(kwargs)
+    if method == 'auto':
+        return ((band.stop - band.start) * nlags <
+                irfftsize * np.log2(irfftsize))
+    return method == 'zoom'
+
+
+# least recently used matrices of _zoom_matrices limited to
+# _ZOOM_CACHE_BYTES bytes
+_zoom_cache = OrderedDict()
+_zoom_cache_lock = threading.Lock()
+_ZOOM_CACHE_BYTES = 2**29
+# largest matrices of _zoom_matrices that are used
+_ZOOM_MAX_BYTES = 2**28
+
+
+def _zoom_nbytes(band,sampleToSave,dtype):
+    """Size in bytes of the matrices returned by :func:`_zoom_matrices`
+    """
+    if band is None:
+        return 0
+    return (2 * (2*sampleToSave+1) * (band.stop-band.start) *
+            np.dtype(dtype).itemsize)
+
+
+def _zoom_matrices(irfftsize,band,sampleToSave,dtype):
+    """Return the matrices evaluating an inverse real FFT at the saved lags
+
+    The inverse real FFT of size `irfftsize` of a spectrum `M` that is zero
+    outside of `band` is at the lags -`sampleToSave` to `sampleToSave`
+    ``cosm.dot(M[band].real) - sinm.dot(M[band].imag)``. The cost of this
+    scales with the width of the band and the number of saved lags instead
+    of the length of the transform. The least recently used matrices are
+    kept for reuse up to a total size of `_ZOOM_CACHE_BYTES` bytes.
+
+    :rtype: tuple
+    :return: cosine and sine matrices with the lags along the first and the
+        frequencies along the second dimension
+    """
+    key = (irfftsize,band.start,band.stop,sampleToSave,np.dtype(dtype).name)
+    with _zoom_cache_lock:
+        if key in _zoom_cache:
+            matrices = _zoom_cache.pop(key)
+            _zoom_cache[key] = matrices
+            return matrices
+    k = np.arange(band.start,band.stop,dtype=np.int64)
+    lags = np.arange(-sampleToSave,sampleToSave+1,dtype=np.int64)
+    # reduce the phase before the conversion to float for precision
+    phi = 2.*np.pi*((np.outer(lags,k) % irfftsize) / float(irfftsize))
+    # the zero and Nyquist frequency appear only once in the sum
+    weight = np.where((k == 0) | (k == irfftsize//2),1.,2.) / irfftsize
+    matrices = ((np.cos(phi)*weight).astype(dtype),
+                (np.sin(phi)*weight).astype(dtype))
+    with _zoom_cache_lock:
+        _zoom_cache[key] = matrices
+        nbytes = sum([cosm.nbytes + sinm.nbytes for cosm, sinm in
+                      _zoom_cache.values()])
+        while nbytes > _ZOOM_CACHE_BYTES:
+            _, (cosm, sinm) = _zoom_cache.popitem(last=False)
+            nbytes -= cosm.nbytes + sinm.nbytes
+    return matrices
 
 
 def detrend(A,args,params):
@@ -273,12 +1452,19 @@ def detrend(A,args,params):
        -`constant` or `demean`: substract mean of traces
        
        -`linear`: substract a least squares fitted linear trend form the data
+
+    NaN samples (e.g. gaps) are ignored for the estimation of the trend and
+    remain NaN. For the `linear` type the optional keyword `bp` in `args`
+    gives a list of sample indices (breakpoints) at which the data is split
+    into segments with independent trends. The straight lines of all traces
+    are fitted at once by solving the normal equations of the fit in closed
+    form. Floating point data is detrended in place.
     
     :type A: numpy.ndarray
     :param A: time series data with time oriented along the first \\
         dimension (columns)
     :type args: dictionary
-    :param args: the only used keyword is `type`
+    :param args: the used keywords are `type` and `bp`
     :type params: dictionary
     :param params: not used here
     
@@ -291,53 +1477,50 @@ def detrend(A,args,params):
     if args['type'] == 'detrend':
         args['type'] = 'linear'
 
-    # Detrend function taken from scipy and modified to account for nan
     type=args['type']
     axis=0
     data=A
     if type not in ['linear', 'l', 'constant', 'c']:
         raise ValueError("Trend type must be 'linear' or 'constant'.")
     data = asarray(data)
-    dtype = data.dtype.char
-    if dtype not in 'dfDF':
-        dtype = 'd'
     if type in ['constant', 'c']:
         ret = data - expand_dims(nanmean(data, axis), axis)
         return ret
+    if data.dtype.char not in 'dfDF':
+        data = data.astype(np.float64)
+    N = data.shape[axis]
+    if 'bp' in args.keys():
+        bp = np.unique(np.concatenate(([0],np.atleast_1d(args['bp']),[N])))
     else:
-        dshape = data.shape
-        N = dshape[axis]
-        bp = sort(unique(r_[0, bp, N]))
-        if np.any(bp > N):
-            raise ValueError("Breakpoints must be less than length "
-                             "of data along given axis.")
-        Nreg = len(bp) - 1
-        # Restructure data so that axis is along first dimension and
-        #  all other dimensions are collapsed into second dimension
-        rnk = len(dshape)
-        if axis < 0:
-            axis = axis + rnk
-        newdims = r_[axis, 0:axis, axis + 1:rnk]
-        newdata = reshape(transpose(data, tuple(newdims)),
-                          (N, _prod(dshape) // N))
-        newdata = newdata.copy()  # make sure we have a copy
-        if newdata.dtype.char not in 'dfDF':
-            newdata = newdata.astype(dtype)
-        # Find leastsq fit and remove it for each piece
-        for m in range(Nreg):
-            Npts = bp[m + 1] - bp[m]
-            A = ones((Npts, 2), dtype)
-            A[:, 0] = cast[dtype](arange(1, Npts + 1) * 1.0 / Npts)
-            sl = slice(bp[m], bp[m + 1])
-            coef, resids, rank, s = linalg.lstsq(A, newdata[sl])
-            newdata[sl] = newdata[sl] - dot(A, coef)
-        # Put data back in original shape.
-        tdshape = take(dshape, newdims, 0)
-        ret = reshape(newdata, tuple(tdshape))
-        vals = list(range(1, rnk))
-        olddims = vals[:axis] + [0] + vals[axis:]
-        ret = transpose(ret, tuple(olddims))
-        return ret
+        bp = np.array([0,N])
+    if np.any(bp > N) or np.any(bp < 0):
+        raise ValueError("Breakpoints must be less than length "
+                         "of data along given axis.")
+    tdata = data.reshape(N,-1)
+    for m in range(len(bp) - 1):
+        seg = tdata[bp[m]:bp[m+1]]
+        # time relative to the center of the segment for a well conditioned
+        # system
+        t = np.arange(len(seg),dtype=np.float64) - (len(seg)-1)/2.
+        valid = ~np.isnan(seg)
+        y = np.where(valid,seg,0.)
+        # sums of the normal equations of all traces
+        n = valid.sum(axis=0)
+        st = np.dot(t,valid)
+        stt = np.dot(t**2,valid)
+        sy = y.sum(axis=0)
+        sty = np.dot(t,y)
+        det = n*stt - st**2
+        # traces with less than two samples are only demeaned
+        fit = det > 0
+        rdtype = np.result_type(seg.dtype,np.float64)
+        slope = np.zeros(seg.shape[1],dtype=rdtype)
+        slope[fit] = (n[fit]*sty[fit] - st[fit]*sy[fit]) / det[fit]
+        offset = np.zeros(seg.shape[1],dtype=rdtype)
+        has = n > 0
+        offset[has] = (sy[has] - slope[has]*st[has]) / n[has]
+        seg -= offset[None,:] + t[:,None]*slope[None,:]
+    return data
 
 def TDnormalization(A,args,params):
     """
@@ -371,31 +1554,58 @@ def TDnormalization(A,args,params):
     :rtype: numpy.ndarray
     :return: normalized time series data
     """
-    # filter if args['filter']
-    B = deepcopy(A)
+    # filter if args['filter'] and simple calculation of envelope
     if args['filter']:
         func = getattr(osignal,args['filter']['type'])
         fargs = deepcopy(args['filter'])
         fargs.pop('type')
         B = func(A.T,df=params['sampling_rate'],**fargs).T
+        B **= 2
     else:
-        B = deepcopy(A)
-    # simple calculation of envelope
-    B = B**2
-    #print 'shape B', B.shape
+        B = A**2
     # smoothing of envelepe in both directions to avoid a shift
-    window = (np.ones(np.ceil(args['windowLength']*params['sampling_rate']))/
-              np.ceil(args['windowLength']*params['sampling_rate']))
-    #print 'shape window', window.shape
-    for ind in range(B.shape[1]):
-        B[:,ind] = np.convolve(B[:,ind],window, mode='same')        
-        B[:,ind] = np.convolve(B[::-1,ind],window, mode='same')[::-1]
-        B[:,ind] += np.max(B[:,ind])*1e-6
+    wlen = int(np.ceil(args['windowLength']*params['sampling_rate']))
+    B = _moving_average(B,wlen,(wlen-1)//2)
+    B = _moving_average(B,wlen,wlen-1-(wlen-1)//2)
+    B += np.max(B,axis=0)*1e-6
     # normalization
     A /= np.sqrt(B)
     return A
 
 
+def _moving_average(B,wlen,lead):
+    """Moving average along the first dimension of `B`
+
+    Sample `k` of the result is the sum of the samples `k+lead-wlen+1` to
+    `k+lead` of `B` divided by `wlen` where samples outside `B` are zero.
+    This is what `np.convolve(B[:,ii],np.ones(wlen)/wlen,mode='same')`
+    returns for `lead=(wlen-1)//2` and the same applied to the reversed
+    trace for `lead=wlen-1-(wlen-1)//2`. All columns are averaged at once
+    with a cumulative sum in double precision and the result is written to
+    `B`.
+    """
+    _window_sum(B,wlen,lead,out=B)
+    B /= wlen
+    return B
+
+
+def _window_sum(B,wlen,lead,out=None,dtype=np.float64):
+    """Moving sum along the first dimension of `B`
+
+    Sample `k` of the result is the sum of the samples `k+lead-wlen+1` to
+    `k+lead` of `B` where samples outside `B` are zero. The sums are
+    differences of a cumulative sum of type `dtype`.
+    """
+    npts = B.shape[0]
+    # cumulative sum of B padded with wlen-lead-1 zeros in front and lead
+    # zeros at the end
+    front = wlen - lead - 1
+    C = np.zeros((npts+wlen,)+B.shape[1:],dtype=dtype)
+    np.cumsum(B,axis=0,out=C[front+1:front+npts+1])
+    C[front+npts+1:] = C[front+npts]
+    return np.subtract(C[wlen:wlen+npts],C[:npts],out=out,casting='unsafe')
+
+
 def taper(A,args,params):
     """
     Taper to the time series data
@@ -457,11 +1667,9 @@ def clip(A,args,params):
     :rtype: numpy.ndarray
     :return: clipped time series data
     """
-    stds = np.nanstd(A,axis=0)
-    for ind in range(A.shape[1]):
-        ts = args['std_factor']*stds[ind]
-        A[A[:,ind]>ts,ind] = ts
-        A[A[:,ind]<-ts,ind] = -ts
+    ts = args['std_factor']*np.nanstd(A,axis=0)
+    np.minimum(A,ts,out=A)
+    np.maximum(A,-ts,out=A)
     return A
 
 
@@ -517,7 +1725,7 @@ def mute(A,args,params):
     if 'filter' in args.keys():
         C = TDfilter(A,args['filter'],params)
     else:
-        C = deepcopy(A)
+        C = A
     
     # calculate envelope
     #D = np.abs(signal.hilbert(C,axis=0))
@@ -532,29 +1740,44 @@ def mute(A,args,params):
         thres = np.std(C,axis=0)
     
     # calculate mask
-    mask = np.ones_like(D)
-    mask[D>np.tile(np.atleast_2d(thres),(A.shape[0],1))]=0
+    mask = (~(D > thres[None,:])).astype(np.float64)
     # extend the muted segments to make sure the whole segment is zero after
     if args['extend_gaps']:
-        tap = np.ones(ntap)/ntap
-        for ind in range(A.shape[1]):
-            mask[:,ind] = np.convolve(mask[:,ind],tap, mode='same')
-        nmask = np.ones_like(D)
-        nmask[mask<1.] = 0
+        mask = _moving_average(mask,ntap,(ntap-1)//2)
+        nmask = (~(mask < 1.)).astype(np.float64)
     else:
         nmask = mask
     
     # apply taper
-    tap = 2. - (np.cos(np.arange(ntap,dtype=float)/ntap*2.*np.pi) + 1.)
-    tap /= ntap
-    for ind in range(A.shape[1]):
-        nmask[:,ind] = np.convolve(nmask[:,ind],tap, mode='same')
+    nmask = _cosine_taper_convolve(nmask,ntap)
     
     # mute date with tapered mask
     A *= nmask
     return A
 
 
+def _cosine_taper_convolve(B,ntap):
+    """Convolve all columns of `B` with the cosine taper of `mute`
+
+    Return what `np.convolve(B[:,ii],tap,mode='same')` returns for every
+    column of `B` with `tap = (1 - cos(2 pi j/ntap))/ntap` for
+    `j = 0...ntap-1`. The cosine is the real part of a complex exponential
+    such that the convolution reduces to two moving sums (one of them of
+    `B` multiplied by the exponential) that are calculated with cumulative
+    sums for all columns at once.
+    """
+    npts = B.shape[0]
+    lead = (ntap - 1)//2
+    omega = 2.*np.pi/ntap
+    S = _window_sum(B,ntap,lead)
+    E = _window_sum(B*np.exp(-1j*omega*np.arange(npts))[:,None],ntap,lead,
+                    dtype=np.complex128)
+    E *= np.exp(1j*omega*(np.arange(npts) + lead))[:,None]
+    S -= E.real
+    S /= ntap
+    return S
+
+
 def TDfilter(A,args,params):
     """
     Filter time series data
@@ -637,7 +1860,7 @@ def zeroPadding(A,args,params):
     Append zeros to the traces 
     
     Pad traces with zeros to increase the speed of the Fourier transforms and
-    to avoid wrap around effects. Three possibilities for the length of the 
+    to avoid wrap around effects. Four possibilities for the length of the 
     padding can be set in `args['type']`
     
         -`nextPowerOfTwo`: traces are padded to a length that is the next power \\
@@ -645,6 +1868,8 @@ def zeroPadding(A,args,params):
         -`avoidWrapAround`: depending on length of the trace that is to be used \\
             the padded part is just long enough to avoid wrap around
         -`avoidWrapPowerTwo`: use the next power of two that avoids wrap around
+        -`avoidWrapFastLength`: use the next even length that avoids wrap \
+            around and is a product of small primes for which the FFT is fast
         
         :Example: ``args = {'type':'avoidWrapPowerTwo'}``
     
@@ -667,10 +1892,16 @@ def zeroPadding(A,args,params):
     elif args['type'] == 'avoidWrapPowerTwo':
         N = osignal.util.next_pow_2(npts + params['sampling_rate'] *
                                   params['lengthToSave'])
+    elif args['type'] == 'avoidWrapFastLength':
+        N = next_fast_len(int(np.ceil(npts + params['sampling_rate'] *
+                                      params['lengthToSave'])))
+        # the correlation assumes spectra of even length traces
+        while N % 2:
+            N = next_fast_len(N+1)
     else:
         raise ValueError("type '%s' of zero padding not implemented" %
                          args['type'])
-    A = np.concatenate((A,np.zeros((N-npts,ntrc),dtype=np.float64)),axis=0)
+    A = np.concatenate((A,np.zeros((int(N-npts),ntrc),dtype=A.dtype)),axis=0)
     return A
     
 
@@ -732,11 +1963,86 @@ def FDfilter(B,args,params):
     :rtype: numpy.ndarray
     :return: filtered spectal data
     """
-    args = deepcopy(args)
-    args.update({'freqs':params['freqs']})
-    tap = osignal.invsim.cosine_taper(B.shape[0],**args)
-    B *= np.tile(np.atleast_2d(tap).T,(1,B.shape[1]))
+    B *= _fd_taper(params['freqs'],args)[:,None]
+    return B
+
+
+_taper_cache = {}
+
+def _fd_taper(freqs,args):
+    """Return the taper of :func:`FDfilter` for the frequencies `freqs`
+
+    The taper is calculated once for every number of frequencies, maximum
+    frequency and set of arguments and reused for all later windows.
+    """
+    key = (len(freqs),float(freqs[-1]),repr(_canonical(args)))
+    if key not in _taper_cache:
+        targs = deepcopy(args)
+        targs.update({'freqs':freqs})
+        _taper_cache[key] = osignal.invsim.cosine_taper(len(freqs),**targs)
+    return _taper_cache[key]
+
+
+def _fd_process(B,procs,params):
+    """Apply the frequency domain pre-processing `procs` to the spectra `B`
+
+    Consecutive steps of :func:`spectralWhitening` (without joint
+    normalization) followed by :func:`FDfilter` are fused: the inverse
+    amplitude of the whitening and the tapers of the filters are combined
+    into one real weight per sample that is applied to `B` by a single
+    in-place multiplication. All other steps are applied as they are.
+    """
+    weight = None
+    for proc in procs:
+        if proc['function'] == spectralWhitening and \
+                not ('joint_norm' in proc['args'].keys() and
+                     proc['args']['joint_norm']):
+            if weight is not None:
+                B *= weight
+            weight = np.absolute(B)
+            np.reciprocal(weight,out=weight)
+        elif proc['function'] == FDfilter:
+            taper = _fd_taper(params['freqs'],proc['args'])[:,None]
+            if weight is None:
+                weight = np.repeat(taper,B.shape[1],axis=1)
+            else:
+                weight *= taper
+        else:
+            if weight is not None:
+                B *= weight
+                weight = None
+            B = proc['function'](B,proc['args'],params)
+    if weight is not None:
+        B *= weight
     return B
+
+
+def _fd_band(procs,freqs):
+    """Return the band of frequencies outside of which the spectra are zero
+
+    This is known if the frequency domain pre-processing `procs` consists of
+    :func:`spectralWhitening` and :func:`FDfilter` steps only and contains at
+    least one filter.
+
+    :rtype: slice
+    :return: samples of the spectra within the pass band of the filters or
+        None if the spectra are not band limited
+    """
+    taper = None
+    for proc in procs:
+        if proc['function'] == FDfilter:
+            if taper is None:
+                taper = _fd_taper(freqs,proc['args'])
+            else:
+                taper = taper * _fd_taper(freqs,proc['args'])
+        elif proc['function'] != spectralWhitening:
+            return None
+    if taper is None:
+        return None
+    nonzero = np.where(taper != 0)[0]
+    if len(nonzero) == 0:
+        return slice(0,0)
+    return slice(nonzero[0],nonzero[-1]+1)
     
 
 def FDsignBitNormalization(B,args,params):
@@ -817,6 +2123,257 @@ def rfftfreq(n, d=1.0):
     return results * val
     
 
+def allgather_stream(comm,st):
+    """Gather the traces of `st` of all processes on all processes
+
+    Replaces the broadcast of a pickled stream from every process. The
+    headers of the traces are exchanged as a compact table with the seed ID,
+    start time, sampling rate, number of samples and dtype of every trace
+    and the positions of their gaps (see :func:`_stream_header`). Other
+    entries of the stats (e.g. coordinates) are not exchanged. The samples
+    of the traces are packed into one contiguous buffer that keeps the dtype
+    of the traces if they all share one (float64 otherwise). Tables, gaps and
+    samples are each exchanged by a single `Allgatherv` (see
+    :func:`_allgatherv`). The traces of the returned stream are in the order
+    of the processes and their data are views of the received buffer.
+
+    :type comm: :class:`mpi4py.MPI.Comm`
+    :param comm: communicator of the processes
+    :type st: :class:`~obspy.core.stream.Stream`
+    :param st: traces of this process
+
+    :rtype: :class:`~obspy.core.stream.Stream`
+    :return: traces of all processes
+    """
+    if comm.Get_size() == 1:
+        return stream.Stream([tr for tr in st])
+    table, gaps = _stream_header(st)
+    tables = [part.view(_HEADER_DTYPE) for part in _allgatherv(comm,table)]
+    gaps = [part.view(np.int64).reshape(-1,2)
+            for part in _allgatherv(comm,gaps)]
+    dtype = _buffer_dtype(np.concatenate(tables))
+    _, _, buf = _pack_stream(st,dtype)
+    rst = stream.Stream()
+    for table, gap, part in zip(tables,gaps,_allgatherv(comm,buf)):
+        rst += _unpack_stream(table,gap,part.view(dtype))
+    return rst
+
+
+def _allgatherv(comm,buf):
+    """Gather the contiguous array `buf` of all processes by one `Allgatherv`
+
+    The number of elements of an MPI message is a 32 bit integer. The bytes
+    of the buffers are therefore exchanged in blocks of a derived datatype
+    whose size (a power of two and at least 8 bytes) keeps the number of
+    blocks of all processes below this limit. The buffer of every process is
+    padded to a whole number of blocks.
+
+    :rtype: list
+    :return: views of the bytes of the buffers of all processes
+    """
+    psize = comm.Get_size()
+    sbuf = np.ascontiguousarray(buf).reshape(-1).view(np.uint8)
+    nbytes = np.zeros(psize,dtype=np.int64)
+    comm.Allgather([np.array([len(sbuf)],dtype=np.int64),MPI.INT64_T],
+                   [nbytes,MPI.INT64_T])
+    blk = 8
+    while (np.sum(nbytes)//blk + psize) >= 2**31:
+        blk *= 2
+    counts = (nbytes + blk - 1)//blk
+    displs = np.concatenate(([0],np.cumsum(counts)[:-1]))
+    if len(sbuf) != counts[comm.Get_rank()]*blk:
+        tmp = np.zeros(counts[comm.Get_rank()]*blk,dtype=np.uint8)
+        tmp[:len(sbuf)] = sbuf
+        sbuf = tmp
+    rbuf = np.zeros(np.sum(counts)*blk,dtype=np.uint8)
+    btype = MPI.BYTE.Create_contiguous(blk).Commit()
+    try:
+        comm.Allgatherv([sbuf,counts[comm.Get_rank()],btype],
+                        [rbuf,(counts.astype(int),displs.astype(int)),btype])
+    finally:
+        btype.Free()
+    return [rbuf[displs[ii]*blk:displs[ii]*blk+nbytes[ii]]
+            for ii in range(psize)]
+
+
+# table of the headers of the traces exchanged by allgather_stream
+_HEADER_DTYPE = np.dtype([('id','S64'),('starttime','i8'),
+                          ('sampling_rate','f8'),('npts','i8'),
+                          ('dtype','S8'),('ngaps','i8')])
+
+
+def _stream_header(st):
+    """Header of the traces in `st` for :func:`_pack_stream`
+
+    :rtype: tuple
+    :return: table of type `_HEADER_DTYPE` with the seed ID, start time in
+        nanoseconds, sampling rate, number of samples, dtype and number of
+        gaps (-1 for unmasked data) of every trace and an array with the
+        start and end index of the runs of masked samples of all traces
+    """
+    table = np.zeros(len(st),dtype=_HEADER_DTYPE)
+    gaps = [np.zeros((0,2),dtype=np.int64)]
+    for ind, tr in enumerate(st):
+        ngaps = -1
+        if np.ma.isMaskedArray(tr.data):
+            mask = np.ma.getmaskarray(tr.data).astype(np.int8)
+            edges = np.diff(np.concatenate(([0],mask,[0])))
+            tgaps = np.array([np.where(edges == 1)[0],
+                              np.where(edges == -1)[0]],dtype=np.int64).T
+            gaps.append(tgaps)
+            ngaps = len(tgaps)
+        table[ind] = (tr.id,tr.stats.starttime.ns,tr.stats.sampling_rate,
+                      len(tr.data),tr.data.dtype.str,ngaps)
+    return table, np.concatenate(gaps)
+
+
+def _buffer_dtype(table):
+    """dtype of the buffer for the traces in `table`
+
+    The dtype of the traces if they all share one and float64 otherwise.
+    """
+    dtypes = set(table['dtype'])
+    if len(dtypes) == 1:
+        return np.dtype(dtypes.pop())
+    return np.dtype(np.float64)
+
+
+def _pack_stream(st,dtype=None):
+    """Pack the samples of the traces in `st` into one buffer
+
+    Masked samples are stored as zeros and their positions are kept in the
+    header (see :func:`_stream_header`).
+
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: dtype of the buffer (see :func:`_buffer_dtype` by default)
+
+    :rtype: tuple
+    :return: table of headers, gaps and the buffer with the samples of all
+        traces
+    """
+    table, gaps = _stream_header(st)
+    if dtype is None:
+        dtype = _buffer_dtype(table)
+    buf = np.zeros(np.sum(table['npts']),dtype=dtype)
+    pos = 0
+    for tr in st:
+        npts = len(tr.data)
+        buf[pos:pos+npts] = np.ma.filled(tr.data,0)
+        pos += npts
+    return table, gaps, buf
+
+
+def _unpack_stream(table,gaps,buf):
+    """Create a stream from the `table`, `gaps` and `buf` of
+    :func:`_pack_stream`
+    """
+    st = stream.Stream()
+    pos = 0
+    gpos = 0
+    for header in table:
+        npts = int(header['npts'])
+        data = buf[pos:pos+npts].astype(header['dtype'],copy=False)
+        if header['ngaps'] >= 0:
+            mask = np.zeros(npts,dtype=bool)
+            for start, end in gaps[gpos:gpos+header['ngaps']]:
+                mask[start:end] = True
+            gpos += header['ngaps']
+            data = np.ma.masked_array(data,mask=mask)
+        tr = trace.Trace(data=data)
+        (tr.stats.network,tr.stats.station,tr.stats.location,
+         tr.stats.channel) = header['id'].decode().split('.')
+        tr.stats.sampling_rate = header['sampling_rate']
+        tr.stats.starttime = UTCDateTime(ns=int(header['starttime']))
+        st.append(tr)
+        pos += npts
+    return st
+
+
+class SubdivisionWindows(object):
+    """Sliding windows over the traces of a stream without copying the data
+
+    The traces of `st` are packed once into a matrix with time along the
+    first dimension on the sample grid starting at `starttime`. A boolean
+    matrix of the same shape marks the samples that contain data (gaps and
+    the parts not covered by a trace are zero in the data matrix). The
+    subdivisions of length `corr_len` seconds that start every `corr_inc`
+    seconds are strided views of these matrices such that a subdivision is
+    obtained without copying samples. The start time of every trace keeps
+    its sub-sample offset from the grid.
+
+    :type st: obspy.stream
+    :param st: stream with traces of equal sampling rate
+    :type starttime: :class:`~obspy.core.UTCDateTime`
+    :param starttime: start time of the first subdivision
+    :type corr_len: float
+    :param corr_len: length of the subdivisions in seconds
+    :type corr_inc: float
+    :param corr_inc: increment of the start times of the subdivisions in
+        seconds
+    :type nsub: int
+    :param nsub: number of subdivisions
+    """
+    def __init__(self, st, starttime, corr_len, corr_inc, nsub):
+        self.sampling_rate = st[0].stats['sampling_rate']
+        self.starttime = starttime
+        self.nsub = nsub
+        self.stats = [tr.stats for tr in st]
+        inc = int(round(corr_inc * self.sampling_rate))
+        # trim includes the sample at the end time
+        npts = int(round(corr_len * self.sampling_rate)) + 1
+        nrow = (nsub - 1) * inc + npts
+        data = np.zeros((nrow,len(st)),dtype=np.float64)
+        mask = np.zeros((nrow,len(st)),dtype=bool)
+        self.offset = np.zeros(len(st),dtype=np.float64)
+        for ii, tr in enumerate(st):
+            # row of the first sample and its offset from the grid
+            shift = (tr.stats['starttime'] - starttime) * self.sampling_rate
+            row = int(round(shift))
+            self.offset[ii] = (shift - row) / self.sampling_rate
+            if isinstance(tr.data,np.ma.MaskedArray):
+                tdata = tr.data.filled(0.)
+                tmask = ~np.ma.getmaskarray(tr.data)
+            else:
+                tdata = tr.data
+                tmask = np.ones(len(tr.data),dtype=bool)
+            first = max(-row,0)
+            last = min(len(tdata),nrow-row)
+            if last <= first:
+                continue
+            data[row+first:row+last,ii] = tdata[first:last]
+            mask[row+first:row+last,ii] = tmask[first:last]
+        shape = (nsub,npts,len(st))
+        self.data = np.lib.stride_tricks.as_strided(data,shape=shape,
+                        strides=(inc*data.strides[0],)+data.strides)
+        self.mask = np.lib.stride_tricks.as_strided(mask,shape=shape,
+                        strides=(inc*mask.strides[0],)+mask.strides)
+        self.inc = inc
+
+    def stream(self, subn):
+        """Return the traces of subdivision `subn`
+
+        Traces without any data in the subdivision are omitted. The data of
+        the returned traces are views of the packed matrix (masked where
+        there are gaps) and must not be modified.
+
+        :rtype: obspy.stream
+        :return: traces of the subdivision
+        """
+        data = self.data[subn]
+        mask = self.mask[subn]
+        wstart = self.starttime + subn * self.inc / float(self.sampling_rate)
+        sst = stream.Stream()
+        for ii in np.where(mask.any(axis=0))[0]:
+            header = self.stats[ii].copy()
+            header['starttime'] = wstart + self.offset[ii]
+            if mask[:,ii].all():
+                tdata = data[:,ii]
+            else:
+                tdata = np.ma.masked_array(data[:,ii],mask=~mask[:,ii])
+            sst.append(trace.Trace(data=tdata,header=header))
+        return sst
+
+
 def stream_pxcorr(st,options,comm=None):
     """ 
     Preprocess and correlate traces in a stream
@@ -847,12 +2404,63 @@ def stream_pxcorr(st,options,comm=None):
         - TDpreProcessing: list controlling the time domain preprocessing
         - FDpreProcessing: list controlling the frequency domain preprocessing
 
+    The following keys are optional:
+        - block_size: number of combinations that are correlated together in\\
+            one vectorized operation. By default it is chosen such that the\\
+            cross-spectra of one block occupy about 64 MB.
+        - distribution: either `replicate` (default) or `grid`. With\
+            `replicate` the spectra of all traces are summed on every process\
+            and the correlations are returned on every process. With `grid`\
+            the processes are arranged in a 2D grid, each of them receives\
+            only the spectra needed for its combinations and the correlations\
+            are only returned on rank 0 (or written directly by the\
+            processes that computed them if `direct_output` is given).
+        - schedule: `static` (default) or `dynamic`. With `static` the\
+            combinations are split into parts of equal estimated cost for\
+            the processes. With `dynamic` (only with the `replicate`\
+            distribution) the processes claim blocks of combinations from a\
+            shared counter while they work. `timing` prints the time spent\
+            by every process.
+        - executor: `serial` (default) or `threads` to pre-process and\
+            correlate blocks of traces and combinations on a pool of\
+            `threads` threads within every process.
+        - fft: backend of the Fourier transforms `numpy` (default), `scipy`\
+            or `fftw` (see :func:`get_fft`). `fft_threads` sets the number of\
+            threads used by `scipy` and `fftw` for one transform.
+        - lag_transform: `fft` (default), `zoom` or `auto`. If\
+            `FDpreProcessing` limits the spectra to the pass band of\
+            `FDfilter`, `zoom` evaluates the saved lags directly from the\
+            cross-spectra within the band instead of by a full size inverse\
+            FFT. `auto` does so if it needs fewer operations. The FFT is\
+            used if the matrices of the zoom would exceed 256 MB.
+        - padding: type of the zero padding before the Fourier transform\
+            (see :func:`zeroPadding`). Defaults to `avoidWrapPowerTwo`.\
+            `avoidWrapFastLength` avoids the doubling of long traces.
+        - dtype: `float64` (default) or `float32`. With `float32` the data,\
+            spectra, cross-spectra, reductions and the returned correlations\
+            are held in single precision (complex64 for the spectra) which\
+            halves memory and bandwidth. Start times remain in double\
+            precision.
+        - spectrum_cache: directory (or :class:`SpectrumCache`) of an\
+            on-disk cache of the pre-processed spectra of the traces. Spectra\
+            of traces with the same seed ID, start time, sampling rate,\
+            length and processing are read from the cache instead of being\
+            processed again. `spectrum_cache_size` limits the size of the\
+            cache in bytes by removing the least recently used spectra.
+        - shared_memory: if True the spectra of the `replicate`\
+            distribution are held in MPI shared memory only once per node\
+            and only the lowest rank of every node takes part in the\
+            summation between the nodes.
+
     The item in the list `TDpreProcessing` and `FDpreProcessing` are 
     dictionaries with two keys: `function` containing the function to apply and
     `args` being a dictionary with the arguments for this function. The
     functions in `TDpreProcessing` are applied in their order before the
     Fourier transformation and those in FDpreProcessing` are applied in their
-    order Fourier domain.
+    order Fourier domain. Consecutive steps of `spectralWhitening` and
+    `FDfilter` are fused into a single multiplication of the spectra and if
+    `FDpreProcessing` consists of these two functions only, the cross-spectra
+    are only calculated within the pass band of the filters.
 
     :Example:
         ``options = {'TDpreProcessing':[{'function':detrend,
@@ -882,7 +2490,8 @@ def stream_pxcorr(st,options,comm=None):
             'combinations':[(0,0),(0,1),(0,2),(1,2)]}``
     
     `comm` is a mpi4py communicator that can be passed if already initialized
-    otherwise it is created here.
+    otherwise it is created here. If `mpi4py` is not installed or
+    :class:`LocalComm` is passed the correlation runs in a single process.
 
     :type st: obspy.stream
     :param st: stream with traces to be correlated
@@ -894,30 +2503,21 @@ def stream_pxcorr(st,options,comm=None):
     
     # initialize MPI
     if not comm:
-        comm = MPI.COMM_WORLD
-    rank = comm.Get_rank()    
+        if BC_MPI:
+            comm = MPI.COMM_WORLD
+        else:
+            comm = LocalComm()
 
     # get parameters of the data
-    if rank == 0:
-        starttime = []
-        npts = []
-        for tr in st:
-            starttime.append(tr.stats['starttime'])
-            npts.append(tr.stats['npts'])
-        npts = np.max(np.array(npts))
-    else:
-        starttime = None
-        npts = None
-    starttime = comm.bcast(starttime, root=0)
-    npts = comm.bcast(npts, root=0)
-    # fill matrix with noise data
-    A = np.zeros([npts,len(st)])
-    if rank == 0:    
-        for ii in range(len(st)):
-            A[0:st[ii].stats['npts'],ii] = st[ii].data
-    comm.Bcast([A,MPI.DOUBLE],root=0)
+    starttime = []
+    for tr in st:
+        starttime.append(tr.stats['starttime'])
     options.update({'starttime':starttime,
-                    'sampling_rate':st[0].stats['sampling_rate']})
+                    'sampling_rate':st[0].stats['sampling_rate'],
+                    'trace_ids':[tr.id for tr in st]})
+    # fill matrix with the noise data of the traces processed on this rank
+    A, pmap = _local_trace_matrix(st,comm,options)
+    options.update({'trace_map':pmap})
 
     # call pxcorr for correlation with direct output
     if 'direct_output' in options.keys():
@@ -926,6 +2526,9 @@ def stream_pxcorr(st,options,comm=None):
 
     # call pxcorr for correlation
     A, starttime = pxcorr(comm,A,**options)
+    if A is None:
+        # results of the grid distribution are only present on rank 0
+        return stream.Stream()
     npts = A.shape[0]
     
     # put trace into a stream
@@ -18,8 +18,20 @@ from multiprocessing import Pool
 from copy import deepcopy
 import datetime
 import glob
+import fnmatch
 import re
 import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from fractions import Fraction
+
+# polyphase resampling requires scipy >= 0.18
+try:
+    BC_RESAMPLE_POLY = True
+    from scipy.signal import resample_poly, firwin
+except ImportError:
+    BC_RESAMPLE_POLY = False
 
 
 # ETS imports
@@ -400,6 +412,9 @@ def stream_downsample(st, final_freq, no_filter=False, \
 
     :rtype: :class:`~obspy.core.stream.Stream`
     :return: **st_down**: Downsampled Stream.
+
+    See :func:`stream_resample` for the resampling of all traces with equal
+    sampling rates in one vectorized operation by arbitrary rational factors.
     """
     if not isinstance(st, Stream):
         raise InputError("'st' must be a 'obspy.core.stream.Stream' object")
@@ -425,6 +440,87 @@ def stream_downsample(st, final_freq, no_filter=False, \
     return st_down
 
 
+_poly_filters = {}
+
+def _poly_filter(up, down, window):
+    """Return the FIR filter of :func:`scipy.signal.resample_poly`
+
+    The filter designed by `resample_poly` for the factors `up` and `down`
+    is calculated once and reused for all later calls.
+    """
+    key = (up, down, window)
+    if key not in _poly_filters:
+        max_rate = max(up, down)
+        _poly_filters[key] = firwin(2 * 10 * max_rate + 1, 1. / max_rate,
+                                    window=window)
+    return _poly_filters[key]
+
+
+def stream_resample(st, final_freq, window=('kaiser', 5.0),
+                    max_denominator=1000):
+    """Resample all the traces in the input stream to a desired frequency.
+
+    The ratio of ``final_freq`` and the sampling rate of a trace is
+    approximated by a fraction ``up/down`` with a denominator of at most
+    ``max_denominator``. The traces with the same sampling rate and number of
+    samples are packed into one array and resampled along its first axis by
+    a single call of :func:`scipy.signal.resample_poly` (upsampling by
+    ``up``, zero-phase FIR anti-aliasing filter and downsampling by
+    ``down``). The FIR filter of every factor is designed only once. In
+    contrast to :func:`stream_downsample` the factor is not limited.
+
+    .. Note::
+
+    This operation is performed in place and the data of the resampled
+    traces are of type float64. The traces must not contain gaps (masked
+    arrays). Use :meth:`~obspy.core.stream.Stream.split` to split them into
+    contiguous traces.
+
+    :type st: :class:`~obspy.core.stream.Stream`
+    :param st: The container for the Traces that we want to resample
+    :type final_freq: float
+    :param final_freq: Desired final frequency
+    :type window: tuple
+    :param window: window of the FIR filter design (see
+        :func:`scipy.signal.firwin`)
+    :type max_denominator: int
+    :param max_denominator: largest factor ``down``
+
+    :rtype: :class:`~obspy.core.stream.Stream`
+    :return: **st**: Resampled Stream.
+    """
+    if not isinstance(st, Stream):
+        raise InputError("'st' must be a 'obspy.core.stream.Stream' object")
+    if not BC_RESAMPLE_POLY:
+        raise ImportError("stream_resample requires scipy.signal.resample_poly")
+    # traces that are resampled together
+    groups = {}
+    for ind, tr in enumerate(st):
+        if np.ma.isMaskedArray(tr.data):
+            raise InputError("trace %s contains gaps" % tr.id)
+        key = (tr.stats.sampling_rate, tr.stats.npts)
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(ind)
+    for (sampling_rate, npts), inds in groups.items():
+        ratio = Fraction(float(final_freq) / sampling_rate).limit_denominator(
+                                                            max_denominator)
+        up, down = ratio.numerator, ratio.denominator
+        if up == down:
+            continue
+        A = np.zeros((npts, len(inds)), dtype=np.float64)
+        for jj, ind in enumerate(inds):
+            A[:, jj] = st[ind].data
+        R = resample_poly(A, up, down, axis=0,
+                          window=_poly_filter(up, down, window))
+        # contiguous data for every trace
+        R = np.ascontiguousarray(R.T)
+        for jj, ind in enumerate(inds):
+            st[ind].data = R[jj]
+            st[ind].stats.sampling_rate = sampling_rate * up / float(down)
+    return st
+
+
 if BC_UI:
     class _stream_downsample_view(HasTraits):
         final_freq = Int(2)
@@ -913,7 +1009,323 @@ def trace_sym_pad_shrink_to_npts(tr, npts):
 
 IDformat = ['%NET','%net','%STA','%sta','%LOC','%loc','%CHA','%cha']
 
-def read_from_filesystem(ID,starttime,endtime,fs,trim=True):
+
+class WaveformIndex(object):
+    """Persistent index of the traces in waveform files
+
+    The seed ID, start time, end time and sampling rate of every trace in the
+    indexed files are stored in a SQLite database together with the path,
+    modification time and size of the file. The headers of a file are only
+    read again if its modification time or size changed. Files that contain
+    data of a given period are then found by a range query instead of reading
+    the headers of all candidate files.
+
+    :meth:`files` answers from the database. It only looks at the files of a
+    directory again if the modification time of the directory changed since
+    it was last looked at, i.e. if files were added, removed or renamed.
+    Files changed in place (e.g. data appended to the file of the current
+    day) must be indexed again with :meth:`update` or :meth:`scan`.
+
+    The database should reside on a local disk. It can be shared by several
+    processes and threads.
+
+    :type path: str
+    :param path: file name of the database
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path,timeout=60.,
+                                    check_same_thread=False)
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                              '(path TEXT PRIMARY KEY, mtime REAL, '
+                              'size INTEGER)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS traces '
+                              '(path TEXT, seed_id TEXT, starttime REAL, '
+                              'endtime REAL, sampling_rate REAL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs '
+                              '(path TEXT PRIMARY KEY, mtime REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS traces_path '
+                              'ON traces (path)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS traces_time '
+                              'ON traces (seed_id, starttime, endtime)')
+            self.conn.commit()
+
+    def update(self, flist):
+        """Index the files in `flist` that are new or changed
+
+        Files whose headers cannot be read are indexed without traces.
+
+        :rtype: int
+        :return: number of files whose headers were read
+        """
+        nread = 0
+        for fname in flist:
+            try:
+                fstat = os.stat(fname)
+            except OSError:
+                continue
+            with self.lock:
+                row = self.conn.execute('SELECT mtime, size FROM files '
+                                        'WHERE path=?',(fname,)).fetchone()
+            if (row is not None) and (row[0] == fstat.st_mtime) and \
+                    (row[1] == fstat.st_size):
+                continue
+            try:
+                st = read(fname,headonly=True)
+                traces = [(fname,tr.id,tr.stats.starttime.timestamp,
+                           tr.stats.endtime.timestamp,
+                           tr.stats.sampling_rate) for tr in st]
+            except Exception:
+                traces = []
+            nread += 1
+            with self.lock:
+                self.conn.execute('DELETE FROM traces WHERE path=?',(fname,))
+                self.conn.executemany('INSERT INTO traces VALUES '
+                                      '(?,?,?,?,?)',traces)
+                self.conn.execute('INSERT OR REPLACE INTO files VALUES '
+                                  '(?,?,?)',(fname,fstat.st_mtime,
+                                             fstat.st_size))
+                self.conn.commit()
+        return nread
+
+    def scan(self, directory):
+        """Index all files below `directory` and remove deleted files
+
+        :rtype: int
+        :return: number of files whose headers were read
+        """
+        own = self._own_files()
+        flist = []
+        for root, _, fnames in os.walk(directory):
+            flist += [os.path.join(root,fname) for fname in fnames
+                      if os.path.abspath(os.path.join(root,fname)) not in own]
+        with self.lock:
+            indexed = [row[0] for row in self.conn.execute(
+                            'SELECT path FROM files WHERE path LIKE ?',
+                            (os.path.join(directory,'')+'%',))]
+        self.remove(list(set(indexed) - set(flist)))
+        return self.update(sorted(flist))
+
+    def _own_files(self):
+        """Files of the database itself that are not indexed
+        """
+        return [os.path.abspath(self.path + ext) for ext in ['','-journal']]
+
+    def _refresh(self, directory):
+        """Index the files in `directory` again if the modification time of
+        the directory changed since it was last indexed
+        """
+        try:
+            # taken before listing such that files added meanwhile are found
+            # next time
+            mtime = os.stat(directory or os.curdir).st_mtime
+        except OSError:
+            return
+        with self.lock:
+            row = self.conn.execute('SELECT mtime FROM dirs WHERE path=?',
+                                    (directory,)).fetchone()
+        if (row is not None) and (row[0] == mtime):
+            return
+        own = self._own_files()
+        flist = [os.path.join(directory,fname) for fname in
+                 os.listdir(directory or os.curdir)]
+        flist = [fname for fname in flist if os.path.isfile(fname) and
+                 (os.path.abspath(fname) not in own)]
+        with self.lock:
+            indexed = [row[0] for row in self.conn.execute(
+                            'SELECT path FROM files WHERE path LIKE ?',
+                            (os.path.join(directory,'')+'%',))
+                       if os.path.dirname(row[0]) == directory]
+        self.remove(list(set(indexed) - set(flist)))
+        self.update(sorted(flist))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?)',
+                              (directory,mtime))
+            self.conn.commit()
+
+    def remove(self, flist):
+        """Remove the files in `flist` from the index
+        """
+        with self.lock:
+            for fname in flist:
+                self.conn.execute('DELETE FROM traces WHERE path=?',(fname,))
+                self.conn.execute('DELETE FROM files WHERE path=?',(fname,))
+            self.conn.commit()
+
+    def files(self, fpattern, starttime, endtime, ID='*'):
+        """Return the files matching `fpattern` with data in a period
+
+        The directories matching the directory part of the glob pattern
+        `fpattern` whose modification time changed are indexed again
+        before the query (see :meth:`_refresh`). The files themselves are
+        not looked at.
+
+        :type starttime: datetime.datetime
+        :param starttime: start of the period
+        :type endtime: datetime.datetime
+        :param endtime: end of the period
+        :type ID: str
+        :param ID: seed ID (may contain wildcards) of the traces
+
+        :rtype: list
+        :return: sorted names of the files that contain traces of `ID`
+            overlapping the period
+        """
+        dpattern, pattern = os.path.split(fpattern)
+        if glob.has_magic(dpattern):
+            dirs = glob.glob(dpattern)
+        else:
+            dirs = [dpattern]
+        for directory in dirs:
+            self._refresh(directory)
+        dirs = set(dirs)
+        start = UTCDateTime(starttime).timestamp
+        end = UTCDateTime(endtime).timestamp
+        # the GLOB of SQLite also matches path separators, the files are
+        # matched exactly as by glob afterwards
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT path FROM traces '
+                            'WHERE seed_id GLOB ? AND starttime < ? AND '
+                            'endtime > ? AND path GLOB ?',
+                            (ID,end,start,fpattern)).fetchall()
+        res = []
+        for (fname,) in rows:
+            directory, name = os.path.split(fname)
+            if (directory in dirs) and fnmatch.fnmatch(name,pattern) and \
+                    (pattern.startswith('.') or not name.startswith('.')):
+                res.append(fname)
+        return sorted(res)
+
+    def close(self):
+        """Close the database
+        """
+        with self.lock:
+            self.conn.close()
+
+
+class WaveformCache(object):
+    """Memory bounded least recently used cache of waveform data
+
+    The data of every seed ID (pattern) are read with `read` and kept in
+    memory as they were read. A request for a period that is contained in
+    the cached data is served from memory. If only the end of the period is
+    missing only the missing data following the cached ones are read and
+    appended. As reads are expected to proceed in time the cached data
+    before the start of the last request are discarded. If the cached data
+    exceed `max_bytes` the least recently used seed IDs are removed.
+
+    The requested period of all seed IDs requested together by
+    :meth:`get_many` is prepared by a single call of `prepare` (e.g. checked
+    and decimated). As the raw data of the whole period are prepared the
+    result does not depend on which part of it was cached (no filter
+    transients at the end of the cached data).
+
+    The numbers of hits, partial hits (only the end read), misses and
+    evictions are counted in :attr:`counters`.
+
+    :type read: function
+    :param read: function `read(ID, starttime, endtime)` returning a
+        :class:`~obspy.core.stream.Stream` with at least the data of `ID`
+        between the `datetime.datetime` objects `starttime` and `endtime`
+    :type max_bytes: int
+    :param max_bytes: size of the cached data in bytes (unlimited if None)
+    :type prepare: function
+    :param prepare: function `prepare(st)` returning the stream that is
+        returned for the data `st` of one or several seed IDs in the
+        requested period
+    """
+    def __init__(self, read, max_bytes=None, prepare=None):
+        self.read = read
+        self.max_bytes = max_bytes
+        self.prepare = prepare
+        self.entries = OrderedDict()
+        self.reset_counters()
+
+    def reset_counters(self):
+        """Set the numbers of hits, misses and evictions to zero
+        """
+        self.counters = {'hits':0,'partial':0,'misses':0,'evictions':0}
+
+    def nbytes(self):
+        """Size of the cached data in bytes
+        """
+        return sum([tr.data.nbytes for st in self.entries.values()
+                    for tr in st])
+
+    def get(self, ID, starttime, endtime):
+        """Return the data of `ID` between `starttime` and `endtime`
+
+        :rtype: :class:`~obspy.core.stream.Stream`
+        :return: prepared copy of the data in the requested period
+        """
+        return self.get_many([ID],starttime,endtime)[0]
+
+    def get_many(self, IDs, starttime, endtime):
+        """Return the data of several seed IDs between `starttime` and
+        `endtime`
+
+        :rtype: list
+        :return: prepared copies of the data of the seed IDs in `IDs` in
+            the requested period
+        """
+        start = UTCDateTime(starttime)
+        end = UTCDateTime(endtime)
+        # read the missing data of all seed IDs
+        cached = []
+        for ID in IDs:
+            st = self.entries.pop(ID,None)
+            fstart = start
+            if st:
+                cstart = min([tr.stats.starttime for tr in st])
+                cend = max([tr.stats.endtime for tr in st])
+                if (cstart <= start) and (cend >= end):
+                    self.counters['hits'] += 1
+                    fstart = None
+                elif (cstart <= start) and (cend > start):
+                    self.counters['partial'] += 1
+                    # start the new data on the next sample of the cached ones
+                    fstart = cend + st[0].stats.delta
+                else:
+                    st = None
+            if not st:
+                self.counters['misses'] += 1
+                st = Stream()
+            if fstart is not None:
+                st += self.read(ID,fstart.datetime,end.datetime).trim(
+                                                            starttime=fstart)
+                st.merge()
+            cached.append((ID,st))
+        window = Stream()
+        for ID, st in cached:
+            if not st:
+                continue
+            # data before the requested period are not needed any more
+            for tr in st:
+                if tr.stats.starttime < start:
+                    tr.trim(starttime=start)
+                    tr.data = tr.data.copy()
+            self.entries[ID] = st
+            window += st.slice(starttime=start,endtime=end).copy()
+        self._evict()
+        if (self.prepare is not None) and (len(window) > 0):
+            window = self.prepare(window)
+        return [window.select(id=ID) for ID, st in cached]
+
+    def _evict(self):
+        """Remove least recently used data until the size is within limits
+
+        The data of the last request are always kept.
+        """
+        if self.max_bytes is None:
+            return
+        while (len(self.entries) > 1) and (self.nbytes() > self.max_bytes):
+            self.entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+
+def read_from_filesystem(ID,starttime,endtime,fs,trim=True,index=None):
     """Function to read data from a filesystem with a give file structure
     just by specifying ID and time interval.
 
@@ -927,6 +1339,8 @@ def read_from_filesystem(ID,starttime,endtime,fs,trim=True):
     :type fs: list
     :param trim: switch for trimming of the stream
     :type trim: bool
+    :param index: index of the waveform files
+    :type index: :class:`WaveformIndex` or str (file name of the index)
 
     :rtype: `obspy.stream`
     :return: data stream of requested data
@@ -934,6 +1348,11 @@ def read_from_filesystem(ID,starttime,endtime,fs,trim=True):
     If the switch for trimming is False the whole stream in the files is
     returned.
 
+    If an `index` is given the files containing the requested period are
+    found by a query of the :class:`WaveformIndex` and only these files are
+    opened. Otherwise the headers of all files matching the file structure
+    are read.
+
     **File structure descriptor**
     fs is a list of strings or other lists indicating the elements in the
     file structure. Each item of this list is translated in one level of the
@@ -980,21 +1399,23 @@ def read_from_filesystem(ID,starttime,endtime,fs,trim=True):
     assert type(endtime) is datetime.datetime, \
         'endtime is not a datetime.datetime object: %s is type' % \
         (endtime, type(endtime))
+    if isinstance(index,basestring):
+        index = WaveformIndex(index)
     # translate file structure string
     fpattern = _current_filepattern(ID,starttime,fs)
-    st = _read_filepattern(fpattern, starttime, endtime,trim)
+    st = _read_filepattern(fpattern, starttime, endtime,trim,index,ID)
 
     # if trace starts too late have a look in the previous section
     if (len(st)==0) or ((st[0].stats.starttime-st[0].stats.delta).datetime > starttime):
         fpattern, _ = _adjacent_filepattern(ID,starttime,fs,-1)
-        st += _read_filepattern(fpattern, starttime, endtime,trim)
+        st += _read_filepattern(fpattern, starttime, endtime,trim,index,ID)
         st.merge()
     thistime = starttime
     while ((len(st)==0) or (st[0].stats.endtime.datetime < endtime)) & (thistime < endtime):
         fpattern, thistime = _adjacent_filepattern(ID,thistime,fs,1)
         if thistime == starttime:
             break
-        st += _read_filepattern(fpattern, starttime, endtime,trim)
+        st += _read_filepattern(fpattern, starttime, endtime,trim,index,ID)
         st.merge()
     if trim:
         st.trim(starttime=UTCDateTime(starttime),endtime=UTCDateTime(endtime))
@@ -1002,25 +1423,29 @@ def read_from_filesystem(ID,starttime,endtime,fs,trim=True):
     return st
 
 
-def _read_filepattern(fpattern, starttime, endtime, trim):
+def _read_filepattern(fpattern, starttime, endtime, trim, index=None, ID='*'):
     """Read a stream from files whose names match a given pattern.
+
+    With a :class:`WaveformIndex` the files containing data of `ID` in the
+    period are taken from the index.
     """
-    flist = glob.glob(fpattern)
-    starttimes = []
-    endtimes = []
-    # first only read the header information
-    for fname in flist:
-        st = read(fname,headonly=True)
-        starttimes.append(st[0].stats.starttime.datetime)
-        endtimes.append(st[-1].stats.endtime.datetime)
+    if index is not None:
+        flist = index.files(fpattern,starttime,endtime,ID)
+    else:
+        flist = []
+        # first only read the header information
+        for fname in glob.glob(fpattern):
+            st = read(fname,headonly=True)
+            if (st[0].stats.starttime.datetime < endtime) and \
+                    (st[-1].stats.endtime.datetime > starttime):
+                flist.append(fname)
     # now read the stream from the files that contain the period
     st = Stream()
-    for ind,fname in enumerate(flist):
-        if (starttimes[ind] < endtime) and (endtimes[ind] > starttime):
-            if trim:
-                st += read(fname,starttime=UTCDateTime(starttime),endtime=UTCDateTime(endtime))
-            else:
-                st += read(fname)
+    for fname in flist:
+        if trim:
+            st += read(fname,starttime=UTCDateTime(starttime),endtime=UTCDateTime(endtime))
+        else:
+            st += read(fname)
     try:
         st.merge()
     except:
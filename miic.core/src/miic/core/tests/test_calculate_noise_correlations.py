@@ -0,0 +1,237 @@
+import imp
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core import Stats
+
+pytest.importorskip('mpi4py')
+pytest.importorskip('yaml')
+cnc = imp.load_source('calculate_noise_correlations',
+                      os.path.join(os.path.dirname(__file__),os.pardir,
+                                   os.pardir,'scripts',
+                                   'calculate_noise_correlations.py'))
+
+
+def _write(fname, text):
+    with open(fname,'w') as fh:
+        fh.write(text)
+
+
+def _corr_traces(ntimes, stations=('S1','S2')):
+    st = Stream()
+    for ii in range(ntimes):
+        tr = Trace(data=np.cos(np.arange(11.)*(ii+1)/5.+len(stations[1])))
+        tr.stats['network'] = 'XX-XX'
+        tr.stats['station'] = '-'.join(stations)
+        tr.stats['location'] = '-'
+        tr.stats['channel'] = 'HHZ-HHZ'
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['starttime'] = UTCDateTime(1971,1,1) - 0.5
+        for name, station in zip(['stats_tr1','stats_tr2'],stations):
+            setattr(tr,name,Stats({'network':'XX','station':station,
+                                   'channel':'HHZ','sampling_rate':10.,
+                                   'npts':36000,
+                                   'starttime':UTCDateTime(2015,1,1) +
+                                   ii*3600}))
+        st.append(tr)
+    return st
+
+
+def test_complete_read():
+    base_dir = tempfile.mkdtemp()
+    try:
+        pathname = os.path.join(base_dir,'2015')
+        os.makedirs(pathname)
+        _write(os.path.join(pathname,'old.mat'),'old')
+        _write(os.path.join(pathname,'kept.mat'),'kept')
+        manifest = cnc._RunManifest(os.path.join(base_dir,'manifest.json'))
+        manifest.start('2015-01-01')
+        before = cnc._file_state(pathname)
+        _write(os.path.join(pathname,'old.mat'),'changed')
+        _write(os.path.join(pathname,'new.mat'),'new')
+        cnc._complete_read(manifest,'2015-01-01',pathname,before)
+        # only the files written during the read are recorded
+        files = manifest.reads['2015-01-01']['files']
+        assert sorted(files.keys()) == [os.path.join('2015','new.mat'),
+                                        os.path.join('2015','old.mat')], \
+            'recorded files do not match'
+        assert files[os.path.join('2015','new.mat')]['size'] == 3, \
+            'recorded size does not match'
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_run_manifest():
+    base_dir = tempfile.mkdtemp()
+    try:
+        mname = os.path.join(base_dir,'manifest.json')
+        fname = os.path.join(base_dir,'a.mat')
+        _write(fname,'abc')
+        manifest = cnc._RunManifest(mname)
+        manifest.start('day1')
+        manifest.complete('day1',[fname])
+        manifest.start('day2')
+        # the manifest is read again when resuming
+        manifest = cnc._RunManifest(mname)
+        assert manifest.reads['day2']['status'] == 'started', \
+            'started read is not recorded'
+        assert manifest.completed() == ['day1'], 'completed reads do not match'
+        # a change of the content is only found by the checksum
+        _write(fname,'abd')
+        assert manifest.completed() == ['day1'], 'size is not compared'
+        assert manifest.completed(verify=True) == [], \
+            'checksum is not compared'
+        _write(fname,'abcd')
+        assert manifest.completed() == [], 'size is not compared'
+        os.remove(fname)
+        assert manifest.completed() == [], 'missing file is not found'
+        assert not os.path.exists(mname + '.tmp'), \
+            'temporary manifest is left'
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_run_manifest_store():
+    pytest.importorskip('h5py')
+    base_dir = tempfile.mkdtemp()
+    try:
+        st = _corr_traces(4)
+        fname = cnc.corr_store_name(base_dir,0)
+        store = cnc.CorrelationStore(fname)
+        store.append(st)
+        par = {'co':{'read_inc':86400}}
+        sttime = UTCDateTime(2015,1,1).datetime
+        state = cnc._store_state(store,sttime,par)
+        # the recorded checksums match the checksums of the data
+        assert state['rows'] == 4, 'number of rows does not match'
+        assert store.digest(state['starttime'],state['endtime'],
+                            recompute=True)[1] == state['sha1'], \
+            'recorded checksums do not match the data'
+        # rows of other reads do not change the state of the read
+        nst = _corr_traces(1)
+        nst[0].stats_tr1['starttime'] += 86400
+        store.append(nst)
+        assert cnc._store_state(store,sttime,par) == state, \
+            'state depends on other reads'
+        store.close()
+        manifest = cnc._RunManifest(os.path.join(base_dir,'manifest.json'))
+        manifest.complete('day1',[],[state])
+        assert manifest.completed(verify=True) == ['day1'], \
+            'store is not valid'
+        # data changed in place are only found when verifying
+        store = cnc.CorrelationStore(fname)
+        store.h5[st[0].id]['corr_data'][1,:] = 0.
+        store.close()
+        assert manifest.completed() == ['day1'], 'number of rows is not used'
+        assert manifest.completed(verify=True) == [], \
+            'changed data are not found'
+        os.remove(fname)
+        assert manifest.completed() == [], 'missing store is not found'
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def _read(sttime):
+    if sttime == 2:
+        raise ValueError('unreadable')
+    return Stream([Trace(data=np.ones(3)*sttime)])
+
+
+def test_read_ahead_exception():
+    for depth in [0,2]:
+        res = []
+        with pytest.raises(ValueError):
+            for sttime, st in cnc._read_ahead(_read,[0,1,2,3],depth):
+                res.append(sttime)
+        # the reads before the failing one are processed
+        assert res == [0,1], 'reads before the exception do not match'
+
+
+def test_background_writer_exception():
+    import logging
+
+    def _fail():
+        raise IOError('disk full')
+    done = []
+    writer = cnc._BackgroundWriter(logging.getLogger('test'))
+    writer.submit('first',done.append,1)
+    writer.submit('failing',_fail)
+    writer.submit('skipped',done.append,2)
+    with pytest.raises(IOError):
+        writer.wait()
+    # the functions after the failing one are skipped and the exception is
+    # raised again
+    assert done == [1], 'functions after the exception are executed'
+    with pytest.raises(IOError):
+        writer.submit('later',done.append,3)
+    with pytest.raises(IOError):
+        writer.close()
+    assert not writer.thread.is_alive(), 'writer thread is not joined'
+
+
+def test_background_writer_close_on_error():
+    import logging
+    import time
+    done = []
+
+    def _slow(ii):
+        time.sleep(0.05)
+        done.append(ii)
+    writer = cnc._BackgroundWriter(logging.getLogger('test'))
+    for ii in range(3):
+        writer.submit('slow %d' % ii,_slow,ii)
+    # an error of the main loop flushes the writer before it is raised
+    writer.close(reraise=False)
+    assert done == [0,1,2], 'submitted functions are not written'
+    assert not writer.thread.is_alive(), 'writer thread is not joined'
+
+
+def test_save_subdivisions():
+    base_dir = tempfile.mkdtemp()
+    try:
+        subdivision = {'recombine_subdivision':True,
+                       'delete_subdivisions':False}
+        # correlations of two combinations for four subdivisions in the
+        # order in which they are computed
+        combs = [_corr_traces(4,('S1','S2')),_corr_traces(4,('S1','S33'))]
+        subs = [Stream([comb[ii] for comb in combs]) for ii in range(4)]
+        # in memory: the traces are collected per combination as in paracorr
+        mem_dir = os.path.join(base_dir,'memory')
+        os.makedirs(mem_dir)
+        sub_corr = {}
+        for rcst in subs:
+            for tr in rcst:
+                if tr.id not in sub_corr.keys():
+                    sub_corr[tr.id] = Stream()
+                sub_corr[tr.id].append(tr.copy())
+        for trid in sorted(sub_corr.keys()):
+            cnc._save_subdivisions(sub_corr[trid],mem_dir,subdivision)
+        # baseline: one file per trace combined afterwards
+        file_dir = os.path.join(base_dir,'files')
+        os.makedirs(file_dir)
+        for rcst in subs:
+            cnc.convert_to_matlab(rcst.copy(),'trace',file_dir)
+        cnc._combine_subdivisions(file_dir,subdivision)
+        fnames = sorted(os.listdir(file_dir))
+        assert fnames == sorted(os.listdir(mem_dir)), \
+            'names of the files do not match'
+        assert len(fnames) == 4, 'number of files does not match'
+        for fname in fnames:
+            ref = cnc.mat_to_ndarray(os.path.join(file_dir,fname))
+            res = cnc.mat_to_ndarray(os.path.join(mem_dir,fname))
+            key = 'corr_data' if fname.startswith('mat__') else 'corr_trace'
+            assert np.allclose(res[key],ref[key],atol=1e-12), \
+                'stacked correlations do not match'
+            if key == 'corr_data':
+                assert list(res['time']) == list(ref['time']), \
+                    'times do not match'
+            for skey in ['network','station','location','channel',
+                         'sampling_rate','npts','starttime']:
+                assert res['stats'][skey] == ref['stats'][skey], \
+                    'stats do not match'
+    finally:
+        shutil.rmtree(base_dir)
@@ -0,0 +1,127 @@
+import glob
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core import Stats
+
+import miic.core.corr_mat_processing as cmp
+from miic.core.miic_utils import convert_to_matlab, mat_to_ndarray
+
+
+def _corr_traces(ntimes):
+    """Correlation traces of one combination for subsequent hours
+    """
+    st = Stream()
+    for ii in range(ntimes):
+        tr = Trace(data=np.sin(np.arange(21.)*(ii+1)/7.))
+        tr.stats['network'] = 'XX-XX'
+        tr.stats['station'] = 'S1-S2'
+        tr.stats['location'] = '-'
+        tr.stats['channel'] = 'HHZ-HHZ'
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['starttime'] = UTCDateTime(1971,1,1) - 1.
+        for name, station in [('stats_tr1','S1'),('stats_tr2','S2')]:
+            stats = Stats({'network':'XX','station':station,'location':'',
+                           'channel':'HHZ','sampling_rate':10.,'npts':36000,
+                           'starttime':UTCDateTime(2015,1,1)+ii*3600})
+            setattr(tr,name,stats)
+        st.append(tr)
+    return st
+
+
+def test_correlation_store():
+    pytest.importorskip('h5py')
+    base_dir = tempfile.mkdtemp()
+    try:
+        st = _corr_traces(6)
+        ID = st[0].id
+        # the traces are written alternately by two processes
+        fnames = [cmp.corr_store_name(base_dir,rank) for rank in [0,1]]
+        for rank, fname in enumerate(fnames):
+            store = cmp.CorrelationStore(fname,chunk_rows=2)
+            store.append(Stream(st[rank::2]))
+            # writing a trace again replaces its row
+            store.append(Stream(st[rank:rank+1]))
+            store.close()
+        mat = cmp.corr_mat_from_stores(fnames,ID)
+        # reference from the files of the traces
+        trace_dir = os.path.join(base_dir,'traces')
+        os.makedirs(trace_dir)
+        convert_to_matlab(st.copy(),'trace',trace_dir)
+        cmp.corr_mat_create_from_traces(trace_dir,trace_dir)
+        ref = mat_to_ndarray(glob.glob(os.path.join(trace_dir,'mat_*'))[0])
+        assert mat['corr_data'].shape == (6,21), 'shape does not match'
+        assert np.allclose(mat['corr_data'],
+                           np.reshape(ref['corr_data'],(6,21)),atol=1e-12), \
+            'correlation data do not match'
+        assert [UTCDateTime(tt) for tt in mat['time']] == \
+            [UTCDateTime(tt) for tt in ref['time']], 'times do not match'
+        for key in ['sampling_rate','npts','network','station','channel']:
+            assert mat['stats'][key] == ref['stats'][key], \
+                'stats do not match'
+        assert UTCDateTime(mat['stats']['starttime']) == \
+            UTCDateTime(ref['stats']['starttime']), 'start time does not match'
+        # slicing of a time range
+        mat = cmp.corr_mat_from_stores(fnames,ID,
+                                       UTCDateTime(2015,1,1,1),
+                                       UTCDateTime(2015,1,1,4))
+        assert np.allclose(mat['corr_data'],
+                           np.array([tr.data for tr in st[1:4]]),atol=1e-12), \
+            'sliced correlation data do not match'
+        store = cmp.CorrelationStore(fnames[0],mode='r')
+        assert store.combinations() == [ID], 'combinations do not match'
+        assert store.digest(UTCDateTime(2015,1,1),
+                            UTCDateTime(2015,1,2))[0] == 3, \
+            'number of rows does not match'
+        store.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def test_correlation_store_growth_and_order():
+    pytest.importorskip('h5py')
+    base_dir = tempfile.mkdtemp()
+    try:
+        st = _corr_traces(5)
+        ID = st[0].id
+        fname = cmp.corr_store_name(base_dir,0)
+        store = cmp.CorrelationStore(fname,chunk_rows=4)
+        store.append(Stream(st[:3]))
+        # the datasets grow in steps of a chunk
+        assert store.h5[ID]['corr_data'].shape[0] == 4, \
+            'datasets do not grow by chunks'
+        store.append(Stream(st[3:]))
+        assert store.h5[ID]['corr_data'].shape[0] == 8, \
+            'datasets do not grow by chunks'
+        assert store.h5[ID].attrs['nrows'] == 5, 'number of rows does not match'
+        # a mismatching trace is rejected without writing any of the traces
+        tr = st[0].copy()
+        tr.data = tr.data[:10]
+        with pytest.raises(cmp.InputError):
+            store.append(Stream([st[1].copy(),tr]))
+        store.close()
+        store = cmp.CorrelationStore(fname,mode='r')
+        times, data = store.read(ID)
+        store.close()
+        assert len(times) == 5, 'number of rows does not match'
+        assert np.allclose(data,np.array([tr.data for tr in st])), \
+            'data do not match'
+        # a store written later wins independent of the order of the stores
+        later = cmp.corr_store_name(base_dir,'later')
+        store = cmp.CorrelationStore(later)
+        nst = Stream(st[1:2]).copy()
+        nst[0].data = nst[0].data*2.
+        store.append(nst)
+        store.close()
+        for fnames in [[fname,later],[later,fname]]:
+            mat = cmp.corr_mat_from_stores(fnames,ID)
+            assert np.allclose(mat['corr_data'][1],st[1].data*2.), \
+                'rows of the later store are not used'
+            assert np.allclose(mat['corr_data'][0],st[0].data), \
+                'rows of the earlier store are not used'
+    finally:
+        shutil.rmtree(base_dir)
@@ -1,5 +1,6 @@
 import miic.core.pxcorr_func as px
 import numpy as np
+import pytest
 
 def test_spectral_whitening():
     A = [[1,2,3,5,4,5,6,6,7,4],
@@ -29,3 +30,811 @@ def test_spectral_whitening():
     assert np.allclose(amp,np.absolute(Bw),atol=1e-12), 'amplitude does not match'
 
 	
+
+
+def test_pxcorr_block():
+    # pseudo random spectra
+    A = np.sin(np.outer(np.arange(64),np.arange(1,5))**1.3)
+    B = np.fft.rfft(A,axis=0)
+    freqs = px.rfftfreq(64,1./10)
+    combis = np.array([(0,1),(1,2),(3,3),(2,0)])
+    reltime = np.array([0.,0.13,-0.21,0.07])
+    kwargs = {'sampling_rate':10.,'center_correlation':False,
+              'normalize_correlation':True}
+    P = px._phase_ramp(B.copy(),freqs,reltime)
+    energy = px._trace_energy(P,np.arange(4))
+    C, starttimes = px._pxcorr_block(P,energy,combis,reltime,5,kwargs)
+    assert C.shape == (11,4), 'shape of correlations does not match'
+    for jj, (ii, kk) in enumerate(combis):
+        offset = reltime[ii] - reltime[kk]
+        roffset = np.fix(offset*10.)/10.
+        M = (B[:,ii].conj()*B[:,kk]*np.exp(1j*freqs*(offset-roffset)*2*np.pi))
+        tmp = np.fft.irfft(M)
+        norm = (np.sqrt(2.*np.sum(np.abs(B[:,ii])**2) - B[0,ii]**2) *
+                np.sqrt(2.*np.sum(np.abs(B[:,kk])**2) - B[0,kk]**2)/64.).real
+        ref = np.concatenate((tmp[-5:],tmp[:6]))/norm
+        assert np.allclose(C[:,jj],ref,atol=1e-12), 'correlation does not match'
+        assert np.allclose(starttimes[jj],
+                           float(px.zerotime) - 0.5 - roffset), \
+                           'start time does not match'
+
+
+def test_stream_pxcorr_local_threads():
+    from obspy import Stream, Trace
+    st = Stream()
+    for ii in range(5):
+        tr = Trace(data=np.sin(np.arange(500.)**(1.+ii/10.)))
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+        st.append(tr)
+    options = {'TDpreProcessing':[{'function':px.clip,
+                                   'args':{'std_factor':2}}],
+               'FDpreProcessing':[{'function':px.spectralWhitening,
+                                   'args':{}}],
+               'lengthToSave':2,
+               'center_correlation':True,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allSimpleCombinations')}
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    options.update({'executor':'threads','threads':3,'block_size':2})
+    tcst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    assert len(cst) == len(tcst) == 15, 'number of correlations does not match'
+    for tr, ttr in zip(cst,tcst):
+        assert np.allclose(tr.data,ttr.data,atol=1e-12), \
+            'correlation does not match'
+
+
+
+def test_stream_pxcorr_shared_executor():
+    from obspy import Stream, Trace
+    st = Stream()
+    for ii in range(4):
+        tr = Trace(data=np.sin(np.arange(500.)**(1.+ii/10.)))
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+        st.append(tr)
+    options = {'TDpreProcessing':[],
+               'FDpreProcessing':[],
+               'lengthToSave':2,
+               'center_correlation':True,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allSimpleCombinations')}
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    # an executor of the caller is used by several calls and not closed
+    executor = px.ThreadExecutor(2)
+    options.update({'executor':executor,'block_size':2})
+    try:
+        for _ in range(2):
+            tcst = px.stream_pxcorr(st.copy(),dict(options),
+                                    comm=px.LocalComm())
+            assert len(tcst) == len(cst), \
+                'number of correlations does not match'
+            for tr, ttr in zip(cst,tcst):
+                assert np.allclose(tr.data,ttr.data,atol=1e-12), \
+                    'correlation does not match'
+        assert list(executor.imap(len,['ab','c'])) == [2,1], \
+            'executor of the caller is closed'
+    finally:
+        executor.close()
+
+def test_zero_padding_fast_length():
+    params = {'sampling_rate':100.,'lengthToSave':20.}
+    A = np.ones((360001,2))
+    P = px.zeroPadding(A.copy(),{'type':'avoidWrapFastLength'},params)
+    Q = px.zeroPadding(A.copy(),{'type':'avoidWrapPowerTwo'},params)
+    assert P.shape[0] >= 362001, 'padding does not avoid wrap around'
+    assert P.shape[0] % 2 == 0, 'padded length is not even'
+    assert P.shape[0] < Q.shape[0], 'padded length is not reduced'
+    assert np.all(P[:360001] == 1.) and np.all(P[360001:] == 0.), \
+        'padded data does not match'
+    # the backends agree for the padded length
+    B = np.fft.rfft(P,axis=0)
+    for fft in ['numpy','scipy','fftw']:
+        try:
+            backend = px.get_fft({'fft':fft})
+        except ImportError:
+            continue
+        assert np.allclose(backend.rfft(P),B,atol=1e-6), \
+            'spectrum of %s backend does not match' % fft
+        assert np.allclose(backend.irfft(B,P.shape[0]),P,atol=1e-9), \
+            'inverse transform of %s backend does not match' % fft
+
+
+def test_stream_pxcorr_single_precision():
+    from obspy import Stream, Trace
+    st = Stream()
+    for ii in range(4):
+        tr = Trace(data=np.sin(np.arange(600.)**(1.+ii/10.)))
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+        st.append(tr)
+    options = {'TDpreProcessing':[{'function':px.clip,
+                                   'args':{'std_factor':2}}],
+               'FDpreProcessing':[{'function':px.spectralWhitening,
+                                   'args':{}}],
+               'lengthToSave':3,
+               'center_correlation':True,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allSimpleCombinations')}
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    options.update({'dtype':'float32'})
+    scst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    assert len(cst) == len(scst) == 10, 'number of correlations does not match'
+    for tr, str_ in zip(cst,scst):
+        assert str_.data.dtype == np.float32, 'correlation is not float32'
+        assert np.max(np.abs(tr.data - str_.data)) < 1e-5, \
+            'single precision correlation deviates too much'
+
+
+def test_subdivision_windows():
+    from obspy import Stream, Trace
+    from obspy.core import UTCDateTime
+    t0 = UTCDateTime(2015,1,1)
+    st = Stream()
+    st.append(Trace(data=np.arange(100.)))
+    data = np.ma.masked_array(np.arange(60.) + 1000.,
+                              mask=np.arange(60) >= 55)
+    st.append(Trace(data=data))
+    for ii, tr in enumerate(st):
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+    st[0].stats['starttime'] = t0
+    st[1].stats['starttime'] = t0 + 0.02
+    windows = px.SubdivisionWindows(st,t0,3.,2.,4)
+    sst = windows.stream(1)
+    assert len(sst) == 2, 'number of traces does not match'
+    assert np.all(sst[0].data == np.arange(20.,51.)), 'data does not match'
+    assert np.may_share_memory(sst[0].data,windows.data), 'data is copied'
+    assert abs((sst[0].stats['starttime'] - t0) - 2.) < 1e-6, \
+        'start time does not match'
+    assert abs((sst[1].stats['starttime'] - t0) - 2.02) < 1e-6, \
+        'start time does not match'
+    assert np.all(sst[1].data == np.arange(20.,51.) + 1000.), \
+        'data does not match'
+    # gap and end of the second trace are masked
+    sst = windows.stream(2)
+    assert np.all(sst[1].data[:15] == np.arange(40.,55.) + 1000.), \
+        'data does not match'
+    assert np.all(np.ma.getmaskarray(sst[1].data) == (np.arange(31) >= 15)), \
+        'gap mask does not match'
+    # the second trace has no data in the last subdivision
+    sst = windows.stream(3)
+    assert len(sst) == 1, 'trace without data is not omitted'
+    assert sst[0].stats['station'] == 'S0', 'wrong trace omitted'
+
+
+_processed = []
+
+def _count_traces(A,args,params):
+    _processed.append(A.shape[1])
+    return A
+
+
+def test_stream_pxcorr_spectrum_cache():
+    import shutil
+    import tempfile
+    from obspy import Stream, Trace
+    st = Stream()
+    for ii in range(4):
+        tr = Trace(data=np.sin(np.arange(400.)**(1.+ii/10.)))
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+        st.append(tr)
+    options = {'TDpreProcessing':[{'function':_count_traces,'args':{}}],
+               'FDpreProcessing':[{'function':px.spectralWhitening,
+                                   'args':{}}],
+               'lengthToSave':2,
+               'center_correlation':True,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allSimpleCombinations')}
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    cache_dir = tempfile.mkdtemp()
+    try:
+        options.update({'spectrum_cache':cache_dir})
+        del _processed[:]
+        ccst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+        assert sum(_processed) == 4, 'spectra are not processed'
+        assert len(px.SpectrumCache(cache_dir).files()) == 4, \
+            'spectra are not cached'
+        # a different combination list reuses the cached spectra
+        del _processed[:]
+        options.update({'combinations':[(0,3),(1,2)]})
+        rcst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+        assert sum(_processed) == 0, 'cached spectra are processed again'
+        for tr, ctr in zip(cst,ccst):
+            assert np.allclose(tr.data,ctr.data,atol=1e-12), \
+                'correlation does not match'
+        assert np.allclose(rcst[0].data,cst[3].data,atol=1e-12), \
+            'correlation from cached spectra does not match'
+        # eviction of the least recently used spectra
+        cache = px.SpectrumCache(cache_dir)
+        cache.evict(cache.files()[0][1])
+        assert len(cache.files()) == 1, 'cache is not evicted'
+        cache.purge()
+        assert len(cache.files()) == 0, 'cache is not purged'
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_spectrum_cache_eviction():
+    import shutil
+    import tempfile
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = px.SpectrumCache(cache_dir)
+        cache.put('a',np.zeros(100))
+        fsize = cache.size()
+        cache = px.SpectrumCache(cache_dir,int(2.5*fsize))
+        for key in ['b','c']:
+            cache.put(key,np.zeros(100))
+        assert len(cache.files()) == 2, 'cache is not evicted on put'
+        assert cache.get('a') is None, 'least recently used spectrum is kept'
+        cache.put('c',np.ones(100))
+        assert len(cache.files()) == 2, 'replaced spectrum is counted twice'
+        assert cache._size == cache.size(), 'tracked size does not match'
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_td_normalization():
+    A = np.sin(np.outer(np.arange(500.),np.arange(1,4))**1.2) * \
+        np.linspace(1.,20.,500)[:,None]
+    for wlen in [1.,1.5]:
+        # reference implementation with a convolution per trace
+        B = A**2
+        window = np.ones(int(np.ceil(wlen*10.)))/np.ceil(wlen*10.)
+        for ind in range(B.shape[1]):
+            B[:,ind] = np.convolve(B[:,ind],window,mode='same')
+            B[:,ind] = np.convolve(B[::-1,ind],window,mode='same')[::-1]
+            B[:,ind] += np.max(B[:,ind])*1e-6
+        ref = A/np.sqrt(B)
+        N = px.TDnormalization(A.copy(),{'filter':False,'windowLength':wlen},
+                               {'sampling_rate':10.})
+        assert np.allclose(N,ref,atol=1e-10), 'normalization does not match'
+
+
+def test_detrend_linear():
+    t = np.arange(200.)
+    A = np.vstack((3. + 0.5*t, -2.*t + np.sin(t), 7. + 0.*t)).T
+    A[40:60,1] = np.nan
+    A[150:,2] = np.nan
+    A[199,2] = 5.
+    D = px.detrend(A.copy(),{'type':'linear','bp':[120]},{})
+    assert np.all(np.isnan(D) == np.isnan(A)), 'NaN samples do not match'
+    for ii in range(3):
+        for sl in [slice(0,120),slice(120,200)]:
+            valid = ~np.isnan(A[sl,ii])
+            tt = t[sl][valid]
+            if len(tt) > 1:
+                coef = np.polyfit(tt,A[sl,ii][valid],1)
+                ref = A[sl,ii][valid] - np.polyval(coef,tt)
+            else:
+                ref = A[sl,ii][valid] - np.mean(A[sl,ii][valid])
+            assert np.allclose(D[sl,ii][valid],ref,atol=1e-9), \
+                'detrended data does not match'
+
+
+def test_mute_and_clip():
+    A = np.sin(np.outer(np.arange(300.),np.arange(1,4))**1.1)
+    A[100:120,0] *= 10.
+    A[200:205,2] *= 8.
+    # reference implementation of clip with a loop over the traces
+    ref = A.copy()
+    stds = np.nanstd(ref,axis=0)
+    for ind in range(ref.shape[1]):
+        ref[ref[:,ind] > 2.*stds[ind],ind] = 2.*stds[ind]
+        ref[ref[:,ind] < -2.*stds[ind],ind] = -2.*stds[ind]
+    C = px.clip(A.copy(),{'std_factor':2.},{})
+    assert np.allclose(C,ref,atol=1e-12), 'clipped data does not match'
+    ntap = 8
+    for extend_gaps in [True, False]:
+        # reference implementation of mute with a loop over the traces
+        thres = np.std(A,axis=0)*2.
+        mask = np.ones_like(A)
+        mask[np.abs(A) > thres] = 0
+        if extend_gaps:
+            for ind in range(A.shape[1]):
+                mask[:,ind] = np.convolve(mask[:,ind],np.ones(ntap)/ntap,
+                                          mode='same')
+            nmask = np.ones_like(A)
+            nmask[mask < 1.] = 0
+        else:
+            nmask = mask
+        tap = 2. - (np.cos(np.arange(ntap,dtype=float)/ntap*2.*np.pi) + 1.)
+        tap /= ntap
+        for ind in range(A.shape[1]):
+            nmask[:,ind] = np.convolve(nmask[:,ind],tap,mode='same')
+        M = px.mute(A.copy(),{'taper_len':0.8,'std_factor':2.,
+                              'extend_gaps':extend_gaps},
+                    {'sampling_rate':10.})
+        assert np.allclose(M,A*nmask,atol=1e-12), 'muted data does not match'
+
+
+def test_fd_process_fused():
+    A = np.sin(np.outer(np.arange(200),np.arange(1,5))**1.3)
+    B = np.fft.rfft(A,axis=0)
+    freqs = px.rfftfreq(200,1./10)
+    params = {'freqs':freqs}
+    procs = [{'function':px.spectralWhitening,'args':{}},
+             {'function':px.FDfilter,'args':{'flimit':[0.5,1.,2.,2.5]}}]
+    ref = B.copy()
+    for proc in procs:
+        ref = proc['function'](ref,proc['args'],params)
+    Bf = px._fd_process(B.copy(),procs,params)
+    assert np.allclose(Bf,ref,atol=1e-12), 'fused spectra do not match'
+    band = px._fd_band(procs,freqs)
+    assert np.all(ref[:band.start] == 0) and np.all(ref[band.stop:] == 0), \
+        'spectra outside of the band are not zero'
+    assert px._fd_band(procs[:1],freqs) is None, 'whitened spectra are limited'
+    combis = np.array([(0,1),(1,2),(3,3),(2,0)])
+    reltime = np.zeros(4)
+    kwargs = {'sampling_rate':10.,'center_correlation':True,
+              'normalize_correlation':True}
+    energy = px._trace_energy(Bf,np.arange(4))
+    C, _ = px._pxcorr_block(Bf,energy,combis,reltime,20,kwargs)
+    Cb, _ = px._pxcorr_block(Bf,energy,combis,reltime,20,kwargs,band=band)
+    assert np.allclose(C,Cb,atol=1e-12), 'band limited correlation does not match'
+
+
+def test_pxcorr_block_zoom():
+    A = np.sin(np.outer(np.arange(256),np.arange(1,5))**1.3)
+    B = np.fft.rfft(A,axis=0)
+    freqs = px.rfftfreq(256,1./10)
+    procs = [{'function':px.spectralWhitening,'args':{}},
+             {'function':px.FDfilter,'args':{'flimit':[0.5,1.,2.,2.5]}}]
+    B = px._fd_process(B,procs,{'freqs':freqs})
+    band = px._fd_band(procs,freqs)
+    combis = np.array([(0,1),(1,2),(3,3),(2,0)])
+    reltime = np.array([0.,0.13,-0.21,0.57])
+    for center in [True,False]:
+        kwargs = {'sampling_rate':10.,'center_correlation':center,
+                  'normalize_correlation':True}
+        P = px._phase_ramp(B.copy(),freqs,reltime)
+        energy = px._trace_energy(P,np.arange(4))
+        C, st = px._pxcorr_block(P,energy,combis,reltime,15,kwargs,band=band)
+        kwargs['lag_transform'] = 'zoom'
+        Cz, stz = px._pxcorr_block(P,energy,combis,reltime,15,kwargs,
+                                   band=band)
+        assert np.allclose(C,Cz,atol=1e-12), 'zoom correlation does not match'
+        assert np.allclose(st,stz), 'start times do not match'
+    # the size of the kept matrices is limited
+    nbytes = px._zoom_nbytes(band,15,np.float64)
+    cache_bytes = px._ZOOM_CACHE_BYTES
+    px._ZOOM_CACHE_BYTES = 3*nbytes
+    try:
+        for irfftsize in range(64,70):
+            px._zoom_matrices(irfftsize,band,15,np.float64)
+        assert [key[0] for key in px._zoom_cache.keys()] == [67,68,69], \
+            'least recently used zoom matrices are not removed'
+    finally:
+        px._ZOOM_CACHE_BYTES = cache_bytes
+    cosm, sinm = px._zoom_matrices(256,band,15,np.float64)
+    assert cosm.shape == (31,band.stop-band.start), \
+        'shape of the zoom matrices does not match'
+    assert cosm.nbytes + sinm.nbytes == nbytes, 'size does not match'
+    # too large matrices fall back to the inverse FFT
+    max_bytes = px._ZOOM_MAX_BYTES
+    px._ZOOM_MAX_BYTES = nbytes - 1
+    px._zoom_cache.clear()
+    try:
+        Cf, _ = px._pxcorr_block(P,energy,combis,reltime,15,kwargs,band=band)
+        assert len(px._zoom_cache) == 0, 'too large zoom matrices are used'
+        assert np.allclose(C,Cf,atol=1e-12), 'correlation does not match'
+    finally:
+        px._ZOOM_MAX_BYTES = max_bytes
+
+
+def test_autocorr_block():
+    A = np.sin(np.outer(np.arange(128),np.arange(1,4))**1.3)
+    B = np.fft.rfft(A,axis=0)
+    freqs = px.rfftfreq(128,1./10)
+    combis = np.array([(0,0),(1,1),(2,2)])
+    reltime = np.array([0.,0.13,-0.21])
+    kwargs = {'sampling_rate':10.,'center_correlation':False,
+              'normalize_correlation':True}
+    energy = px._trace_energy(B,np.arange(3))
+    C, starttimes = px._pxcorr_block(B,energy,combis,reltime,7,kwargs)
+    tmp = np.fft.irfft(np.absolute(B)**2,axis=0) / (energy**2/128.)
+    ref = np.concatenate((tmp[-7:],tmp[:8]))
+    assert np.allclose(C,ref,atol=1e-12), 'auto-correlation does not match'
+    assert np.allclose(starttimes,float(px.zerotime) - 0.7), \
+        'start time does not match'
+    band = slice(5,40)
+    Bb = B.copy()
+    Bb[:band.start] = 0
+    Bb[band.stop:] = 0
+    kwargs['lag_transform'] = 'zoom'
+    Cz, _ = px._pxcorr_block(Bb,energy,combis,reltime,7,kwargs,band=band)
+    tmp = np.fft.irfft(np.absolute(Bb)**2,axis=0) / (energy**2/128.)
+    ref = np.concatenate((tmp[-7:],tmp[:8]))
+    assert np.allclose(Cz,ref,atol=1e-12), 'zoom auto-correlation does not match'
+
+
+def test_combination_schedule():
+    combis = np.array([(0,0),(0,1),(1,1),(0,2),(1,2),(2,2)])
+    kwargs = {}
+    ind = [px._combination_indices(combis,2,rank,kwargs) for rank in [0,1]]
+    assert np.all(np.concatenate(ind) == np.arange(6)), \
+        'combinations are not distributed completely'
+    cost = [np.sum(px._combination_cost(combis[tind])) for tind in ind]
+    assert cost == [2.,2.5], 'estimated cost is not balanced'
+    kwargs['schedule'] = 'dynamic'
+    assert np.all(px._combination_indices(combis,2,1,kwargs) ==
+                  np.arange(6)), 'dynamic schedule is restricted'
+    kwargs['block_size'] = 2
+    blocks = px._scheduled_blocks(combis,10,kwargs)
+    assert [list(bpos) for bpos in blocks] == [[1,3],[4],[0,2],[5]], \
+        'blocks do not match'
+    counter = px.WorkCounter(px.LocalComm())
+    executor = px.get_executor({'executor':'threads','threads':3})
+    results = list(px._map_blocks(executor,len,blocks,counter))
+    executor.close()
+    assert [res for _, res in results] == [2,1,2,1], 'results do not match'
+    assert counter.claim() == 9, 'claimed blocks do not match'
+
+
+def test_pack_stream():
+    from obspy import Stream, Trace
+    st = Stream()
+    st.append(Trace(data=np.arange(10,dtype=np.int32)))
+    st.append(Trace(data=np.ma.masked_greater(np.linspace(0.,1.,7),0.7)))
+    st.append(Trace(data=np.ones(5,dtype=np.float32)))
+    st.append(Trace(data=np.ma.masked_inside(np.arange(8,dtype=np.int32),2,3)))
+    for ii, tr in enumerate(st):
+        tr.stats['station'] = 'S%d' % ii
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['starttime'] += 1.2345678 + ii
+    table, gaps, buf = px._pack_stream(st)
+    assert len(buf) == 30, 'size of the buffer does not match'
+    assert buf.dtype == np.float64, 'dtype of the buffer does not match'
+    rst = px._unpack_stream(table,gaps,buf)
+    assert len(rst) == 4, 'number of traces does not match'
+    for tr, rtr in zip(st,rst):
+        for key in ['network','station','location','channel',
+                    'sampling_rate','starttime','npts']:
+            assert rtr.stats[key] == tr.stats[key], 'header does not match'
+        assert rtr.data.dtype == tr.data.dtype, 'dtype does not match'
+        assert np.all(rtr.data == tr.data), 'data do not match'
+    for ii in [1,3]:
+        assert np.all(rst[ii].data.mask == st[ii].data.mask), \
+            'mask does not match'
+        assert np.all(rst[ii].data.compressed() == st[ii].data.compressed()), \
+            'unmasked data do not match'
+    # traces of the same dtype keep it in the buffer
+    table, gaps, buf = px._pack_stream(st[3:])
+    assert buf.dtype == np.int32, 'dtype of the buffer does not match'
+    rtr = px._unpack_stream(table,gaps,buf)[0]
+    assert rtr.data.dtype == np.int32, 'dtype does not match'
+    assert np.all(np.ma.getmaskarray(rtr.data) == [0,0,1,1,0,0,0,0]), \
+        'mask does not match'
+    assert len(px.allgather_stream(px.LocalComm(),st)) == 4, \
+        'number of gathered traces does not match'
+
+
+def _mpiexec(script,nprocs=3):
+    """Run the python code `script` on `nprocs` MPI processes and return
+    the output
+    """
+    import os
+    import subprocess
+    import sys
+    env = dict(os.environ)
+    env.update({'OMPI_ALLOW_RUN_AS_ROOT':'1',
+                'OMPI_ALLOW_RUN_AS_ROOT_CONFIRM':'1',
+                'OMPI_MCA_rmaps_base_oversubscribe':'1',
+                'PYTHONPATH':os.path.dirname(os.path.dirname(
+                    os.path.dirname(os.path.dirname(
+                        os.path.abspath(__file__)))))})
+    return subprocess.check_output([_MPIEXEC,'-n',str(nprocs),
+                                    sys.executable,'-c',script],env=env)
+
+
+def _find_mpiexec():
+    from distutils.spawn import find_executable
+    return find_executable('mpiexec')
+
+
+_MPIEXEC = _find_mpiexec()
+mpi = pytest.mark.skipif((not px.BC_MPI) or (_MPIEXEC is None),
+                         reason='requires mpi4py and mpiexec')
+
+
+@mpi
+def test_allgather_stream_mpi():
+    script = '''
+import numpy as np
+from obspy import Stream, Trace
+from mpi4py import MPI
+import miic.core.pxcorr_func as px
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+def traces(rank):
+    st = Stream()
+    for ii in range(rank+1):
+        data = np.ma.masked_equal(np.arange(5+ii,dtype=np.int32)*(rank+1),
+                                  2*(rank+1))
+        tr = Trace(data=data)
+        tr.stats.station = 'S%d' % rank
+        tr.stats.channel = 'HH%d' % ii
+        tr.stats.starttime += 0.123456789*rank
+        st.append(tr)
+    return st
+rst = px.allgather_stream(comm,traces(rank))
+ref = traces(0) + traces(1) + traces(2)
+assert len(rst) == len(ref)
+for tr, rtr in zip(ref,rst):
+    assert rtr.id == tr.id
+    assert rtr.stats.starttime == tr.stats.starttime
+    assert rtr.data.dtype == np.int32
+    assert np.all(np.ma.getmaskarray(rtr.data) == np.ma.getmaskarray(tr.data))
+    assert np.all(rtr.data.compressed() == tr.data.compressed())
+# large blocks are used for the exchange of the samples
+parts = px._allgatherv(comm,np.arange(rank*3,dtype=np.float32))
+assert [len(part) for part in parts] == [0,12,24]
+assert np.all(parts[2].view(np.float32) == np.arange(6))
+print('ok')
+'''
+    assert _mpiexec(script).count(b'ok') == 3, 'gathered stream does not match'
+
+
+# stream and reference correlations of the MPI tests
+_PXCORR_MPI = '''
+import numpy as np
+from obspy import Stream, Trace
+from mpi4py import MPI
+import miic.core.pxcorr_func as px
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+psize = comm.Get_size()
+st = Stream()
+for ii in range(7):
+    tr = Trace(data=np.sin(np.arange(400.)**(1.+ii/10.)))
+    tr.stats.sampling_rate = 10.
+    tr.stats.station = 'S%d' % ii
+    tr.stats.starttime += 0.03*ii
+    st.append(tr)
+options = {'TDpreProcessing':[{'function':px.clip,
+                               'args':{'std_factor':2}}],
+           'FDpreProcessing':[{'function':px.spectralWhitening,
+                               'args':{}}],
+           'lengthToSave':2,
+           'center_correlation':False,
+           'normalize_correlation':True,
+           'combinations':px.calc_cross_combis(st,'allCombinations')}
+ref = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+def check(cst):
+    assert len(cst) == len(ref), 'number of correlations does not match'
+    for tr, rtr in zip(cst,ref):
+        assert tr.id == rtr.id, 'order does not match'
+        assert tr.stats.starttime == rtr.stats.starttime, \\
+            'start time does not match'
+        assert np.allclose(tr.data,rtr.data,atol=1e-12), \\
+            'correlation does not match'
+'''
+
+
+def _local_stream(ntrc=7):
+    from obspy import Stream, Trace
+    st = Stream()
+    for ii in range(ntrc):
+        tr = Trace(data=np.sin(np.arange(400.)**(1.+ii/10.)))
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['station'] = 'S%d' % ii
+        tr.stats['starttime'] += 0.03*ii
+        st.append(tr)
+    return st
+
+
+def test_pxcorr_grid_local():
+    assert [px._process_grid(psize) for psize in [1,4,6,7]] == \
+        [(1,1),(2,2),(2,3),(1,7)], 'process grid does not match'
+    # traces are distributed cyclically on the grid
+    assert list(px._trace_map(7,4,{'distribution':'grid',
+                                   'FDpreProcessing':[]})) == \
+        [0,1,2,3,0,1,2], 'trace map does not match'
+    st = _local_stream()
+    options = {'TDpreProcessing':[],
+               'FDpreProcessing':[{'function':px.spectralWhitening,
+                                   'args':{}}],
+               'lengthToSave':2,
+               'center_correlation':False,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allCombinations'),
+               'starttime':[tr.stats.starttime for tr in st],
+               'sampling_rate':10.}
+    A = np.array([tr.data for tr in st]).T
+    res = {}
+    for distribution in ['replicate','grid']:
+        kwargs = dict(options,distribution=distribution)
+        res[distribution] = px._pxcorr_spectra(px.LocalComm(),A,kwargs,
+                                               px.SerialExecutor())
+    B, freqs, cind, lcombis, lreltime = res['grid']
+    assert B.shape == (len(freqs),7), 'shape of the spectra does not match'
+    assert np.all(cind == np.arange(len(options['combinations']))), \
+        'combinations of the process do not match'
+    for rval, gval in zip(res['replicate'],res['grid']):
+        assert np.allclose(rval,gval), 'grid distribution does not match'
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    gcst = px.stream_pxcorr(st.copy(),dict(options,distribution='grid'),
+                            comm=px.LocalComm())
+    for tr, gtr in zip(cst,gcst):
+        assert np.allclose(tr.data,gtr.data,atol=1e-12), \
+            'correlation does not match'
+
+
+@mpi
+@pytest.mark.parametrize('nprocs',[3,4])
+def test_pxcorr_grid_mpi(nprocs):
+    script = _PXCORR_MPI + '''
+kwargs = dict(options,distribution='grid')
+cst = px.stream_pxcorr(st.copy(),dict(kwargs),comm=comm)
+if rank == 0:
+    check(cst)
+else:
+    # results are only gathered on rank 0
+    assert len(cst) == 0, 'correlations returned on other ranks'
+# every process only holds the spectra of its grid row and column
+A = np.array([tr.data for tr in st]).T
+kwargs.update({'starttime':[tr.stats.starttime for tr in st],
+               'sampling_rate':10.})
+B, freqs, cind, lcombis, lreltime = px._pxcorr_spectra(comm,A,kwargs,
+                                                       px.SerialExecutor())
+nrow, ncol = px._process_grid(psize)
+pmap = px._trace_map(7,psize,kwargs)
+assert B.shape[1] == (np.sum(pmap//ncol == rank//ncol) +
+                      np.sum(pmap%ncol == rank%ncol)), 'spectra do not match'
+ncombis = comm.allgather(len(cind))
+assert sum(ncombis) == len(options['combinations']), \\
+    'combinations are not distributed completely'
+print('ok')
+'''
+    out = _mpiexec(script,nprocs)
+    assert out.count('ok') == nprocs, out
+
+
+class _RankComm(px.LocalComm):
+    """Communicator of process `rank` of `size` processes without MPI
+    """
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+
+def test_local_trace_matrix():
+    st = _local_stream()
+    st[2].data = st[2].data[:300]
+    kwargs = {'FDpreProcessing':[]}
+    for rank in range(3):
+        A, pmap = px._local_trace_matrix(st,_RankComm(rank,3),kwargs)
+        assert list(pmap) == [0,0,0,1,1,2,2], 'trace map does not match'
+        ind = np.where(pmap == rank)[0]
+        # only the columns of the traces of this rank are filled
+        assert A.shape == (400,len(ind)), 'shape does not match'
+        for col, tind in enumerate(ind):
+            npts = st[tind].stats.npts
+            assert np.all(A[:npts,col] == st[tind].data), \
+                'data do not match'
+            assert np.all(A[npts:,col] == 0), 'data are not padded'
+
+
+@mpi
+def test_local_trace_matrix_mpi():
+    script = _PXCORR_MPI + '''
+A, pmap = px._local_trace_matrix(st,comm,{'FDpreProcessing':[]})
+ind = np.where(pmap == rank)[0]
+assert A.shape == (400,len(ind)), 'shape does not match'
+assert np.all(A == np.array([st[tind].data for tind in ind]).T), \\
+    'data do not match'
+assert sum(comm.allgather(A.shape[1])) == len(st), \\
+    'traces are not distributed completely'
+check(px.stream_pxcorr(st.copy(),dict(options),comm=comm))
+print('ok')
+'''
+    out = _mpiexec(script)
+    assert out.count('ok') == 3, out
+
+
+def test_node_shared_memory_local():
+    st = _local_stream()
+    options = {'TDpreProcessing':[],
+               'FDpreProcessing':[],
+               'lengthToSave':2,
+               'center_correlation':False,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allCombinations')}
+    # a single process does not use shared memory
+    assert px._shared_memory(px.LocalComm(),
+                             dict(options,shared_memory=True)) is None, \
+        'shared memory is used by a single process'
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    scst = px.stream_pxcorr(st.copy(),dict(options,shared_memory=True),
+                            comm=px.LocalComm())
+    for tr, rtr in zip(cst,scst):
+        assert np.allclose(tr.data,rtr.data,atol=1e-12), \
+            'correlation does not match'
+    if not px.BC_MPI:
+        return
+    # the shared arrays of a node of one process
+    shm = px.NodeSharedMemory(px.MPI.COMM_SELF)
+    try:
+        assert shm.leader, 'single process is not the leader'
+        arr = shm.zeros((5,3),dtype=np.complex64)
+        assert arr.shape == (5,3) and arr.dtype == np.complex64, \
+            'shared array does not match'
+        assert np.all(arr == 0), 'shared array is not zero'
+        arr[:,1] = 1.+2.j
+        assert np.all(shm.allreduce(arr)[:,1] == 1.+2.j), \
+            'sum of a single node changes the array'
+    finally:
+        shm.free()
+    assert shm.windows == [], 'windows are not released'
+
+
+@mpi
+def test_node_shared_memory_mpi():
+    script = _PXCORR_MPI + '''
+shm = px.NodeSharedMemory(comm)
+assert shm.nodecomm.Get_size() == psize, 'processes are not on one node'
+assert shm.leader == (rank == 0), 'leader does not match'
+arr = shm.zeros((5,psize),dtype=np.complex128)
+# every process writes its own column of the array of the node
+arr[:,rank] = rank + 1j
+shm.allreduce(arr)
+assert np.all(arr == (np.arange(psize) + 1j)[None,:]), \\
+    'shared array does not match'
+shm.free()
+check(px.stream_pxcorr(st.copy(),dict(options,shared_memory=True),
+                       comm=comm))
+print('ok')
+'''
+    out = _mpiexec(script)
+    assert out.count('ok') == 3, out
+
+
+def test_work_counter_local():
+    for comm in [px.LocalComm()] + ([px.MPI.COMM_SELF] if px.BC_MPI else []):
+        counter = px.WorkCounter(comm)
+        assert counter.win is None, 'window is used by a single process'
+        assert [counter.claim(n) for n in [1,3,2]] == [0,1,4], \
+            'claimed items do not match'
+        counter.free()
+    st = _local_stream()
+    options = {'TDpreProcessing':[],
+               'FDpreProcessing':[],
+               'lengthToSave':2,
+               'center_correlation':False,
+               'normalize_correlation':True,
+               'combinations':px.calc_cross_combis(st,'allCombinations'),
+               'block_size':3}
+    cst = px.stream_pxcorr(st.copy(),dict(options),comm=px.LocalComm())
+    dcst = px.stream_pxcorr(st.copy(),dict(options,schedule='dynamic'),
+                            comm=px.LocalComm())
+    for tr, dtr in zip(cst,dcst):
+        assert np.allclose(tr.data,dtr.data,atol=1e-12), \
+            'correlation does not match'
+
+
+@mpi
+def test_work_counter_mpi():
+    script = _PXCORR_MPI + '''
+counter = px.WorkCounter(comm)
+claims = []
+for _ in range(20):
+    start = counter.claim(2)
+    claims += [start,start+1]
+claims = sum(comm.allgather(claims),[])
+# every item is claimed exactly once
+assert sorted(claims) == list(range(40*psize)), 'claims do not match'
+counter.free()
+check(px.stream_pxcorr(st.copy(),dict(options,schedule='dynamic',
+                                      block_size=3),comm=comm))
+print('ok')
+'''
+    out = _mpiexec(script)
+    assert out.count('ok') == 3, out
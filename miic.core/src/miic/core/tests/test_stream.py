@@ -0,0 +1,256 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from scipy.signal import resample_poly
+
+import miic.core.stream as ms
+
+
+def _day_trace(station, day, value=0):
+    tr = Trace(data=(np.arange(8640) % 97 + value).astype(np.int32))
+    tr.stats['network'] = 'XX'
+    tr.stats['station'] = station
+    tr.stats['channel'] = 'HHZ'
+    tr.stats['sampling_rate'] = 0.1
+    tr.stats['starttime'] = UTCDateTime(2015,1,1) + day*86400
+    return tr
+
+
+def test_waveform_index():
+    base_dir = tempfile.mkdtemp()
+    try:
+        fs = [os.path.join(base_dir,'data'),'%Y',['%j','.','%STA','.mseed']]
+        os.makedirs(os.path.join(base_dir,'data','2015'))
+        for day in range(3):
+            for station in ['S1','S2']:
+                tr = _day_trace(station,day)
+                fname = ms._current_filepattern(tr.id,
+                                    tr.stats.starttime.datetime,fs)
+                tr.write(fname,format='MSEED')
+        index = ms.WaveformIndex(os.path.join(base_dir,'index.sqlite'))
+        assert index.scan(base_dir) == 6, 'files are not indexed'
+        assert index.scan(base_dir) == 0, 'unchanged files are read again'
+        starttime = datetime.datetime(2015,1,1,12)
+        endtime = datetime.datetime(2015,1,2,12)
+        fpattern = os.path.join(base_dir,'data','2015','*.mseed')
+        assert len(index.files(fpattern,starttime,endtime,'XX.S1..HHZ')) \
+            == 2, 'files of the period do not match'
+        # with and without the index the same traces are read
+        for ID in ['XX.S1..HHZ','XX.S2..HHZ']:
+            st = ms.read_from_filesystem(ID,starttime,endtime,fs)
+            ist = ms.read_from_filesystem(ID,starttime,endtime,fs,
+                                          index=index)
+            assert len(st) == len(ist) == 1, 'number of traces does not match'
+            assert st[0].stats == ist[0].stats, 'header does not match'
+            assert np.all(st[0].data == ist[0].data), 'data do not match'
+        # a changed file is read again
+        fname = ms._current_filepattern('XX.S1..HHZ',starttime,fs)
+        tr = _day_trace('S1',0,value=1000)
+        tr.data = tr.data[:4320]
+        tr.write(fname,format='MSEED')
+        assert index.scan(base_dir) == 1, 'changed file is not read again'
+        ist = ms.read_from_filesystem('XX.S1..HHZ',starttime,endtime,fs,
+                                      index=index)
+        st = ms.read_from_filesystem('XX.S1..HHZ',starttime,endtime,fs)
+        assert len(ist) == len(st) == 1, 'number of traces does not match'
+        assert st[0].stats == ist[0].stats, 'header does not match'
+        # a deleted file is removed from the index
+        os.remove(fname)
+        assert index.scan(base_dir) == 0, 'files are read again'
+        assert index.files(fpattern,starttime,endtime,'XX.S1..HHZ') == \
+            [ms._current_filepattern('XX.S1..HHZ',endtime,fs)], \
+            'deleted file is still indexed'
+        ist = ms.read_from_filesystem('XX.S1..HHZ',starttime,endtime,fs,
+                                      index=index)
+        st = ms.read_from_filesystem('XX.S1..HHZ',starttime,endtime,fs)
+        assert st[0].stats == ist[0].stats, 'header does not match'
+        assert np.all(st[0].data == ist[0].data), 'data do not match'
+        index.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+
+
+def test_waveform_index_directories():
+    base_dir = tempfile.mkdtemp()
+    try:
+        fs = [os.path.join(base_dir,'data'),'%Y',['%j','.','%STA','.mseed']]
+        os.makedirs(os.path.join(base_dir,'data','2015'))
+        for day in range(2):
+            tr = _day_trace('S1',day)
+            tr.write(ms._current_filepattern(tr.id,
+                                tr.stats.starttime.datetime,fs),format='MSEED')
+        index = ms.WaveformIndex(os.path.join(base_dir,'index.sqlite'))
+        calls = []
+        update = index.update
+
+        def _update(flist):
+            calls.append(flist)
+            return update(flist)
+        index.update = _update
+        starttime = datetime.datetime(2015,1,1)
+        endtime = datetime.datetime(2015,1,4)
+        fpattern = os.path.join(base_dir,'data','*','*.S1.mseed')
+        assert len(index.files(fpattern,starttime,endtime)) == 2, \
+            'files of the period do not match'
+        # the files of an unchanged directory are not looked at again
+        del calls[:]
+        assert len(index.files(fpattern,starttime,endtime)) == 2, \
+            'files of the period do not match'
+        assert calls == [], 'files of an unchanged directory are read'
+        # a new file changes the directory
+        tr = _day_trace('S1',2)
+        tr.write(ms._current_filepattern(tr.id,tr.stats.starttime.datetime,
+                                         fs),format='MSEED')
+        tr = _day_trace('S2',2)
+        tr.write(ms._current_filepattern(tr.id,tr.stats.starttime.datetime,
+                                         fs),format='MSEED')
+        assert len(index.files(fpattern,starttime,endtime)) == 3, \
+            'new file is not found'
+        assert len(calls) == 1, 'directory is not indexed again'
+        # the file pattern is matched as by glob
+        assert index.files(os.path.join(base_dir,'*.S1.mseed'),starttime,
+                           endtime) == [], 'pattern does not match as glob'
+        assert len(index.files(os.path.join(base_dir,'data','2015','*'),
+                               starttime,endtime,'XX.S2..HHZ')) == 1, \
+            'seed ID does not match'
+        # a deleted file changes the directory
+        os.remove(ms._current_filepattern('XX.S1..HHZ',starttime,fs))
+        assert len(index.files(fpattern,starttime,endtime)) == 2, \
+            'deleted file is still found'
+        index.close()
+    finally:
+        shutil.rmtree(base_dir)
+
+class _Reader(object):
+    """Read from a stream in memory and record the requested periods
+    """
+    def __init__(self, st):
+        self.st = st
+        self.requests = []
+
+    def __call__(self, ID, starttime, endtime):
+        self.requests.append((ID,UTCDateTime(starttime),UTCDateTime(endtime)))
+        return self.st.select(id=ID).slice(UTCDateTime(starttime),
+                                           UTCDateTime(endtime)).copy()
+
+
+def _cache_stream():
+    st = Stream()
+    for ii, station in enumerate(['S1','S2','S3','S4']):
+        tr = Trace(data=np.sin(np.arange(3000.)*(ii+1)/10.))
+        tr.stats['network'] = 'XX'
+        tr.stats['station'] = station
+        tr.stats['sampling_rate'] = 10.
+        tr.stats['starttime'] = UTCDateTime(2015,1,1)
+        st.append(tr)
+    return st
+
+
+def test_waveform_cache_tail_read():
+    st = _cache_stream()
+    read = _Reader(st)
+    cache = ms.WaveformCache(read)
+    t0 = UTCDateTime(2015,1,1)
+    ID = 'XX.S1..'
+    for start, end in [(10,100),(50,150),(60,140),(140,290)]:
+        cst = cache.get(ID,(t0+start).datetime,(t0+end).datetime)
+        rst = _Reader(st)(ID,(t0+start).datetime,(t0+end).datetime)
+        assert len(cst) == 1, 'number of traces does not match'
+        assert cst[0].stats.starttime == rst[0].stats.starttime, \
+            'start time does not match'
+        assert np.allclose(cst[0].data,rst[0].data), \
+            'cached data do not match a direct read'
+    assert cache.counters == {'hits':1,'partial':2,'misses':1,
+                              'evictions':0}, 'counters do not match'
+    # only the missing tail is read
+    assert read.requests[1][1] == t0 + 100.1, 'tail read does not match'
+    assert read.requests[2][1] == t0 + 150.1, 'tail read does not match'
+    # data before the last request are discarded
+    assert cache.entries[ID][0].stats.starttime == t0 + 140, \
+        'data before the request are kept'
+
+
+def test_waveform_cache_eviction():
+    st = _cache_stream()
+    t0 = UTCDateTime(2015,1,1)
+    start, end = t0.datetime, (t0+99.9).datetime
+    # room for the data of two seed IDs
+    cache = ms.WaveformCache(_Reader(st),max_bytes=2*1000*8)
+    for station in ['S1','S2','S3']:
+        cache.get('XX.%s..' % station,start,end)
+    assert list(cache.entries.keys()) == ['XX.S2..','XX.S3..'], \
+        'least recently used data are not evicted'
+    # a hit makes the data the most recently used
+    cache.get('XX.S2..',start,end)
+    cache.get('XX.S4..',start,end)
+    assert list(cache.entries.keys()) == ['XX.S2..','XX.S4..'], \
+        'eviction order does not match'
+    assert cache.counters['evictions'] == 2, 'evictions are not counted'
+    assert cache.nbytes() <= 2*1000*8, 'cache exceeds its size'
+    cst = cache.get('XX.S4..',start,end)
+    assert np.all(cst[0].data == st[3].data[:1000]), \
+        'cached data do not match'
+
+
+def test_waveform_cache_prepare_seam():
+    st = _cache_stream()
+    t0 = UTCDateTime(2015,1,1)
+    prepare = lambda pst: ms.stream_resample(pst,2.5)
+    cache = ms.WaveformCache(_Reader(st),prepare=prepare)
+    # overlapping reads such that the second one is partly cached
+    for start, end in [(0,150),(100,250)]:
+        cst = cache.get_many(['XX.S1..','XX.S2..'],(t0+start).datetime,
+                             (t0+end).datetime)
+        for ID, tst in zip(['XX.S1..','XX.S2..'],cst):
+            rst = prepare(_Reader(st)(ID,(t0+start).datetime,
+                                      (t0+end).datetime))
+            for key in ['starttime','sampling_rate','npts']:
+                assert tst[0].stats[key] == rst[0].stats[key], \
+                    'header does not match'
+            assert np.allclose(tst[0].data,rst[0].data,atol=1e-12), \
+                'prepared data differ from the preparation of a direct read'
+    assert cache.counters['partial'] == 2, 'data are not partly cached'
+
+
+def test_stream_resample():
+    st = Stream()
+    for npts, sampling_rate in [(3000,100.),(2000,100.),(3000,100.),
+                                (1000,50.)]:
+        tr = Trace(data=np.sin(np.arange(npts)*2.*np.pi*0.5/sampling_rate) +
+                   np.cos(np.arange(npts)**1.1/10.)*1e-3)
+        tr.stats['sampling_rate'] = sampling_rate
+        tr.stats['station'] = 'S%d' % len(st)
+        st.append(tr)
+    calls = []
+
+    def _resample_poly(A, up, down, **kwargs):
+        calls.append(A.shape)
+        return resample_poly(A, up, down, **kwargs)
+    rst = st.copy()
+    orig = ms.resample_poly
+    ms.resample_poly = _resample_poly
+    try:
+        ms.stream_resample(rst,25.)
+    finally:
+        ms.resample_poly = orig
+    # traces of different length or sampling rate are resampled separately
+    assert sorted(calls) == [(1000,1),(2000,1),(3000,2)], \
+        'traces are not grouped by sampling rate and length'
+    for tr, rtr in zip(st,rst):
+        down = int(tr.stats.sampling_rate/25.)
+        assert rtr.stats.sampling_rate == 25., 'sampling rate does not match'
+        assert rtr.stats.npts == tr.stats.npts//down, \
+            'number of samples does not match'
+        ref = resample_poly(tr.data,1,down,window=('kaiser',5.0))
+        assert np.allclose(rtr.data,ref,atol=1e-12), \
+            'resampled data do not match'
+        # the signal far below the new Nyquist frequency is not changed by
+        # the zero phase filter
+        dtr = tr.copy().decimate(down,no_filter=True)
+        assert np.allclose(rtr.data[50:-50],dtr.data[50:-50],atol=2e-2), \
+            'resampled data do not match decimation'
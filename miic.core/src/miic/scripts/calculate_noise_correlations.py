@@ -6,6 +6,11 @@ import glob
 import os
 import datetime
 import logging
+import threading
+import Queue
+import json
+import hashlib
+import fnmatch
 
 from mpi4py import MPI
 
@@ -20,10 +25,12 @@ from miic.core.miic_utils import create_path, dir_read, lat_lon_ele_load, \
         save_dict_to_matlab_file, datetime_list, correlation_subdir_name, \
         get_valid_traces
 from miic.core.stream import stream_add_lat_lon_ele, corr_trace_to_obspy
-from miic.core.stream import read_from_filesystem
+from miic.core.stream import read_from_filesystem, WaveformIndex, \
+        WaveformCache, stream_resample
 from miic.core.corr_mat_processing import corr_mat_create_from_traces, \
         corr_mat_extract_trace, corr_mat_merge, corr_mat_extract_trace, \
-        corr_mat_resample, corr_mat_from_corr_stream
+        corr_mat_resample, corr_mat_from_corr_stream, CorrelationStore, \
+        corr_store_name, corr_mat_from_stores
 import miic.core.pxcorr_func as px
 
 from miic.core.script_utils import ini_project, combine_station_channels, \
@@ -42,10 +49,14 @@ def paracorr(par):
     The processing is performed in the following sequence
     
      * Data is read in typically day-long chunks ideally contained in a single 
-       file to speed up reading time
+       file to speed up reading time. With ``par['co']['read_ahead']`` > 0 the
+       data of the following days are read (and decimated) by a background
+       thread while the current day is correlated.
      * Preprocessing on the long sequences to avoid dominating influence of 
        perturbing signals if processed in shorter chunks.
-     * dividing these long sequences into shorter ones (typically an hour)
+     * dividing these long sequences into shorter ones (typically an hour).
+       With ``par['co']['subdivision']['sliding_windows']`` the sequences are
+       packed once and the shorter ones are views of the packed data.
      * time domain preprocessing
      * frequency domain preprocessing
      * correlation
@@ -56,6 +67,31 @@ def paracorr(par):
      * combination of correlation traces of subsequent time segments in 
        correlation matrices
      * optionally delete traces of individual time segments
+
+    If ``par['co']['subdivision']['in_memory']`` is True the correlations of
+    the subdivisions are kept in memory and only the correlation matrix and
+    the stacked trace of every combination are written once per day (not
+    possible in combination with direct output).
+
+    If ``par['co']['write_behind']`` is True the results are written by a
+    background thread while the next subdivision or day is correlated.
+
+    The progress is recorded by rank 0 in the manifest
+    ``paracorr_manifest.json`` in ``par['co']['res_dir']`` together with the
+    size and checksum of the files written for every read. If
+    ``par['co']['resume']`` is True the reads completed in a previous run
+    whose files (or rows in the HDF5 stores) are still present are skipped and reads that were started
+    but not completed are computed again. With ``resume : 'verify'`` the
+    checksums of the files are verified as well.
+
+    If ``par['co']['output']`` is ``'hdf5'`` the correlation traces are
+    appended to a :class:`~miic.core.corr_mat_processing.CorrelationStore`
+    per process (``correlations_<rank>.h5`` in ``par['co']['res_dir']``)
+    instead of being written to one MATLAB file per trace, and the
+    subdivisions are not combined in files per read. Writing a read again
+    replaces its rows in the store. If a read is written again with a
+    different number of processes, the rows written last are used when
+    the stores are combined.
     
     :type par: dict
     :param par: processing parameters
@@ -80,21 +116,27 @@ def paracorr(par):
                             par['net']['channels'],par['co']['combination_method'])
 
     sttimes = datetime_list(par['co']['read_start'], par['co']['read_end'], inc=par['co']['read_inc'])	## loop over 24hrs/whole days
-    time_inc = datetime.timedelta(seconds=par['co']['read_len'])
     lle_df = lat_lon_ele_load(par['net']['coordinate_file'])
     res_dir = par['co']['res_dir']
     station_list = par['net']['stations']
-    channel_list = par['net']['channels']
 
 
     program_start = UTCDateTime()
 
-    # bulid a dictionary that caches the streams that reside in the same file
-    stream_cache = {}
-    for station in par['net']['stations']:
-        stream_cache.update({station:{}})
-        for channel in par['net']['channels']:
-            stream_cache[station].update({channel:Stream().append(Trace())})
+    # index of the waveform files shared by all reads of this process
+    index = None
+    if 'file_index' in par['net'].keys():
+        index = WaveformIndex(par['net']['file_index'])
+
+    # cache of the streams that reside in the same file limited to
+    # par['co']['cache_size'] MB
+    max_bytes = None
+    if 'cache_size' in par['co'].keys():
+        max_bytes = int(par['co']['cache_size']*2**20)
+    read = lambda ID, starttime, endtime: _read_channel(ID,starttime,endtime,
+                                                        par,logger,index)
+    prepare = lambda st: _prepare_stream(st,par,logger)
+    stream_cache = WaveformCache(read,max_bytes,prepare)
 
 
     # mapping of stations to processes
@@ -108,130 +150,191 @@ def paracorr(par):
                                       /par['co']['subdivision']['corr_inc'])+1)
     else:
         nsub = 1
+    # keep the correlations of the subdivisions in memory
+    in_memory = ('subdivision' in par['co'].keys()) and \
+            ('in_memory' in par['co']['subdivision'].keys()) and \
+            par['co']['subdivision']['in_memory']
+    # pack the traces once and take the subdivisions as views
+    sliding_windows = ('subdivision' in par['co'].keys()) and \
+            ('sliding_windows' in par['co']['subdivision'].keys()) and \
+            par['co']['subdivision']['sliding_windows']
+
+    # number of days read in advance and writing in the background
+    read_ahead = 0
+    if 'read_ahead' in par['co'].keys():
+        read_ahead = int(par['co']['read_ahead'])
+    write_behind = ('write_behind' in par['co'].keys()) and \
+            par['co']['write_behind']
+    writer = _BackgroundWriter(logger,write_behind)
 
     # loop over times
     pathname = os.path.join(res_dir, correlation_subdir_name(sttimes[0]))
     print '\nrank %d of %d'  % (rank,psize)
     logger.debug('Rank %d of %d Beginning execution.'  % (rank,psize))
-    for sttime in sttimes:
-        if rank == 0:
-            print "\n>>> Working on %s at %s:" % (sttime,UTCDateTime())
-            logger.debug("\n>>> Working on %s at %s:" % (sttime,UTCDateTime()))
-        usttime = UTCDateTime(sttime)
-        # fill cache and extract current stream: only done by process 0
-        cst = Stream()
-        # loop over stations different stations for every process
-        for this_ind in st_ind:
-            station = station_list[this_ind]
-            tst = Stream()
-            for channel in channel_list:
-                print channel, station
-                try:
-                    if ((len(stream_cache[station][channel])==0) or 
-                            (not ((stream_cache[station][channel][0].stats['starttime']<=usttime) &
-                            (stream_cache[station][channel][0].stats['endtime']>=(usttime+par['co']['read_len']))))):
-                        stream_cache[station][channel] = read_from_filesystem('%s.*.%s' %(station, channel), sttime, sttime+time_inc, par['net']['fss'], trim=False)
-                        if not stream_cache[station][channel]:
-                            logger.warning("%s %s at %s: No trace read." % (station, channel, sttime))
-                            continue
-                        samp_flag = False
-                        for tr in stream_cache[station][channel]:
-                            if tr.stats.sampling_rate != par['co']['sampling_rate']:
-                                samp_flag = True
-                        if samp_flag:
-                            logger.warning("%s %s at %s: Mismatching sampling rate." % (station, channel, sttime))
-                            stream_cache[station][channel] = Stream()
-                            continue
-                        if par['co']['decimation'] > 1:
-                            sst = stream_cache[station][channel].split()
-                            sst.decimate(par['co']['decimation'])
-                            stream_cache[station][channel] = deepcopy(sst.merge())
-                    ttst = stream_cache[station][channel].copy().trim(starttime=usttime,
-                                                 endtime=usttime+par['co']['read_len'])
-                    get_valid_traces(ttst)
-                    tst +=ttst
-                except:
-                    logger.warning("%s %s at %s: %s" % (station, channel, sttime, sys.exc_info()[0]))
-            cst += tst
-        cst = stream_add_lat_lon_ele(cst,lle_df)
-        # initial preprocessing on long time series
-        if 'preProcessing' in par['co'].keys():
-            for procStep in par['co']['preProcessing']:
-                cst = procStep['function'](cst,**procStep['args'])
-
-        # create output path
-        pathname = os.path.join(par['co']['res_dir'],correlation_subdir_name(sttime))
+
+    # manifest of the completed reads and skipping of them when resuming
+    manifest = None
+    if rank == 0:
+        manifest = _RunManifest(os.path.join(res_dir,'paracorr_manifest.json'))
+    if ('resume' in par['co'].keys()) and par['co']['resume']:
+        done = None
         if rank == 0:
-            create_path(pathname)
+            done = manifest.completed(verify=(par['co']['resume'] == 'verify'))
+        done = set(comm.bcast(done, root=0))
+        nall = len(sttimes)
+        sttimes = [sttime for sttime in sttimes
+                   if str(UTCDateTime(sttime)) not in done]
+        logger.debug('Resuming: %d of %d reads completed before.' %
+                     (nall-len(sttimes),nall))
+    # HDF5 store of the correlations written by this process (opened after
+    # the manifest has checked the stores of the previous run)
+    store = None
+    if _hdf5_output(par):
+        store = CorrelationStore(corr_store_name(res_dir,rank))
+    read_day = lambda sttime: _read_stations(par,sttime,st_ind,stream_cache,
+                                             logger)
+    last_pathname = None
+    try:
+        for sttime, cst in _read_ahead(read_day,sttimes,read_ahead):
+            if rank == 0:
+                print "\n>>> Working on %s at %s:" % (sttime,UTCDateTime())
+                logger.debug("\n>>> Working on %s at %s:" % (sttime,UTCDateTime()))
+            cst = stream_add_lat_lon_ele(cst,lle_df)
+            # initial preprocessing on long time series
+            if 'preProcessing' in par['co'].keys():
+                for procStep in par['co']['preProcessing']:
+                    cst = procStep['function'](cst,**procStep['args'])
+
+            # create output path
+            pathname = os.path.join(par['co']['res_dir'],correlation_subdir_name(sttime))
+            if rank == 0:
+                create_path(pathname)
+            if pathname == last_pathname:
+                # the subdivisions of the previous read in the same directory
+                # have to be combined before new traces are written
+                writer.wait()
+                comm.barrier()
+            last_pathname = pathname
+            if rank == 0:
+                before = _file_state(pathname)
+                writer.submit('manifest',manifest.start,str(UTCDateTime(sttime)))
                 
-        # broadcast every station to every process    
-        st = Stream()
-        for pind in range(psize):
-            pst = Stream()
-            if rank == pind:
-                pst = deepcopy(cst)
-            pst = comm.bcast(pst, root=pind)
-            st += pst
-
-        ## do correlations
-        if len(st) == 0:
-            logger.warning("%s: No traces to correlate." % (sttime))
-        else:
-            targs = deepcopy(par['co']['corr_args'])
-            if 'direct_output' in targs.keys():
-                targs['direct_output']['base_dir'] = pathname
-            # loop over subdivisions
-            for subn in range(nsub):
-                if nsub > 1:
-                    sub_st = st.copy().trim(starttime=UTCDateTime(sttime)+
-                                    subn*par['co']['subdivision']['corr_inc'],
-                                    endtime=UTCDateTime(sttime)+subn*par['co']['subdivision']['corr_inc']+
-                                    par['co']['subdivision']['corr_len'])
-                    get_valid_traces(sub_st)
-                else:
-                    sub_st = st
-                targs['combinations'] = select_available_combinations(sub_st,comb_list,targs)
-                if len(targs['combinations']) == 0:
-                    continue
-                cst = px.stream_pxcorr(sub_st,targs,comm=comm)
-                # if 'direct_output' in targs.keys() cst is empty and the 
-                # following will not be executed
-                if cst:
-                    if par['co']['rotation']:
-                        rcst = px.rotate_multi_corr_stream(cst)
+            # gather every station on every process
+            st = px.allgather_stream(comm,cst)
+            # only the header table is exchanged, add the coordinates again
+            st = stream_add_lat_lon_ele(st,lle_df)
+
+            ## do correlations
+            if len(st) == 0:
+                logger.warning("%s: No traces to correlate." % (sttime))
+            else:
+                targs = deepcopy(par['co']['corr_args'])
+                if 'direct_output' in targs.keys():
+                    targs['direct_output']['base_dir'] = pathname
+                # correlations of the subdivisions written by this process and
+                # the mapping of the combinations to the processes
+                sub_corr = {}
+                cmap = {}
+                if sliding_windows and (nsub > 1):
+                    windows = px.SubdivisionWindows(st,UTCDateTime(sttime),
+                                        par['co']['subdivision']['corr_len'],
+                                        par['co']['subdivision']['corr_inc'],nsub)
+                # loop over subdivisions
+                for subn in range(nsub):
+                    if sliding_windows and (nsub > 1):
+                        sub_st = windows.stream(subn)
+                    elif nsub > 1:
+                        sub_st = st.copy().trim(starttime=UTCDateTime(sttime)+
+                                        subn*par['co']['subdivision']['corr_inc'],
+                                        endtime=UTCDateTime(sttime)+subn*par['co']['subdivision']['corr_inc']+
+                                        par['co']['subdivision']['corr_len'])
+                        get_valid_traces(sub_st)
                     else:
-                        rcst = cst
+                        sub_st = st
+                    targs['combinations'] = select_available_combinations(sub_st,comb_list,targs)
+                    if len(targs['combinations']) == 0:
+                        continue
+                    cst = px.stream_pxcorr(sub_st,targs,comm=comm)
+                    # if 'direct_output' in targs.keys() cst is empty and the 
+                    # following will not be executed
+                    if cst:
+                        if par['co']['rotation']:
+                            rcst = px.rotate_multi_corr_stream(cst)
+                        else:
+                            rcst = cst
                 
-                    # distributed writing
-                    # mapping of stations to processes
-                    pmap = (np.arange(len(rcst))*psize)/len(rcst)
-                    # indecies for stations to be worked on by each process
-                    tr_ind = np.where(pmap == rank)[0]
-                    logger.debug('Process %d starting to write %d traces to %s.' % (rank,len(tr_ind),pathname))
-                    this_st = Stream()
-                    for this_ind in tr_ind:
-                        this_st.append(rcst[this_ind])
-                    convert_to_matlab(this_st,'trace',pathname)
+                        # distributed writing
+                        # mapping of stations to processes
+                        if ('distribution' in targs.keys()) and \
+                                (targs['distribution'] == 'grid'):
+                            # correlations are only returned on rank 0
+                            pmap = np.zeros(len(rcst),dtype=int)
+                        elif in_memory:
+                            # a combination stays on the same process for all
+                            # subdivisions
+                            for tr in rcst:
+                                if tr.id not in cmap.keys():
+                                    cmap[tr.id] = len(cmap) % psize
+                            pmap = np.array([cmap[tr.id] for tr in rcst])
+                        else:
+                            pmap = (np.arange(len(rcst))*psize)/len(rcst)
+                        # indecies for stations to be worked on by each process
+                        tr_ind = np.where(pmap == rank)[0]
+                        logger.debug('Process %d starting to write %d traces to %s.' % (rank,len(tr_ind),pathname))
+                        if in_memory and (store is None):
+                            for this_ind in tr_ind:
+                                tr = rcst[this_ind]
+                                if tr.id not in sub_corr.keys():
+                                    sub_corr[tr.id] = Stream()
+                                sub_corr[tr.id].append(tr)
+                        else:
+                            this_st = Stream()
+                            for this_ind in tr_ind:
+                                this_st.append(rcst[this_ind])
+                            if store is not None:
+                                writer.submit('traces in %s' % store.fname,
+                                              store.append,this_st)
+                            else:
+                                writer.submit('traces in %s' % pathname,
+                                              convert_to_matlab,this_st,'trace',
+                                              pathname)
+                if in_memory and (store is None):
+                    logger.debug('Process %d writing %d stacked combinations to %s.' % (rank,len(sub_corr),pathname))
+                    for trid in sorted(sub_corr.keys()):
+                        try:
+                            writer.submit('combination %s' % trid,
+                                          _save_subdivisions,sub_corr[trid],
+                                          pathname,par['co']['subdivision'])
+                        except:
+                            logger.warning("Problem with combination %s: %s" % (trid, sys.exc_info()[0]))
             
-        # if there is a subdivision of read traces
-        comm.barrier()
-        if ('subdivision' in par['co']) and (rank == 0):
-            logger.debug('combining subdivisions')
-            # combine traces to matrix
-            corr_mat_create_from_traces(pathname, pathname, delete_trace_files=True)
-            if par['co']['subdivision']['recombine_subdivision']:
-                flist = dir_read(pathname,'mat__*.mat')
-                for fl in flist:
-                    try:
-                        mat = mat_to_ndarray(fl)
-                        tr = corr_mat_extract_trace(mat,method='norm_mean')
-                        save_dict_to_matlab_file(fl.replace('mat__','tr__'),tr)
-                        if par['co']['subdivision']['delete_subdivisions']:
-                            os.remove(fl)
-                    except:
-                        pass
-
-
+            # if there is a subdivision of read traces the trace files of all
+            # processes must be complete before they are combined and the files
+            # of all processes must be complete before the read is recorded
+            writer.wait()
+            comm.barrier()
+            if ('subdivision' in par['co']) and (not in_memory) and \
+                    (store is None) and (rank == 0):
+                logger.debug('combining subdivisions')
+                writer.submit('combining subdivisions in %s' % pathname,
+                              _combine_subdivisions,pathname,
+                              par['co']['subdivision'])
+            # rows of this read in the HDF5 stores of all processes
+            stores = None
+            if store is not None:
+                stores = comm.gather(_store_state(store,sttime,par),root=0)
+            if rank == 0:
+                writer.submit('manifest',_complete_read,manifest,
+                              str(UTCDateTime(sttime)),pathname,before,stores)
+    except:
+        # write what was submitted before the error and stop the writer,
+        # the error of the main loop is raised
+        exc = sys.exc_info()
+        writer.close(reraise=False)
+        raise exc[0], exc[1], exc[2]
+    writer.close()
+    if store is not None:
+        store.close()
 
     program_end = UTCDateTime()
 
@@ -241,6 +344,403 @@ def paracorr(par):
 
 
 
+def _read_stations(par,sttime,st_ind,stream_cache,logger):
+    """Read the data of the stations `st_ind` for the read starting at `sttime`
+
+    The data are taken from the :class:`~miic.core.stream.WaveformCache`
+    ``stream_cache`` such that files that contain the data of several reads
+    are only read once. The data of all channels that are read are prepared
+    together. The statistics of the cache are logged.
+
+    :rtype: :class:`~obspy.core.stream.Stream`
+    :return: traces of the stations trimmed to the read
+    """
+    station_list = par['net']['stations']
+    channel_list = par['net']['channels']
+    usttime = UTCDateTime(sttime)
+    # loop over stations different stations for every process
+    IDs = ['%s.*.%s' % (station_list[this_ind], channel)
+           for this_ind in st_ind for channel in channel_list]
+    try:
+        streams = stream_cache.get_many(IDs,usttime,
+                                        usttime+par['co']['read_len'])
+    except:
+        logger.warning("Reading at %s: %s" % (sttime, sys.exc_info()[0]))
+        streams = [None]*len(IDs)
+    cst = Stream()
+    for ID, ttst in zip(IDs,streams):
+        print ID
+        try:
+            if ttst is None:
+                # read the channels separately after a problem
+                ttst = stream_cache.get(ID,usttime,
+                                        usttime+par['co']['read_len'])
+            if not ttst:
+                logger.warning("%s at %s: No trace read." % (ID, sttime))
+                continue
+            get_valid_traces(ttst)
+            cst += ttst
+        except:
+            logger.warning("%s at %s: %s" % (ID, sttime, sys.exc_info()[0]))
+    logger.debug("Stream cache at %s: %d hits, %d partial hits, %d misses, "
+                 "%d evictions, %.1f MB" % (sttime,
+                 stream_cache.counters['hits'],stream_cache.counters['partial'],
+                 stream_cache.counters['misses'],
+                 stream_cache.counters['evictions'],
+                 stream_cache.nbytes()/2.**20))
+    stream_cache.reset_counters()
+    return cst
+
+
+def _read_channel(ID,starttime,endtime,par,logger,index=None):
+    """Read the data of `ID` with :func:`~miic.core.stream.read_from_filesystem`
+
+    Problems are logged and result in an empty stream.
+    """
+    try:
+        return read_from_filesystem(ID,starttime,endtime,par['net']['fss'],
+                                    trim=False,index=index)
+    except:
+        logger.warning("%s at %s: %s" % (ID, starttime, sys.exc_info()[0]))
+        return Stream()
+
+
+def _prepare_stream(st,par,logger):
+    """Check the sampling rate of the data read and decimate them
+
+    The traces of channels with a sampling rate different from
+    ``par['co']['sampling_rate']`` are discarded and the data are decimated
+    by ``par['co']['decimation']``. All contiguous traces of equal length are
+    decimated together (see :func:`~miic.core.stream.stream_resample`).
+    """
+    mismatch = set([tr.id for tr in st
+                    if tr.stats.sampling_rate != par['co']['sampling_rate']])
+    for trid in sorted(mismatch):
+        logger.warning("%s: Mismatching sampling rate." % trid)
+    st = Stream([tr for tr in st if tr.id not in mismatch])
+    if (par['co']['decimation'] > 1) and (len(st) > 0):
+        st = st.split()
+        stream_resample(st,float(par['co']['sampling_rate'])/
+                        par['co']['decimation'])
+        st.merge()
+    return st
+
+
+def _read_ahead(read,sttimes,depth):
+    """Read the data of the times in `sttimes` in advance
+
+    The function `read` is called for the times in `sttimes` by a background
+    thread that keeps up to `depth` reads in a queue. This overlaps reading
+    (and decimation) of the following reads with the processing of the
+    current one. With `depth` < 1 the data are read when they are needed.
+    An exception raised by `read` is raised in the calling thread when the
+    data of that time are taken from the generator.
+
+    :rtype: generator
+    :return: tuples of the start time and the data read for it
+    """
+    if depth < 1:
+        for sttime in sttimes:
+            yield sttime, read(sttime)
+        return
+    queue = Queue.Queue(maxsize=depth)
+    def _reader():
+        for sttime in sttimes:
+            try:
+                queue.put((sttime,read(sttime),None))
+            except:
+                # raised in the main thread, no further reads
+                queue.put((sttime,None,sys.exc_info()))
+                return
+    thread = threading.Thread(target=_reader)
+    thread.daemon = True
+    thread.start()
+    for _ in sttimes:
+        sttime, st, exc = queue.get()
+        if exc is not None:
+            thread.join()
+            raise exc[0], exc[1], exc[2]
+        yield sttime, st
+    thread.join()
+
+
+class _BackgroundWriter(object):
+    """Write results in a background thread
+
+    Functions passed to :meth:`submit` are executed in the order of
+    submission by a background thread such that writing overlaps with the
+    following computations. If `enabled` is False the functions are
+    executed immediately.
+
+    If a function raises an exception it is logged, the functions submitted
+    after it are skipped and the exception is raised in the calling thread
+    by every following call of :meth:`submit`, :meth:`wait` or
+    :meth:`close`. Skipping them makes sure that e.g. a read is not recorded
+    as complete after its results could not be written.
+    """
+    def __init__(self, logger, enabled=True):
+        self.logger = logger
+        self.enabled = enabled
+        self.exc = None
+        if enabled:
+            self.queue = Queue.Queue()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.exc is not None:
+                    continue
+                description, func, args = task
+                try:
+                    func(*args)
+                except:
+                    self.exc = sys.exc_info()
+                    self.logger.error("Problem with %s: %s" %
+                                      (description, self.exc[1]))
+            finally:
+                self.queue.task_done()
+
+    def _reraise(self):
+        if self.exc is not None:
+            raise self.exc[0], self.exc[1], self.exc[2]
+
+    def submit(self, description, func, *args):
+        """Execute `func(*args)` in the background
+        """
+        if not self.enabled:
+            return func(*args)
+        self._reraise()
+        self.queue.put((description,func,args))
+
+    def wait(self):
+        """Wait until all submitted functions are executed
+        """
+        if self.enabled:
+            self.queue.join()
+            self._reraise()
+
+    def close(self, reraise=True):
+        """Wait for the submitted functions and stop the thread
+
+        With `reraise` False an exception of a submitted function is only
+        logged (used when the calling thread fails itself).
+        """
+        if self.enabled:
+            self.queue.put(None)
+            self.thread.join()
+            self.enabled = False
+        if reraise:
+            self._reraise()
+
+
+class _RunManifest(object):
+    """Record of the reads processed by paracorr
+
+    The status of every read (identified by its start time) is kept in a
+    JSON file that is replaced atomically on every change. For completed
+    reads the size and SHA1 checksum of every file written are stored with
+    paths relative to the directory of the manifest.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.reads = {}
+        if os.path.exists(fname):
+            with open(fname) as fh:
+                self.reads = json.load(fh)['reads']
+
+    def _write(self):
+        tmp = self.fname + '.tmp'
+        with open(tmp,'w') as fh:
+            json.dump({'reads':self.reads},fh,indent=1,sort_keys=True)
+        os.rename(tmp,self.fname)
+
+    def start(self, key):
+        """Record that the read `key` is started
+        """
+        self.reads[key] = {'status':'started','started':str(UTCDateTime())}
+        self._write()
+
+    def complete(self, key, files, stores=None):
+        """Record that the read `key` is completed with the list `files`
+
+        `stores` is the list of states of the HDF5 stores the read was
+        written to (see :func:`_store_state`).
+        """
+        base = os.path.dirname(self.fname)
+        self.reads[key] = {'status':'complete',
+                           'completed':str(UTCDateTime()),
+                           'files':dict([(os.path.relpath(fname,base),
+                                          {'size':os.path.getsize(fname),
+                                           'sha1':_checksum(fname)})
+                                         for fname in files])}
+        if stores:
+            self.reads[key]['stores'] = dict(
+                    [(os.path.relpath(state['fname'],base),state)
+                     for state in stores])
+        self._write()
+
+    def completed(self, verify=False):
+        """Return the completed reads whose files are unchanged
+
+        The files must exist with their recorded size and if `verify` is
+        True also with their checksum.
+
+        :rtype: list
+        :return: keys of the completed reads
+        """
+        base = os.path.dirname(self.fname)
+        done = []
+        for key, read in self.reads.items():
+            if read['status'] != 'complete':
+                continue
+            valid = True
+            for fname, info in read['files'].items():
+                fname = os.path.join(base,fname)
+                if (not os.path.exists(fname)) or \
+                        (os.path.getsize(fname) != info['size']) or \
+                        (verify and (_checksum(fname) != info['sha1'])):
+                    valid = False
+                    break
+            if 'stores' in read.keys():
+                for fname, info in read['stores'].items():
+                    if not valid:
+                        break
+                    valid = _store_valid(os.path.join(base,fname),info,
+                                         verify)
+            if valid:
+                done.append(key)
+        return sorted(done)
+
+
+def _checksum(fname):
+    """SHA1 checksum of the file `fname`
+    """
+    sha1 = hashlib.sha1()
+    with open(fname,'rb') as fh:
+        for block in iter(lambda: fh.read(2**20),b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _file_state(pathname):
+    """Modification time and size of the files in `pathname`
+    """
+    state = {}
+    for fname in glob.glob(os.path.join(pathname,'*')):
+        if os.path.isfile(fname):
+            fstat = os.stat(fname)
+            state[fname] = (fstat.st_mtime,fstat.st_size)
+    return state
+
+
+def _store_state(store,sttime,par):
+    """Number and checksum of the rows of the read starting at `sttime` in
+    the HDF5 `store`
+
+    The rows of a read are those starting within ``par['co']['read_inc']``
+    seconds after `sttime`. The checksum is the sum of the checksums
+    recorded when the rows were written, the data are not read again.
+    """
+    starttime = UTCDateTime(sttime)
+    endtime = starttime + par['co']['read_inc']
+    rows, sha1 = store.digest(starttime,endtime)
+    return {'fname':store.fname,'starttime':str(starttime),
+            'endtime':str(endtime),'rows':rows,'sha1':sha1}
+
+
+def _store_valid(fname,info,verify=False):
+    """True if the HDF5 store `fname` holds the rows recorded in `info`
+    (see :func:`_store_state`)
+
+    Only the number of rows is compared. With `verify` the checksum of the
+    rows is calculated from their data and compared as well.
+    """
+    if not os.path.exists(fname):
+        return False
+    try:
+        store = CorrelationStore(fname,mode='r')
+        try:
+            rows, sha1 = store.digest(info['starttime'],info['endtime'],
+                                      checksum=verify,recompute=verify)
+        finally:
+            store.close()
+    except Exception:
+        # truncated or corrupted store
+        return False
+    return (rows == info['rows']) and ((not verify) or (sha1 == info['sha1']))
+
+
+def _complete_read(manifest,key,pathname,before,stores=None):
+    """Record the files in `pathname` that changed since `before` (see
+    :func:`_file_state`) and the state of the HDF5 `stores` as the output of
+    the completed read `key`
+    """
+    after = _file_state(pathname)
+    files = [fname for fname in sorted(after.keys())
+             if (fname not in before) or (before[fname] != after[fname])]
+    manifest.complete(key,files,stores)
+
+
+def _hdf5_output(par):
+    """True if the correlations are written to HDF5 stores
+    """
+    return ('output' in par['co'].keys()) and (par['co']['output'] == 'hdf5')
+
+
+def _combine_subdivisions(pathname,subdivision):
+    """Combine the traces of the subdivisions in `pathname` to matrices
+
+    If ``subdivision['recombine_subdivision']`` is True the normalized mean
+    trace of every matrix is saved as well and the matrix is deleted if
+    ``subdivision['delete_subdivisions']`` is True.
+    """
+    # combine traces to matrix
+    corr_mat_create_from_traces(pathname, pathname, delete_trace_files=True)
+    if subdivision['recombine_subdivision']:
+        flist = dir_read(pathname,'mat__*.mat')
+        for fl in flist:
+            try:
+                mat = mat_to_ndarray(fl)
+                tr = corr_mat_extract_trace(mat,method='norm_mean')
+                save_dict_to_matlab_file(fl.replace('mat__','tr__'),tr)
+                if subdivision['delete_subdivisions']:
+                    os.remove(fl)
+            except:
+                pass
+
+
+def _save_subdivisions(st,pathname,subdivision):
+    """Save the correlations of the subdivisions of one combination
+
+    The correlation traces of the subdivisions in ``st`` are combined in a
+    correlation matrix that is saved under the same name as done by
+    :func:`~miic.core.corr_mat_processing.corr_mat_create_from_traces`. If
+    ``subdivision['recombine_subdivision']`` is True the normalized mean trace
+    is saved as well and the matrix is only kept if
+    ``subdivision['delete_subdivisions']`` is False.
+    """
+    mat = corr_mat_from_corr_stream(st)
+    # time of the rows as written by corr_mat_create_from_traces
+    mat['time'] = np.array(['%s' % max(UTCDateTime(tr.stats_tr1['starttime']),
+                                       UTCDateTime(tr.stats_tr2['starttime']))
+                            .strftime('%Y-%m-%d %H:%M:%S.%f') for tr in st])
+    fname = os.path.join(pathname,'mat__%s.mat' % st[0].id.replace('-',''))
+    if subdivision['recombine_subdivision']:
+        tr = corr_mat_extract_trace(mat,method='norm_mean')
+        save_dict_to_matlab_file(fname.replace('mat__','tr__'),tr)
+        if subdivision['delete_subdivisions']:
+            return
+    save_dict_to_matlab_file(fname,mat)
+
+
+
+
 def merge_corr_results(par):
     """Combine traces and matrices
     
@@ -279,8 +779,33 @@ def merge_corr_results(par):
     comb_ind = np.where(pmap == rank)[0]
     #pdb.set_trace()
 
+    # combine the rows of the HDF5 stores of all processes
+    if _hdf5_output(par):
+        stores = sorted(glob.glob(corr_store_name(par['co']['res_dir'],'*')))
+        IDs = []
+        for fname in stores:
+            store = CorrelationStore(fname,mode='r')
+            IDs += store.combinations()
+            store.close()
+        IDs = sorted(set(IDs))
+        for cind in comb_ind:
+            ID0 = comb_list[0][cind].split('.')
+            ID1 = comb_list[1][cind].split('.')
+            comb_str = '%s-%s.%s-%s.*.%s-%s' % (ID0[0],ID1[0],ID0[1],ID1[1],ID0[3],ID1[3])
+            try:
+                ID = [tID for tID in IDs if fnmatch.fnmatch(tID,comb_str)][0]
+                mat = corr_mat_from_stores(stores,ID)
+                fname = 'mat__%s.mat' % ID.replace('-','')
+                tr = corr_mat_extract_trace(mat,method='norm_mean')
+                save_dict_to_matlab_file(os.path.join(par['co']['res_dir'],fname.replace('mat__','ctr__')),tr)
+                rmat = corr_mat_resample(mat,sttimes)
+                save_dict_to_matlab_file(os.path.join(par['co']['res_dir'],fname),rmat)
+            except:
+                logger.warning("Problem with combination %s-%s: %s" % 
+                                (comb_list[0][cind], comb_list[1][cind], sys.exc_info()[0]))
+
     # combine matrices of subdivisions
-    if ('subdivision' in par['co']) and not par['co']['subdivision']['recombine_subdivision']:
+    elif ('subdivision' in par['co']) and not par['co']['subdivision']['recombine_subdivision']:
         for cind in comb_ind:
             print "\n>>> Working on combination %s-%s at %s:" % \
                         (comb_list[0][cind],comb_list[1][cind],UTCDateTime())
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+""" build or update the index of the waveform files used by read_from_filesystem
+"""
+import sys
+
+from miic.core.stream import WaveformIndex
+
+
+def index_waveforms(index_file, directory):
+    """Index all waveform files below ``directory`` in ``index_file``
+
+    Only new or modified files are read. Files that were deleted are removed
+    from the index.
+    """
+    index = WaveformIndex(index_file)
+    nread = index.scan(directory)
+    print '%s: read the headers of %d files below %s' % (index_file, nread,
+                                                         directory)
+    index.close()
+
+
+if __name__=="__main__":
+    if len(sys.argv) < 3:
+        print 'Usage: index_waveforms.py INDEX_FILE DIRECTORY'
+        sys.exit()
+    index_waveforms(sys.argv[1], sys.argv[2])
@@ -188,7 +188,12 @@ def paracorr(par):
                 
                     # distributed writing
                     # mapping of stations to processes
-                    pmap = (np.arange(len(rcst))*psize)/len(rcst)
+                    if ('distribution' in targs.keys()) and \
+                            (targs['distribution'] == 'grid'):
+                        # correlations are only returned on rank 0
+                        pmap = np.zeros(len(rcst),dtype=int)
+                    else:
+                        pmap = (np.arange(len(rcst))*psize)/len(rcst)
                     # indecies for stations to be worked on by each process
                     tr_ind = np.where(pmap == rank)[0]
                     logger.debug('Process %d starting to write %d traces to %s.' % (rank,len(tr_ind),pathname))
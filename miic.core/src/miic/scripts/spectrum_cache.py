@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+""" inspect or purge the spectrum cache of pxcorr
+"""
+import sys
+
+from miic.core.pxcorr_func import SpectrumCache
+
+
+def spectrum_cache_info(directory):
+    """Print the number of spectra in the cache and its size
+    """
+    cache = SpectrumCache(directory)
+    flist = cache.files()
+    size = sum([fsize for mtime, fsize, path in flist])
+    print '%s: %d spectra, %.1f MB' % (directory, len(flist), size/2.**20)
+
+
+def spectrum_cache_purge(directory, max_size=0):
+    """Remove least recently used spectra until the cache is smaller than
+    ``max_size`` MB (remove all spectra by default)
+    """
+    cache = SpectrumCache(directory)
+    cache.evict(int(max_size*2**20))
+    spectrum_cache_info(directory)
+
+
+if __name__=="__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ['info', 'purge']:
+        print 'Usage: spectrum_cache.py info DIRECTORY'
+        print '       spectrum_cache.py purge DIRECTORY [MAX_SIZE_MB]'
+        sys.exit()
+    if sys.argv[1] == 'info':
+        spectrum_cache_info(sys.argv[2])
+    elif len(sys.argv) > 3:
+        spectrum_cache_purge(sys.argv[2], float(sys.argv[3]))
+    else:
+        spectrum_cache_purge(sys.argv[2])
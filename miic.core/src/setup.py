@@ -1,7 +1,8 @@
 from distutils.core import setup
 from Cython.Build import cythonize
 
-setup(ext_modules = cythonize("miic/core/pxcorr_func.pyx"))
+setup(ext_modules = cythonize("miic/core/pxcorr_func.pyx"),
+      requires = ['numpy'])
 
 
 ## module purge